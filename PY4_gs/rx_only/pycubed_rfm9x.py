@@ -12,11 +12,22 @@ Library Repo: https://github.com/pycubed/library_pycubed.py
 """
 import time
 from random import random
-import digitalio
-from micropython import const
+try:
+    import digitalio
+    from micropython import const
+except ImportError:
+    # Running under CPython without the Blinka/micropython shims
+    digitalio = None
+    def const(x):
+        return x
 # import adafruit_bus_device.spi_device as spidev
-import spidev
-import RPi.GPIO as GPIO
+try:
+    import spidev
+    import RPi.GPIO as GPIO
+except ImportError:
+    # Only needed for hardware, see the `spi` and `gpio` arguments of RFM9x
+    spidev = None
+    GPIO = None
 
 
 # pylint: disable=bad-whitespace
@@ -73,6 +84,20 @@ _RH_RF95_REG_64_AGC_THRESH3 = const(0x64)
 _RH_RF95_DETECTION_OPTIMIZE = const(0x31)
 _RH_RF95_DETECTION_THRESHOLD = const(0x37)
 
+# Configuration registers that only change when written by us. Reads of
+# these are served from the driver's shadow copy, op mode, FIFO pointers,
+# IRQ flags and packet status are always read from the chip. The addresses
+# are of the LoRa register page, in FSK/OOK mode nothing is shadowed.
+_SHADOW_REGISTERS = (
+    0x06, 0x07, 0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0E, 0x0F, 0x11,
+    0x1D, 0x1E, 0x1F, 0x20, 0x21, 0x22, 0x23, 0x24, 0x26, 0x27,
+    0x2F, 0x30, 0x31, 0x33, 0x36, 0x37, 0x39, 0x3A, 0x40, 0x41,
+    0x42, 0x4B, 0x4D,
+)
+
+# LongRangeMode bit of RegOpMode
+_RH_RF95_LONG_RANGE_MODE = const(0x80)
+
 _RH_RF95_PA_DAC_DISABLE = const(0x04)
 _RH_RF95_PA_DAC_ENABLE = const(0x07)
 
@@ -187,11 +212,11 @@ class RFM9x:
             self._offset = offset
 
         def __get__(self, obj, objtype):
-            reg_value = obj._read_u8(self._address)
+            reg_value = obj._read_cached(self._address)
             return (reg_value & self._mask) >> self._offset
 
         def __set__(self, obj, val):
-            reg_value = obj._read_u8(self._address)
+            reg_value = obj._read_cached(self._address)
             reg_value &= ~self._mask
             reg_value |= (val & 0xFF) << self._offset
             obj._write_u8(self._address, reg_value)
@@ -230,8 +255,13 @@ class RFM9x:
         high_power=True,
         baudrate=5000000,
         max_output=True,
-        hot_start=False
+        hot_start=False,
+        gpio=None
     ):
+        # Write-through copy of the configuration registers, kept while the
+        # chip is in LoRa mode as last written to RegOpMode
+        self._shadow = {}
+        self._lora_mode = False
         self.hot_start=hot_start
         self.high_power = high_power
         self.max_output=max_output
@@ -240,16 +270,22 @@ class RFM9x:
         # Device support SPI mode 0 (polarity & phase = 0) up to a max of 10mhz.
         # Set Default Baudrate to 5MHz to avoid problems
         # self._device = spidev.SPIDevice(spi, cs, baudrate=baudrate, polarity=0, phase=0)
-        self.spi = spidev.SpiDev()
-        self.spi.open(0, 0)
-        self.spi.max_speed_hz = 5000000
+        if hasattr(spi, 'xfer'):
+            # Already a spidev style device, e.g. sx127x_emulator.EmulatedSpiDev
+            self.spi = spi
+        else:
+            self.spi = spidev.SpiDev()
+            self.spi.open(0, 0)
+            self.spi.max_speed_hz = 5000000
+        # RPi.GPIO or a stand-in with the same interface (sx127x_emulator.EmulatedGPIO)
+        self._gpio = GPIO if gpio is None else gpio
         # Setup reset as a digital input (default state for reset line according
         # to the datasheet).  This line is pulled low as an output quickly to
         # trigger a reset.  Note that reset MUST be done like this and set as
         # a high impedence input or else the chip cannot change modes (trust me!).
         self._reset = reset
         # self._reset.switch_to_input(pull=digitalio.Pull.UP)
-        self._reset = GPIO.setup(12, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        self._reset = self._gpio.setup(12, self._gpio.IN, pull_up_down=self._gpio.PUD_UP)
 
         ## ------ hot-start jump point ------
         if self.hot_start:
@@ -401,6 +437,7 @@ class RFM9x:
         self.operation_mode = SLEEP_MODE
         time.sleep(0.01)
         self.long_range_mode=False # FSK/OOK Mode
+        self._shadow.clear() # register map changes with the modem
         self.modulation_type=1 # OOK
         self.modulation_shaping = 2
         self._write_u8(0x25,0x00) # no preamble
@@ -431,6 +468,7 @@ class RFM9x:
             self.operation_mode = SLEEP_MODE
             time.sleep(0.01)
             self.long_range_mode = True
+            self._shadow.clear()
             self._write_u8(_RH_RF95_REG_0E_FIFO_TX_BASE_ADDR, 0x00)
             self._write_u8(_RH_RF95_REG_0F_FIFO_RX_BASE_ADDR, 0x00)
             self._write_u8(_RH_RF95_REG_24_HOP_PERIOD, 0x00)
@@ -484,10 +522,39 @@ class RFM9x:
             length = len(buf)
         self._spi_write(address, buf)
 
+    def _read_cached(self, address):
+        # Configuration registers come from the shadow once known,
+        # everything else (and everything in FSK/OOK mode) is read from the chip.
+        try:
+            return self._shadow[address]
+        except KeyError:
+            val = self._read_u8(address)
+            if self._lora_mode and address in _SHADOW_REGISTERS:
+                self._shadow[address] = val
+            return val
+
+    def resync(self):
+        """Reload the register shadow from the chip in one burst read."""
+        regs = self._spi_read(0x01, _SHADOW_REGISTERS[-1])
+        self._shadow.clear()
+        self._lora_mode = bool(regs[0] & _RH_RF95_LONG_RANGE_MODE)
+        if not self._lora_mode:
+            return
+        for address in _SHADOW_REGISTERS:
+            self._shadow[address] = regs[address - 1]
+
     def _write_u8(self, address, val):
         # Write a byte register to the chip.  Specify the 7-bit address and the
         # 8-bit value to write to that address.
         self._spi_write(address,val)
+        if address == _RH_RF95_REG_01_OP_MODE:
+            lora_mode = bool(val & _RH_RF95_LONG_RANGE_MODE)
+            if lora_mode != self._lora_mode:
+                # Register map changes with the modem
+                self._shadow.clear()
+                self._lora_mode = lora_mode
+        elif self._lora_mode and address in _SHADOW_REGISTERS:
+            self._shadow[address] = val & 0xFF
         '''
         with self._device as device:
             self._BUFFER[0] = (address | 0x80) & 0xFF  # Set top bit to 1 to
@@ -498,10 +565,13 @@ class RFM9x:
 
     def reset(self):
         """Perform a reset of the chip."""
+        # Registers return to their defaults, FSK/OOK mode included
+        self._shadow.clear()
+        self._lora_mode = False
         # See section 7.2.2 of the datasheet for reset description.
-        self._reset = GPIO.setup(12, GPIO.OUT)
+        self._reset = self._gpio.setup(12, self._gpio.OUT)
         time.sleep(0.0001)  # 100 us
-        self._reset = GPIO.setup(12, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        self._reset = self._gpio.setup(12, self._gpio.IN, pull_up_down=self._gpio.PUD_UP)
         time.sleep(0.005)  # 5 ms
 
     def idle(self):
@@ -533,8 +603,8 @@ class RFM9x:
         16-bit value.  Received packets must match this length or they are
         ignored! Set to 8 to match the RadioHead RFM95 library.
         """
-        msb = self._read_u8(_RH_RF95_REG_20_PREAMBLE_MSB)
-        lsb = self._read_u8(_RH_RF95_REG_21_PREAMBLE_LSB)
+        msb = self._read_cached(_RH_RF95_REG_20_PREAMBLE_MSB)
+        lsb = self._read_cached(_RH_RF95_REG_21_PREAMBLE_LSB)
         return ((msb << 8) | lsb) & 0xFFFF
 
     @preamble_length.setter
@@ -548,9 +618,9 @@ class RFM9x:
         """The frequency of the radio in Megahertz. Only the allowed values for
         your radio must be specified (i.e. 433 vs. 915 mhz)!
         """
-        msb = self._read_u8(_RH_RF95_REG_06_FRF_MSB)
-        mid = self._read_u8(_RH_RF95_REG_07_FRF_MID)
-        lsb = self._read_u8(_RH_RF95_REG_08_FRF_LSB)
+        msb = self._read_cached(_RH_RF95_REG_06_FRF_MSB)
+        mid = self._read_cached(_RH_RF95_REG_07_FRF_MID)
+        lsb = self._read_cached(_RH_RF95_REG_08_FRF_LSB)
         frf = ((msb << 16) | (mid << 8) | lsb) & 0xFFFFFF
         frequency = (frf * _RH_RF95_FSTEP) / 1000000.0
         return frequency
@@ -637,7 +707,7 @@ class RFM9x:
         value to increase throughput or to a lower value to increase the
         likelihood of successfully received payloads).  Valid values are
         listed in RFM9x.bw_bins."""
-        bw_id = (self._read_u8(_RH_RF95_REG_1D_MODEM_CONFIG1) & 0xF0) >> 4
+        bw_id = (self._read_cached(_RH_RF95_REG_1D_MODEM_CONFIG1) & 0xF0) >> 4
         if bw_id >= len(bw_bins):
             current_bandwidth = 500000
         else:
@@ -679,7 +749,7 @@ class RFM9x:
                 bw_id = 9
         self._write_u8(
             _RH_RF95_REG_1D_MODEM_CONFIG1,
-            (self._read_u8(_RH_RF95_REG_1D_MODEM_CONFIG1) & 0x0F) | (bw_id << 4),
+            (self._read_cached(_RH_RF95_REG_1D_MODEM_CONFIG1) & 0x0F) | (bw_id << 4),
         )
         if val >= 500000:
             # see Semtech SX1276 errata note 2.3
@@ -711,7 +781,7 @@ class RFM9x:
         correction (try setting to a higher value to increase tolerance of
         short bursts of interference or to a lower value to increase bit
         rate).  Valid values are limited to 5, 6, 7, or 8."""
-        cr_id = (self._read_u8(_RH_RF95_REG_1D_MODEM_CONFIG1) & 0x0E) >> 1
+        cr_id = (self._read_cached(_RH_RF95_REG_1D_MODEM_CONFIG1) & 0x0E) >> 1
         denominator = cr_id + 4
         return denominator
 
@@ -722,7 +792,7 @@ class RFM9x:
         cr_id = denominator - 4
         self._write_u8(
             _RH_RF95_REG_1D_MODEM_CONFIG1,
-            (self._read_u8(_RH_RF95_REG_1D_MODEM_CONFIG1) & 0xF1) | (cr_id << 1),
+            (self._read_cached(_RH_RF95_REG_1D_MODEM_CONFIG1) & 0xF1) | (cr_id << 1),
         )
 
     @property
@@ -731,7 +801,7 @@ class RFM9x:
         value to increase the receiver's ability to distinguish signal from
         noise or to a lower value to increase the data transmission rate).
         Valid values are limited to 6, 7, 8, 9, 10, 11, or 12."""
-        sf_id = (self._read_u8(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0xF0) >> 4
+        sf_id = (self._read_cached(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0xF0) >> 4
         return sf_id
 
     @spreading_factor.setter
@@ -750,7 +820,7 @@ class RFM9x:
         self._write_u8(
             _RH_RF95_REG_1E_MODEM_CONFIG2,
             (
-                (self._read_u8(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0x0F)
+                (self._read_cached(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0x0F)
                 | ((val << 4) & 0xF0)
             ),
         )
@@ -761,7 +831,7 @@ class RFM9x:
         """Set to True to enable hardware CRC checking of incoming packets.
         Incoming packets that fail the CRC check are not processed.  Set to
         False to disable CRC checking and process all incoming packets."""
-        return (self._read_u8(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0x04) == 0x04
+        return (self._read_cached(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0x04) == 0x04
 
     @enable_crc.setter
     def enable_crc(self, val):
@@ -769,12 +839,12 @@ class RFM9x:
         if val:
             self._write_u8(
                 _RH_RF95_REG_1E_MODEM_CONFIG2,
-                self._read_u8(_RH_RF95_REG_1E_MODEM_CONFIG2) | 0x04,
+                self._read_cached(_RH_RF95_REG_1E_MODEM_CONFIG2) | 0x04,
             )
         else:
             self._write_u8(
                 _RH_RF95_REG_1E_MODEM_CONFIG2,
-                self._read_u8(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0xFB,
+                self._read_cached(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0xFB,
             )
 
     def tx_done(self):
@@ -1206,6 +1276,7 @@ class RFM9x:
         time.sleep(0.01)
         # put chip into FSK mode
         self.long_range_mode=False # FSK/OOK Mode
+        self._shadow.clear() # register map changes with the modem
         self.modulation_type=0 # FSK
         # set freq deviation to 0
         self._write_u8(0x04, 0) # RegFdevMsb
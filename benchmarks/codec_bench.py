@@ -0,0 +1,181 @@
+"""
+'codec_bench.py'
+================
+Microbenchmark of the protocol codec in src/protocol_database.py. For
+every message type it reports:
+
+    receive_pps     packets/s through gs_unpack_header, the ground station's
+                    receive path (header, decode, prints, InfluxDB uploads
+                    to a no-op database, stdout to /dev/null)
+    decode_pps      packets/s through the message schema's decode alone
+    encode_pps      packets/s packed into a FrameBuffer (messages sent only)
+    blocks_per_pkt  memory blocks still allocated per decoded packet when
+                    the records are kept (sys.getallocatedblocks)
+    peak_bytes      peak memory allocated while decoding one packet (tracemalloc)
+
+plus the batch fixed point codec in values/s when numpy is installed.
+
+Usage, from the repository root:
+
+    python benchmarks/codec_bench.py --output codec.json
+    python benchmarks/codec_bench.py --compare codec.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+from lora_packet import LoRaPacket
+from protocol_database import RECEIVE_SCHEMAS, TRANSMIT_SCHEMAS, FrameBuffer, gs_unpack_header
+from sim_satellite import SimDatabase
+import fixed_point
+
+from codec_check import random_frame
+from pass_throughput import git_commit
+
+COMPARE_METRICS = (("receive_pps", True), ("decode_pps", True), ("encode_pps", True),
+                   ("blocks_per_pkt", False), ("peak_bytes", False))
+
+
+class NullDatabase:
+    """DATABASE stand-in whose uploads do nothing"""
+
+
+for _name in SimDatabase.UPLOADS:
+    setattr(NullDatabase, _name, lambda self, *args, time_ns=None: None)
+
+
+def rate(function, items, min_time):
+    """Calls of `function` per second over `items`, repeated for at least `min_time` seconds"""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        for item in items:
+            function(item)
+        calls += len(items)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return calls / elapsed
+
+
+def bench_schema(schema, rng, frames, min_time):
+    messages = [random_frame(rng, schema) for _ in range(frames)]
+    payloads = [LoRaPacket(message, 255, 2, 0, 0, -80.0, 9.5, 0, 0) for message, *_ in messages]
+    records = [(schema.decode(message), flags, sequence_count, tail)
+               for message, _, flags, sequence_count, tail in messages]
+    influx = NullDatabase()
+    buffer = FrameBuffer(1)
+
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        receive_pps = rate(lambda payload: gs_unpack_header(payload, influx), payloads, min_time)
+    decode_pps = rate(schema.decode, [message for message, *_ in messages], min_time)
+    encode_pps = None
+    if schema.message_ID in TRANSMIT_SCHEMAS:
+        encode_pps = rate(lambda item: buffer.pack(0, schema.message_ID, *item), records, min_time)
+
+    # Blocks left behind by decoding, with the records kept
+    kept = [None] * len(messages)
+    before = sys.getallocatedblocks()
+    for i, (message, *_) in enumerate(messages):
+        kept[i] = schema.decode(message)
+    blocks = (sys.getallocatedblocks() - before) / len(messages)
+    del kept
+
+    # Peak of the transient allocations of one decode
+    message = messages[0][0]
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    schema.decode(message)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    return {"size": schema.size, "receive_pps": receive_pps, "decode_pps": decode_pps,
+            "encode_pps": encode_pps, "blocks_per_pkt": blocks, "peak_bytes": peak}
+
+
+def bench_batch(rng, values, min_time):
+    if fixed_point.np is None:
+        return None
+    data = bytes(rng.getrandbits(8) for _ in range(4 * values))
+    floats = fixed_point.decode_fixed_point(data)
+    results = {}
+    for name, function, argument in (("decode_fixed_point", fixed_point.decode_fixed_point, data),
+                                     ("decode_fixed_point_hp", fixed_point.decode_fixed_point_hp, data),
+                                     ("encode_fixed_point", fixed_point.encode_fixed_point, floats),
+                                     ("encode_fixed_point_hp", fixed_point.encode_fixed_point_hp, floats)):
+        results[name] = rate(function, [argument], min_time) * values
+    return results
+
+
+def compare(results, baseline):
+    print(f"{'message':<22}{'metric':<18}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, metrics in results["messages"].items():
+        old_metrics = baseline["messages"].get(name)
+        if old_metrics is None:
+            continue
+        for metric, higher_is_better in COMPARE_METRICS:
+            old, new = old_metrics.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / abs(old) * 100 if old else 0.0
+            better = (change > 0) == higher_is_better if change else None
+            mark = "" if better is None else (" +" if better else " -")
+            print(f"{name:<22}{metric:<18}{old:>14.1f}{new:>14.1f}{change:>9.1f}%{mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--frames", type=int, default=256, help="random frames per message type")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement")
+    parser.add_argument("--batch-values", type=int, default=100000, help="values per batch codec call")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    results = {
+        "benchmark": "codec_bench",
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "messages": {},
+    }
+
+    print(f"{'message':<22}{'bytes':>6}{'receive/s':>12}{'decode/s':>12}{'encode/s':>12}"
+          f"{'blocks/pkt':>12}{'peak B':>8}")
+    for message_ID, schema in sorted({**RECEIVE_SCHEMAS, **TRANSMIT_SCHEMAS}.items()):
+        metrics = bench_schema(schema, rng, args.frames, args.min_time)
+        results["messages"][schema.name] = metrics
+        encode = '-' if metrics['encode_pps'] is None else f"{metrics['encode_pps']:.0f}"
+        print(f"{schema.name:<22}{metrics['size']:>6}{metrics['receive_pps']:>12.0f}{metrics['decode_pps']:>12.0f}"
+              f"{encode:>12}{metrics['blocks_per_pkt']:>12.1f}{metrics['peak_bytes']:>8}")
+
+    results["batch"] = bench_batch(rng, args.batch_values, args.min_time)
+    if results["batch"] is None:
+        print("numpy not installed, batch fixed point codec skipped")
+    else:
+        for name, values_per_s in results["batch"].items():
+            print(f"{name:<22} {values_per_s / 1e6:.1f} M values/s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+'codec_check.py'
+================
+Checks that the protocol codec in src/protocol_database.py (and the batch
+fixed point codec in src/fixed_point.py) still decodes telemetry the way
+it did:
+
+    golden  every frame in codec_corpus.json is decoded and the header,
+            the decoded record and the InfluxDB uploads compared with
+            the ones recorded in the corpus
+    fuzz    seeded random round trips: frame -> record -> frame for every
+            message schema, values -> fixed point -> values, the in-place
+            header parser against plain slicing, and the numpy codec
+            against the scalar one (skipped without numpy)
+
+Usage, from the repository root:
+
+    python benchmarks/codec_check.py
+    python benchmarks/codec_check.py --iterations 100000 --seed 7
+    python benchmarks/codec_check.py --regenerate      # after a deliberate change
+
+Exits with status 1 on any mismatch.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import struct
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+from lora_packet import LoRaPacket
+from protocol_database import (RECEIVE_SCHEMAS, TRANSMIT_SCHEMAS, FIXED_POINT, FIXED_POINT_HP, HEADER,
+                               REQ_ACK_NUM, SAT_IMG_INFO, MAX_MESSAGE_SIZE, FrameBuffer, parse_message,
+                               gs_unpack_header, image_meta_info, convert_fixed_point,
+                               convert_floating_point, convert_fixed_point_hp, convert_floating_point_hp)
+from sim_satellite import SimDatabase
+import fixed_point
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codec_corpus.json')
+
+# Messages with a variable length tail after the schema fields
+TAIL_MESSAGES = ('GsAck', 'GsOtaReq', 'SatImgCmd')
+
+# Every schema, received and sent. Sent ones are unknown messages to the receive path.
+SCHEMAS = {**RECEIVE_SCHEMAS, **TRANSMIT_SCHEMAS}
+
+
+def field_count(fmt):
+    """Raw struct values in one field"""
+    return len(struct.unpack('>' + fmt, bytes(struct.calcsize('>' + fmt))))
+
+
+def random_field(rng, fmt):
+    """Raw struct values of one field, anywhere in their range"""
+    return list(struct.unpack('>' + fmt, bytes(rng.getrandbits(8) for _ in range(struct.calcsize('>' + fmt)))))
+
+
+def random_frame(rng, schema, tail=True):
+    """Random but valid message for a schema, and its raw field values"""
+    raw = []
+    for _, fmt, _, _ in schema.fields:
+        raw.extend(random_field(rng, fmt))
+    extra = bytes(rng.getrandbits(8) for _ in range(rng.randrange(MAX_MESSAGE_SIZE - schema.size + 1))) \
+        if tail and schema.name in TAIL_MESSAGES else b''
+    flags = rng.choice((0, REQ_ACK_NUM))
+    sequence_count = rng.randrange(0x10000)
+    message = schema.frame.pack(schema.message_ID | flags, sequence_count, schema.struct.size + len(extra),
+                                *raw) + extra
+    return message, raw, flags, sequence_count, extra
+
+
+def expected_raw(schema, raw):
+    """Raw values pack(decode(frame)) gives back. -0.0 loses its sign in the 16.16
+    encoder, the HP decoder adds one to the fraction."""
+    expected = list(raw)
+    position = 0
+    for _, fmt, scale, _ in schema.fields:
+        if scale is FIXED_POINT and not (raw[position] & 0x7FFFFFFF):
+            expected[position] = 0
+        elif scale is FIXED_POINT_HP:
+            expected[position] = (raw[position] & 0x80000000) | ((raw[position] & 0x7FFFFFFF) + 1)
+        position += field_count(fmt)
+    return expected
+
+
+def to_json(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, (tuple, list)):
+        return [to_json(item) for item in value]
+    return value
+
+
+def decode_frame(message):
+    """Everything the ground station gets out of one received message, as JSON values"""
+    influx = SimDatabase()
+    payload = LoRaPacket(message, 255, 2, 0, 0, -80.0, 9.5, 0, 0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        received = gs_unpack_header(payload, influx)
+    if received is None:
+        return {"header": None, "uploads": [[name, to_json(list(args))] for name, _, args in influx.records]}
+    decoded = {
+        "header": [received.ack_req, received.message_ID, received.sequence_count, received.size],
+        "body": bytes(received.body).hex(),
+        "record": None if received.record is None else dict(zip(received.record._fields,
+                                                                to_json(list(received.record)))),
+        "uploads": [[name, to_json(list(args))] for name, _, args in influx.records],
+    }
+    if received.message_ID == SAT_IMG_INFO:
+        images = image_meta_info(payload)
+        decoded["image_info"] = None if images is None else [images.image_UID, images.image_size,
+                                                             images.image_message_count]
+    return decoded
+
+
+def corpus_frames(seed=0):
+    """Frames the corpus is generated from: per schema all zero, all one bits, a few
+    random ones, plus an unknown ID, truncated messages and
+    runt frames shorter than the header"""
+    rng = random.Random(seed)
+    frames = []
+    for message_ID, schema in sorted(SCHEMAS.items()):
+        zero = HEADER.pack(message_ID, 0, schema.struct.size) + bytes(schema.struct.size)
+        frames.append((schema.name + " zero", zero))
+        ones = bytearray(b'\xff' * schema.size)
+        ones[1:4] = HEADER.pack(0, 0xFFFF, schema.struct.size)[1:]
+        ones[0] = message_ID | REQ_ACK_NUM
+        frames.append((schema.name + " ones", bytes(ones)))
+        for i in range(3):
+            frames.append((f"{schema.name} random {i}", random_frame(rng, schema)[0]))
+        if schema.struct.size:
+            frames.append((schema.name + " truncated", zero[:schema.size - 1]))
+    frames.append(("unknown ID", bytes([0x7E, 0x00, 0x01, 0x02, 0xAA, 0xBB])))
+    for i, runt in enumerate((b'', b'\x00', b'\x80\x00\x01')):
+        frames.append((f"runt {i}", runt))
+    return frames
+
+
+def golden(regenerate):
+    if regenerate:
+        corpus = [{"name": name, "frame": frame.hex(), "decoded": decode_frame(frame)}
+                  for name, frame in corpus_frames()]
+        with open(CORPUS, "w") as f:
+            json.dump(corpus, f, indent=1)
+        print(f"golden  {len(corpus)} frames written to {CORPUS}")
+        return 0
+
+    with open(CORPUS) as f:
+        corpus = json.load(f)
+    failures = 0
+    for entry in corpus:
+        # Round trip through JSON so floats and tuples compare like the stored ones
+        decoded = json.loads(json.dumps(decode_frame(bytes.fromhex(entry["frame"]))))
+        if decoded != entry["decoded"]:
+            failures += 1
+            print(f"golden  {entry['name']}: expected {entry['decoded']}, got {decoded}")
+    print(f"golden  {len(corpus)} frames, {failures} mismatches")
+    return failures
+
+
+def fuzz(iterations, seed):
+    rng = random.Random(seed)
+    failures = 0
+
+    def fail(what, *details):
+        nonlocal failures
+        failures += 1
+        if failures <= 20:
+            print(f"fuzz    {what}:", *details)
+
+    # frame -> record -> frame for every schema, through pack and, for the ones sent,
+    # a FrameBuffer
+    frames = FrameBuffer(2)
+    schemas = list(SCHEMAS.values())
+    for _ in range(iterations):
+        schema = rng.choice(schemas)
+        message, raw, flags, sequence_count, tail = random_frame(rng, schema)
+        record = schema.decode(message)
+        expected = schema.frame.pack(schema.message_ID | flags, sequence_count, schema.struct.size + len(tail),
+                                     *expected_raw(schema, raw)) + tail
+        packed = schema.pack(record, flags, sequence_count, tail)
+        if packed != expected:
+            fail(schema.name, message.hex(), record, packed.hex())
+        elif schema.message_ID in TRANSMIT_SCHEMAS:
+            if bytes(frames.pack(rng.randrange(2), schema.message_ID, record, flags, sequence_count, tail)) != expected:
+                fail(schema.name + " FrameBuffer", message.hex())
+
+        # The header parser against slicing, on the same frame cut at a random length
+        cut = message[:rng.randrange(len(message) + 1)]
+        received = parse_message(cut)
+        if len(cut) < HEADER.size:
+            if received is not None:
+                fail("parse_message runt", cut.hex(), received)
+        elif (list(received[:4]) != [cut[0] >> 7, cut[0] & 0x7F, int.from_bytes(cut[1:3], 'big'), cut[3]] or
+                bytes(received.body) != cut[4:4 + cut[3]]):
+            fail("parse_message", cut.hex(), received)
+
+    # value -> fixed point -> value, within one step of the format (two for HP)
+    for _ in range(iterations):
+        value = rng.uniform(-32767.99, 32767.99)
+        if abs(convert_floating_point(convert_fixed_point(value)) - value) >= 2 ** -16:
+            fail("16.16", value)
+        value = rng.uniform(-127.99, 127.99)
+        if abs(convert_floating_point_hp(convert_fixed_point_hp(value)) - value) >= 2 ** -23:
+            fail("8.24", value)
+
+    # numpy codec against the scalar one, bit for bit
+    if fixed_point.np is None:
+        print("fuzz    numpy not installed, batch codec skipped")
+    else:
+        np = fixed_point.np
+        words = bytes(rng.getrandbits(8) for _ in range(4 * iterations))
+        lists = [list(words[i:i + 4]) for i in range(0, len(words), 4)]
+        for name, batch, scalar in (("decode_fixed_point", fixed_point.decode_fixed_point, convert_floating_point),
+                                    ("decode_fixed_point_hp", fixed_point.decode_fixed_point_hp,
+                                     convert_floating_point_hp)):
+            expected = np.array([scalar(word) for word in lists])
+            if batch(words).tobytes() != expected.tobytes():
+                fail(name)
+        values = [rng.uniform(-40000, 40000) for _ in range(iterations // 2)] + \
+                 [rng.uniform(-300, 300) for _ in range(iterations // 2)] + [0.0, -0.0, -0.5]
+        for name, batch, scalar in (("encode_fixed_point", fixed_point.encode_fixed_point, convert_fixed_point),
+                                    ("encode_fixed_point_hp", fixed_point.encode_fixed_point_hp,
+                                     convert_fixed_point_hp)):
+            if batch(values).tobytes() != bytes(byte for value in values for byte in scalar(value)):
+                fail(name)
+
+    print(f"fuzz    {iterations} iterations (seed {seed}), {failures} mismatches")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=20000, help="random cases per fuzz check")
+    parser.add_argument("--seed", type=int, default=0, help="fuzz seed")
+    parser.add_argument("--regenerate", action="store_true", help="rewrite codec_corpus.json from this tree")
+    args = parser.parse_args()
+
+    failures = golden(args.regenerate)
+    if not args.regenerate:
+        failures += fuzz(args.iterations, args.seed)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+'driver_bench.py'
+=================
+Benchmark of the LoRa driver in src/argus_lora.py against the register
+level radio model in src/sx127x_emulator.py. A sending and a receiving
+LoRa instance each drive an emulated SX127x over EmulatedSpiDev and get
+DIO0 through EmulatedButton, the two chips are connected. For each
+payload size the sender sends packets back to back and a thread drains
+the receiver's queue, reporting:
+
+    tx_pps          packets/s through send() (waits for the previous TxDone)
+    rx_pps          packets/s out of receive()
+    lost            packets sent that never came out of receive()
+    irq_latency     sender's TxDone -> receiver's RxDone handler entry
+                    (emulator delivery and DIO0 dispatch)
+    rx_latency      RxDone handler entry -> packet out of receive()
+                    (status and FIFO reads, decode, queue)
+    spi_per_rx      SPI transactions to read one received packet
+
+Latencies are p50/p99 in microseconds. With the default `--time-scale 0`
+transmissions complete as soon as the emulator gets to them, so the
+figures are the driver's and emulator's CPU cost, not air time. Packets
+are lost there when the next one lands while the receiver's interrupt
+handler still has RxDone set, so DIO0 does not rise for it.
+
+Usage, from the repository root:
+
+    python benchmarks/driver_bench.py --output driver.json
+    python benchmarks/driver_bench.py --compare driver.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+from argus_lora import LoRa
+from sx127x_emulator import SX127xEmulator, EmulatedSpiDev, EmulatedButton
+
+from pass_throughput import git_commit, percentile
+
+SAT_ADDRESS = 2
+GS_ADDRESS = 255
+
+COMPARE_METRICS = (("tx_pps", True), ("rx_pps", True), ("lost", False),
+                   ("irq_latency_p50_us", False), ("irq_latency_p99_us", False),
+                   ("rx_latency_p50_us", False), ("rx_latency_p99_us", False), ("spi_per_rx", False))
+
+
+def payload(index, size):
+    # Sequence number first so a received packet can be matched to its TxDone
+    return index.to_bytes(4, 'big') + bytes(size - 4)
+
+
+def run_size(size, packets, time_scale):
+    sat_chip = SX127xEmulator(time_scale=time_scale)
+    gs_chip = SX127xEmulator(time_scale=time_scale)
+    sat_chip.connect(gs_chip)
+
+    # on_transmit runs before the packet is handed to the peer
+    tx_done_ns = []
+    sat_chip.on_transmit = lambda packet: tx_done_ns.append(time.monotonic_ns())
+
+    sender = LoRa(0, 19, SAT_ADDRESS, spi=EmulatedSpiDev(sat_chip), irq=EmulatedButton(sat_chip))
+    receiver = LoRa(0, 19, GS_ADDRESS, spi=EmulatedSpiDev(gs_chip), irq=EmulatedButton(gs_chip))
+    receiver.on_recv = lambda packet: None
+    receiver.set_mode_rx()
+
+    # Nothing arrives for this long once the sender is done
+    idle_timeout = 1.0 + sender.time_on_air(size + 4) * time_scale
+    received = []
+    spi_per_rx = []
+
+    def drain():
+        while len(received) < packets:
+            packet = receiver.receive(idle_timeout)
+            if packet is None:
+                return
+            received.append((packet, time.monotonic_ns()))
+            spi_per_rx.append(receiver.last_rx_spi_transactions)
+
+    drainer = threading.Thread(target=drain, name="driver-bench-rx", daemon=True)
+    drainer.start()
+
+    start = time.monotonic_ns()
+    for index in range(packets):
+        sender.send(payload(index, size), GS_ADDRESS)
+    sender.wait_packet_sent()
+    tx_end = time.monotonic_ns()
+    drainer.join()
+
+    irq_latency = []
+    rx_latency = []
+    for packet, dequeued_ns in received:
+        index = int.from_bytes(packet.message[:4], 'big')
+        irq_latency.append((packet.rx_monotonic_ns - tx_done_ns[index]) / 1e3)
+        rx_latency.append((dequeued_ns - packet.rx_monotonic_ns) / 1e3)
+
+    rx_end = received[-1][1] if received else tx_end
+    result = {
+        "size": size,
+        "packets": packets,
+        "tx_pps": packets / ((tx_end - start) / 1e9),
+        "rx_pps": len(received) / ((rx_end - start) / 1e9),
+        "lost": packets - len(received),
+        "irq_latency_p50_us": percentile(irq_latency, 50),
+        "irq_latency_p99_us": percentile(irq_latency, 99),
+        "rx_latency_p50_us": percentile(rx_latency, 50),
+        "rx_latency_p99_us": percentile(rx_latency, 99),
+        "spi_per_rx": sum(spi_per_rx) / len(spi_per_rx) if spi_per_rx else None,
+        "rx_missed": gs_chip.rx_missed,
+        "rx_overflow": receiver.rx_queue.overflow_count,
+    }
+
+    sender.close()
+    receiver.close()
+    sat_chip.close()
+    gs_chip.close()
+    return result
+
+
+def compare(results, baseline):
+    print(f"{'payload':<14}{'metric':<22}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, metrics in results["sizes"].items():
+        old_metrics = baseline["sizes"].get(name)
+        if old_metrics is None:
+            continue
+        for metric, higher_is_better in COMPARE_METRICS:
+            old, new = old_metrics.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / abs(old) * 100 if old else 0.0
+            better = (change > 0) == higher_is_better if change else None
+            mark = "" if better is None else (" +" if better else " -")
+            print(f"{name:<14}{metric:<22}{old:>14.1f}{new:>14.1f}{change:>9.1f}%{mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--packets", type=int, default=2000, help="packets sent per payload size")
+    parser.add_argument("--size", type=int, action="append",
+                        help="payload bytes, 4 to 251 (repeatable, default 8, 64 and 240)")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="emulated time-on-air scale, 1 is real time, 0 as fast as possible")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "benchmark": "driver_bench",
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "time_scale": args.time_scale,
+        "sizes": {},
+    }
+
+    print(f"{'payload':<10}{'tx/s':>10}{'rx/s':>10}{'lost':>6}{'irq p50/p99 us':>18}"
+          f"{'rx p50/p99 us':>18}{'spi/rx':>8}")
+    for size in args.size or (8, 64, 240):
+        assert 4 <= size <= 251, "payload size must be 4 to 251 bytes"
+        metrics = run_size(size, args.packets, args.time_scale)
+        results["sizes"][f"payload_{size}"] = metrics
+        irq = f"{metrics['irq_latency_p50_us'] or 0:.0f}/{metrics['irq_latency_p99_us'] or 0:.0f}"
+        rx = f"{metrics['rx_latency_p50_us'] or 0:.0f}/{metrics['rx_latency_p99_us'] or 0:.0f}"
+        print(f"{size:<10}{metrics['tx_pps']:>10.0f}{metrics['rx_pps']:>10.0f}{metrics['lost']:>6}"
+              f"{irq:>18}{rx:>18}{metrics['spi_per_rx'] or 0:>8.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+'pass_throughput.py'
+====================
+End-to-end pass benchmark. Drives the real GROUNDSTATION state machine
+(heartbeat -> IMG_INFO -> image windows -> SAT_DEL_IMG -> GS_STOP, and
+the OTA uplink) against the simulated satellite in src/sim_satellite.py
+over a virtual link, and reports per scenario:
+
+    images per pass, intact images and goodput (bytes/s of pass time)
+    retransmission ratio of image chunks and OTA frames
+    ground station turnaround (ack request received -> reply sent)
+        in virtual time and in CPU time spent getting there
+    CPU time per packet
+
+Usage, from the repository root:
+
+    python benchmarks/pass_throughput.py --output results.json
+    python benchmarks/pass_throughput.py --compare results.json
+
+Results are JSON so runs on different commits can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+from protocol_database import GS_OTA_REQ, REQ_ACK_NUM
+from GS_helpers import AWS_S3_BUCKET_NAME
+from sim_satellite import simulate_pass
+from adaptive_modem import ModemController
+from virtual_link import GilbertElliottChannel, pass_snr_trace
+
+
+def make_images(count, size, seed):
+    rng = random.Random(seed)
+    return [bytes(rng.getrandbits(8) for _ in range(size)) for _ in range(count)]
+
+
+SCENARIOS = {
+    # Strong signal for the whole pass, no losses
+    "clean": dict(
+        uplink=lambda seed, duration: GilbertElliottChannel(seed=seed),
+        downlink=lambda seed, duration: GilbertElliottChannel(seed=seed + 1),
+    ),
+    # SNR follows the pass geometry, packets below the SF7 floor are lost near the horizons
+    "pass_profile": dict(
+        uplink=lambda seed, duration: GilbertElliottChannel(snr_trace=pass_snr_trace(duration), seed=seed),
+        downlink=lambda seed, duration: GilbertElliottChannel(snr_trace=pass_snr_trace(duration), seed=seed + 1),
+    ),
+    # Burst losses and occasional CRC errors on top of the pass profile
+    "bursty": dict(
+        uplink=lambda seed, duration: GilbertElliottChannel(p_good_to_bad=0.01, p_bad_to_good=0.3, loss_bad=0.8,
+                                                            snr_trace=pass_snr_trace(duration), seed=seed),
+        downlink=lambda seed, duration: GilbertElliottChannel(p_good_to_bad=0.03, p_bad_to_good=0.3, loss_bad=0.8,
+                                                              crc_error_rate=0.005,
+                                                              snr_trace=pass_snr_trace(duration), seed=seed + 1),
+    ),
+    # Pass profile with the ground station negotiating the modem config from link SNR
+    "adaptive": dict(
+        uplink=lambda seed, duration: GilbertElliottChannel(snr_trace=pass_snr_trace(duration), seed=seed),
+        downlink=lambda seed, duration: GilbertElliottChannel(snr_trace=pass_snr_trace(duration), seed=seed + 1),
+        modem_controller=ModemController,
+    ),
+    # OTA uplink of tinyimage.jpg before the image downlink
+    "ota": dict(
+        uplink=lambda seed, duration: GilbertElliottChannel(p_good_to_bad=0.01, p_bad_to_good=0.3, loss_bad=0.8,
+                                                            seed=seed),
+        downlink=lambda seed, duration: GilbertElliottChannel(seed=seed + 1),
+        commands=['GS_OTA_REQ'],
+    ),
+}
+
+# Metrics shown by --compare, and whether bigger is better
+COMPARE_METRICS = (
+    ("images_intact", True),
+    ("goodput_Bps", True),
+    ("retransmission_ratio", False),
+    ("ota_retransmission_ratio", False),
+    ("turnaround_p50_ms", False),
+    ("turnaround_p99_ms", False),
+    ("turnaround_cpu_p99_ms", False),
+    ("cpu_us_per_packet", False),
+)
+
+
+def percentile(values, p):
+    # Nearest-rank percentile, None for no samples
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def run_once(scenario, seed, duration, images):
+    taps = {"rx": [], "tx": []}
+
+    def setup(result):
+        radio = result["link"].radio_a
+        clock = result["clock"]
+        on_recv, send = radio.on_recv, radio.send
+
+        def tap_recv(packet):
+            taps["rx"].append((clock.monotonic(), time.process_time(), packet.message[0]))
+            on_recv(packet)
+
+        def tap_send(data, header_to, header_id=0, header_flags=0):
+            taps["tx"].append((clock.monotonic(), time.process_time(), bytes(data[:1])))
+            return send(data, header_to, header_id, header_flags)
+
+        radio.on_recv = tap_recv
+        radio.send = tap_send
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = simulate_pass(duration, images=images,
+                           uplink=scenario["uplink"](seed, duration),
+                           downlink=scenario["downlink"](seed, duration),
+                           commands=scenario.get("commands", ()), setup=setup,
+                           modem_controller=scenario.get("modem_controller", lambda: None)())
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    satellite = result["satellite"]
+    link = result["link"]
+    gs_radio, sat_radio = link.radio_a, link.radio_b
+
+    downloaded = [data for bucket, key, data in result["s3"].uploads
+                  if bucket == AWS_S3_BUCKET_NAME and key.startswith("earth_image")]
+    intact = [data for data in downloaded if data in images]
+
+    # Turnaround: from the packet that asked for a reply to the reply going out
+    turnaround, turnaround_cpu = [], []
+    rx = taps["rx"]
+    i = 0
+    last_request = None
+    for tx_time, tx_cpu, _ in taps["tx"]:
+        while i < len(rx) and rx[i][0] <= tx_time:
+            if rx[i][2] & REQ_ACK_NUM:
+                last_request = rx[i]
+            i += 1
+        if last_request is not None:
+            turnaround.append((tx_time - last_request[0]) * 1e3)
+            turnaround_cpu.append((tx_cpu - last_request[1]) * 1e3)
+            last_request = None
+
+    ota_sent = sum(1 for _, _, head in taps["tx"] if head and head[0] & 0x7F == GS_OTA_REQ)
+    ota_needed = satellite.ota_message_count
+    packets = gs_radio.rx_packets + sat_radio.rx_packets
+    controller = result["gs"].modem_controller
+
+    return {
+        "seed": seed,
+        "images_completed": len(downloaded),
+        "images_intact": len(intact),
+        "image_bytes_intact": sum(len(data) for data in intact),
+        "goodput_Bps": sum(len(data) for data in intact) / duration,
+        "chunks_sent": satellite.chunks_sent,
+        "chunks_unique": len(satellite.chunks_unique),
+        "retransmission_ratio": ((satellite.chunks_sent - len(satellite.chunks_unique)) / satellite.chunks_sent
+                                 if satellite.chunks_sent else 0.0),
+        "ota_complete": satellite.ota_file() is not None,
+        "ota_complete_s": satellite.ota_complete_time,
+        "ota_frames_sent": ota_sent,
+        "ota_retransmission_ratio": (ota_sent - ota_needed) / ota_sent if ota_sent else 0.0,
+        "gs_tx_packets": gs_radio.tx_packets,
+        "gs_rx_packets": gs_radio.rx_packets,
+        "gs_crc_errors": gs_radio.crc_error_count,
+        "modem_switches": len(controller.switches) if controller is not None else 0,
+        "downlink": link.downlink.stats(),
+        "uplink": link.uplink.stats(),
+        "turnaround_p50_ms": percentile(turnaround, 50),
+        "turnaround_p90_ms": percentile(turnaround, 90),
+        "turnaround_p99_ms": percentile(turnaround, 99),
+        "turnaround_cpu_p50_ms": percentile(turnaround_cpu, 50),
+        "turnaround_cpu_p99_ms": percentile(turnaround_cpu, 99),
+        "cpu_s": cpu,
+        "cpu_us_per_packet": cpu / packets * 1e6 if packets else None,
+        "wall_s": wall,
+    }
+
+
+def summarize(runs):
+    summary = {}
+    for key, value in runs[0].items():
+        if key == "seed" or isinstance(value, dict):
+            continue
+        values = [run[key] for run in runs if isinstance(run[key], (int, float)) and run[key] is not None]
+        if values:
+            summary[key] = sum(values) / len(values)
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print(f"{'scenario':<14}{'metric':<28}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, scenario in results["scenarios"].items():
+        if name not in baseline["scenarios"]:
+            continue
+        old_summary = baseline["scenarios"][name]["summary"]
+        for metric, higher_is_better in COMPARE_METRICS:
+            old, new = old_summary.get(metric), scenario["summary"].get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / abs(old) * 100 if old else 0.0
+            better = (change > 0) == higher_is_better if change else None
+            mark = "" if better is None else (" +" if better else " -")
+            print(f"{name:<14}{metric:<28}{old:>14.3f}{new:>14.3f}{change:>9.1f}%{mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=float, default=600.0, help="pass length in seconds")
+    parser.add_argument("--seeds", type=int, default=3, help="runs per scenario")
+    parser.add_argument("--images", type=int, default=20, help="images stored on the satellite")
+    parser.add_argument("--image-size", type=int, default=20000, help="bytes per image")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable, default all)")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    images = make_images(args.images, args.image_size, seed=0)
+    results = {
+        "benchmark": "pass_throughput",
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "duration_s": args.duration,
+        "images": args.images,
+        "image_size": args.image_size,
+        "scenarios": {},
+    }
+
+    for name in args.scenario or SCENARIOS:
+        runs = [run_once(SCENARIOS[name], seed, args.duration, images) for seed in range(args.seeds)]
+        summary = summarize(runs)
+        results["scenarios"][name] = {"summary": summary, "runs": runs}
+        print(f"{name:<14} images {summary['images_intact']:.2f}  goodput {summary['goodput_Bps']:.1f} B/s  "
+              f"retx {summary['retransmission_ratio']:.3f}  turnaround p50 {summary.get('turnaround_p50_ms', 0):.0f} ms  "
+              f"cpu/packet {summary.get('cpu_us_per_packet', 0):.0f} us")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,28 @@
 from enum import Enum
 from protocol_database import *
 from influx_db import *
+from airtime import AirtimeBudget
+from adaptive_modem import modem_config_bytes, modem_config_from_bytes
+from image_store import PartialImage
+from upload_queue import UploadQueue, MIN_PART_SIZE
 import time
 import sys
 import os
 import datetime
-import boto3
-from gpiozero import LED
+
+try:
+    import boto3
+    from gpiozero import LED
+except ImportError:
+    # Only needed on the ground station itself, the simulator
+    # (sim_satellite.py) passes its own backends to GROUNDSTATION
+    boto3 = None
+    LED = None
 
 AWS_S3_BUCKET_NAME = 'spacecraft-files'
 AWS_PUBLIC_BUCKET = 'public-argus-bucket'
 AWS_REGION = 'us-east-2'
 
-# Globals
-received_success = False
-
 class IMAGE_DEFS(Enum):
     IMAGE_1 = 1
     IMAGE_2 = 2
@@ -24,15 +32,45 @@ class GROUNDSTATION:
     '''
         Name: __init__
         Description: Initialization of GROUNDSTATION class
+        Inputs:
+            rx_timeout - seconds to wait for the satellite to start talking (None waits
+                forever), later packets of a burst are waited for as long as the
+                modem config's airtime says they take
+            s3_client, influx, rx_ctrl, tx_ctrl - replace the AWS client, the InfluxDB
+                database and the RX/TX control LEDs, None creates the real ones
+            clock - time source providing time(), monotonic() and sleep(), e.g. a VirtualClock
+            commands_file - file listing the commands to send each pass
+            ota_file - file uplinked by GS_OTA_REQ
+            pass_duration - seconds of each pass covered by one airtime budget
+            modem_controller - adaptive_modem.ModemController that negotiates modem config
+                changes with the satellite, None keeps the LoRa module's config
+            image_dir - directory partially downloaded images are kept in between passes
+            upload_spool - directory uploads to S3 wait in until the background worker
+                has sent them, uploads left from an earlier run are resumed
+            upload_part_size - images are streamed to S3 in parts of this many bytes
+                while they are downlinked, smaller images are uploaded once complete
     '''
-    def __init__(self):
-        print('Setting up AWS')
-        self.s3_client = boto3.client(
-            service_name='s3',
-            region_name=AWS_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY,
-            aws_secret_access_key=AWS_SECRET_KEY
-        )
+    def __init__(self, rx_timeout=10.0, s3_client=None, influx=None, rx_ctrl=None, tx_ctrl=None,
+                 clock=time, commands_file='groundstation_commands.txt', ota_file='tinyimage.jpg',
+                 pass_duration=600.0, modem_controller=None, image_dir='partial_images',
+                 upload_spool='upload_spool', upload_part_size=MIN_PART_SIZE):
+        self.clock = clock
+        self.commands_file = commands_file
+        self.ota_file = ota_file
+        self.image_dir = image_dir
+
+        if s3_client is None:
+            print('Setting up AWS')
+            s3_client = boto3.client(
+                service_name='s3',
+                region_name=AWS_REGION,
+                aws_access_key_id=AWS_ACCESS_KEY,
+                aws_secret_access_key=AWS_SECRET_KEY
+            )
+        self.s3_client = s3_client
+        # Images and logs are uploaded in the background, the radio loop only queues them
+        self.uploads = UploadQueue(s3_client, upload_spool)
+        self.upload_part_size = upload_part_size
 
         # New contact from the satellite
         # Changes to True when heartbeat is received, false when image transfer starts
@@ -45,19 +83,25 @@ class GROUNDSTATION:
         self.cmd_queue_size = len(self.cmd_queue)
         # Commands issued by the groundstation
         self.gs_cmd = 0xFF
-        # Sequence counter for images
-        self.sequence_counter = 0
+        # Set once the target image is complete and saved, until SAT_DEL_IMG is sent
+        self.image_saved = False
         # References to the image we are requesting
         self.target_image_UID = 0
         self.target_sequence_count = 0
         # Image Info class
         self.sat_images = IMAGES()
-        self.image_array = []
+        # Target image being reassembled (image_store.PartialImage), its chunks
+        # are checkpointed to image_dir so a download carries on in the next pass
+        self.image = None
+        # Multipart upload (upload_queue.MultipartUpload) the start of the image is streamed to
+        self.image_upload = None
         # RX message info
         self.rx_message_ID = 0x0
         self.rx_message_sequence_count = 0
         self.rx_message_size = 0
         self.rx_req_ack = 0
+        self.rx_body = b''
+        self.rx_record = None
         # OTA Sequence Counter 
         self.ota_sequence_counter = 0
         # Satellite request acknowledgement
@@ -67,19 +111,34 @@ class GROUNDSTATION:
         # OTA satellite sequence counter
         self.ota_sat_sequence_counter = 0
         self.send_mod = 10
+        # Uplink frames are packed into this, one slot per frame of an OTA window
+        self.tx_frames = FrameBuffer(self.send_mod + 1)
         # Missed message
         self.missed_message = False
+        # Seconds to wait for the next packet before giving up on the satellite
+        # (None waits forever)
+        self.rx_timeout = rx_timeout
+        # Airtime used in the current pass, started by the first packet heard
+        self.pass_duration = pass_duration
+        self.airtime_budget = None
+        # Adaptive modem config and the config the satellite answered a GS_MODEM_REQ with
+        self.modem_controller = modem_controller
+        self.modem_response = None
 
         # Setup timestamp for timing packet arrival
-        self.start_time = time.time()
-        self.packet_time = 0
-        self.time_diff = 0
+        self.start_time = self.clock.time()
+        # Image packet timing for the current request window,
+        # taken from the interrupt timestamps in each packet
+        self.window_packets = 0
+        self.window_bytes = 0
+        self.window_start_ns = 0
+        self.window_end_ns = 0
 
         # Set up the GPIO pin as an output pin
-        self.rx_ctrl = LED(22)
-        self.tx_ctrl = LED(23)
+        self.rx_ctrl = LED(22) if rx_ctrl is None else rx_ctrl
+        self.tx_ctrl = LED(23) if tx_ctrl is None else tx_ctrl
 
-        self.influx = DATABASE()
+        self.influx = DATABASE() if influx is None else influx
 
         # Logging Information
         # Get the current time
@@ -95,46 +154,72 @@ class GROUNDSTATION:
 
         # Check command queue
         print("GS Command Queue: ", self.cmd_queue)
-        print(f'{time.time() - self.start_time}: Listening for UHF LoRa packets')
+        print(f'{self.clock.time() - self.start_time}: Listening for UHF LoRa packets')
         print()
 
     '''
         Name: received_message
-        Description: This function waits for a message to be received from the LoRa module
+        Description: This function takes received messages off the LoRa receive queue
         Inputs:
             lora - Declaration of lora class
+        Return:
+            True once the satellite requested a response, False if nothing
+            was heard within rx_timeout
     '''
     def receive_message(self,lora):
         # Pull GS RX pin HIGH!
         self.rx_ctrl.on()
-        global received_success 
         receive_multiple = 0
+        packets_received = 0
         while (receive_multiple == 0):
-            received_success = False
             lora.set_mode_rx()
 
-            while received_success == False:
-                time.sleep(0.1)
+            if packets_received == 0:
+                timeout = self.rx_timeout
+            else:
+                # Once the satellite is talking the rest of its window follows back to
+                # back, wait long enough for all of it in case packets were lost
+                timeout = lora.airtime.burst_timeout(max(self.send_mod - packets_received, 1))
+
+            # Blocks on the receive queue, the interrupt handler wakes us
+            # as soon as a packet has been read out of the FIFO
+            payload = lora.receive(timeout=timeout)
+
+            if payload is None:
+                if packets_received == 0:
+                    # Satellite is silent, let the caller decide what to do
+                    self.modem_link_lost(lora)
+                    self.rx_ctrl.off()
+                    return False
+                # Lost the packet requesting an acknowledgement,
+                # respond anyway so the exchange does not stall
+                print(f'{self.clock.time() - self.start_time}: RX timeout, ending receive window early')
+                self.missed_message = True
+                break
+
+            packets_received += 1
+            self.pass_budget(lora).charge_rx(len(payload.message) + 4)
+            if self.modem_controller is not None:
+                self.modem_controller.observe(payload, lora.airtime)
 
-            # print(lora._last_payload.message) 
             # print("From:", payload.header_from)
             # print("Received:", payload.message)
             # print("RSSI: {}; SNR: {}".format(payload.rssi, payload.snr))
             # print('')
-            self.unpack_message(lora)
+            self.unpack_message(payload)
             receive_multiple = self.rx_req_ack
 
+        self.update_modem_config(lora)
+
+        # Checkpoint the chunks of this window
+        if (self.image is not None):
+            self.image.flush()
+
         if ((self.reset_file_array == True) or (self.missed_message == True) or (lora.crc_error_count > 0)):
-            # If last command was an image, refetch last portion of image 
-            # to make sure it was received correctly
-            if ((self.gs_cmd == SAT_IMG_CMD) and (self.missed_message == True)):
-                high_sequence_count = self.sequence_counter
-                while ((self.sequence_counter > 0) and (self.sequence_counter > (high_sequence_count - self.send_mod))):
-                    self.sequence_counter -= 1
-                    self.image_array.pop(self.sequence_counter)
-            # If last command was an OTA, resend the last portion of the file 
-            # to make sure it was received correctly.
-            elif (self.gs_cmd == GS_OTA_REQ):
+            # Image chunks are tracked one by one, the next SAT_IMG_CMD asks for
+            # whatever did not arrive. If last command was an OTA, resend the
+            # last portion of the file to make sure it was received correctly.
+            if (self.gs_cmd == GS_OTA_REQ):
                 print(lora.crc_error_count)
                 if (self.ota_sequence_counter >= self.send_mod):
                     self.ota_sequence_counter -= self.send_mod
@@ -147,30 +232,42 @@ class GROUNDSTATION:
         # Turn GS RX pin LOW!
         self.rx_ctrl.off()
 
+        return True
+
     '''
         Name: unpack_message
         Description: This function unpacks a message based on its ID
         Inputs:
-            lora - Declaration of lora class
+            payload - LoRaPacket taken from the LoRa receive queue
     '''
-    def unpack_message(self,lora):
-        # Get the current time
-        current_time = datetime.datetime.now()
+    def unpack_message(self,payload):
+        # Time the packet was received by the radio
+        current_time = datetime.datetime.fromtimestamp(payload.rx_time_ns / 1e9)
         # Format the current time
-        formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S\n")
+        formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S.%f\n")
         formatted_time = formatted_time.encode('utf-8')
 
-        header_info = f"Header To: {lora._last_payload.header_to}, Header From: {lora._last_payload.header_from}, Header ID: {lora._last_payload.header_id}, Header Flags: {lora._last_payload.header_flags}, RSSI: {lora._last_payload.rssi}, SNR: {lora._last_payload.snr}\n"
+        header_info = f"Header To: {payload.header_to}, Header From: {payload.header_from}, Header ID: {payload.header_id}, Header Flags: {payload.header_flags}, RSSI: {payload.rssi}, SNR: {payload.snr}\n"
         header_info = header_info.encode('utf-8')
-        payload = f"Payload: {lora._last_payload.message}\n\n"
-        payload = payload.encode('utf-8')
+        payload_info = f"Payload: {payload.message}\n\n"
+        payload_info = payload_info.encode('utf-8')
         self.log.write(formatted_time)
         self.log.write(header_info)
-        self.log.write(payload)
+        self.log.write(payload_info)
 
         # Unpack header information - Received header, sequence count, and message size
-        self.rx_req_ack, self.rx_message_ID, self.rx_message_sequence_count, self.rx_message_size = gs_unpack_header(lora, self.influx)
-        self.influx.upload_last_received_packet(self.rx_req_ack, self.rx_message_ID, self.rx_message_sequence_count, self.rx_message_size)
+        received = gs_unpack_header(payload, self.influx)
+        if (received is None):
+            # Runt frame, keep listening for the rest of the window
+            self.rx_req_ack = 0
+            self.missed_message = True
+            return
+        self.rx_req_ack, self.rx_message_ID, self.rx_message_sequence_count, self.rx_message_size = received[:4]
+        # Body of the message (a view of payload.message) and its decoded fields
+        self.rx_body = received.body
+        self.rx_record = received.record
+        self.influx.upload_last_received_packet(self.rx_req_ack, self.rx_message_ID, self.rx_message_sequence_count, self.rx_message_size,
+                                                time_ns=payload.rx_time_ns)
 
         if ((self.rx_message_ID == SAT_HEARTBEAT_BATT) or (self.rx_message_ID == SAT_HEARTBEAT_SUN) or \
             (self.rx_message_ID == SAT_HEARTBEAT_IMU) or (self.rx_message_ID == SAT_HEARTBEAT_GPS)):
@@ -185,46 +282,60 @@ class GROUNDSTATION:
                 self.cmd_queue = self.get_commands()
 
         elif self.rx_message_ID == SAT_IMG_INFO:
-            self.image_info_unpack(lora)
+            self.image_info_unpack(payload)
         elif (self.rx_message_ID == SAT_IMG_CMD):
-            # Get current timestamp
-            time_this_packet = time.time() - self.time_diff
-            self.time_diff = time.time()
-            
-            self.packet_time += time_this_packet
-            
+            # Track packet timing for this window
+            if self.window_packets == 0:
+                self.window_start_ns = payload.rx_monotonic_ns
+            else:
+                self.window_bytes += self.rx_message_size
+            self.window_end_ns = payload.rx_monotonic_ns
+            self.window_packets += 1
+
             # Add timestamp to output
-            print(f'{time.time() - self.start_time}: Image Packet #{self.rx_message_sequence_count} received!')
+            print(f'{payload.rx_time_ns / 1e9 - self.start_time}: Image Packet #{self.rx_message_sequence_count} received!')
             # Unpack image command
-            self.image_unpack(lora)
-        elif (self.rx_message_ID == SAT_OTA_RES):
-            self.ota_sat_rec_success = lora._last_payload.message[4:5]
-            self.ota_sat_sequence_counter = lora._last_payload.message[5:7]
+            self.image_unpack(payload)
+        elif (self.rx_message_ID == SAT_OTA_RES) and (self.rx_record is not None):
+            self.ota_sat_rec_success = self.rx_record.success
+            self.ota_sat_sequence_counter = self.rx_record.sequence_count
             print(f'OTA Response: {self.ota_sat_rec_success}')
         elif (self.rx_message_ID == SAT_DEL_IMG):
-            print(f'{time.time() - self.start_time}: Image fully downlinked, SAT deleted image')
+            print(f'{self.clock.time() - self.start_time}: Image fully downlinked, SAT deleted image')
+            # The image is gone, the next SAT_IMG_INFO tells what is left
+            self.sat_images = IMAGES()
+            self.target_image_UID = 0
+            self.target_sequence_count = 0
+        elif (self.rx_message_ID == SAT_MODEM_RES) and (self.rx_record is not None):
+            self.modem_response = modem_config_from_bytes(self.rx_record.modem_config)
+            print(f'Modem config response: {self.modem_response}')
         else:
             print("Telemetry received!")
-            print("Lora header_to:",lora._last_payload.header_to)
-            print("Lora header_from:",lora._last_payload.header_from)
-            print("Lora header_id:",lora._last_payload.header_id)
-            print("Lora header_flags:",lora._last_payload.header_flags)
-            print("Message received header:",list(lora._last_payload.message[0:4]))
+            print("Lora header_to:",payload.header_to)
+            print("Lora header_from:",payload.header_from)
+            print("Lora header_id:",payload.header_id)
+            print("Lora header_flags:",payload.header_flags)
+            print("Message received header:",list(payload.message[0:4]))
     
     '''
         Name: image_info_unpack
         Description: This function unpacks the image information from
         satellite such as command IDs, UIDs, size (KB), and message counts
         Inputs
-            lora - lora - Declaration of lora class
+            payload - LoRaPacket taken from the LoRa receive queue
     '''
-    def image_info_unpack(self,lora):
-        self.sat_images = image_meta_info(lora)
+    def image_info_unpack(self,payload):
+        sat_images = image_meta_info(payload)
+        if (sat_images is None):
+            # Truncated, keep the current target rather than drop it
+            print("Image info too short, ignored")
+            return
+        self.sat_images = sat_images
         self.image_verification()
 
         # Diagnostic prints
         print("Image info received!")
-        print("Message received header:",list(lora._last_payload.message[0:4]))
+        print("Message received header:",list(payload.message[0:4]))
 
         if(self.sat_images.image_UID == 0x00):
             print("No images stored on satellite")
@@ -237,59 +348,88 @@ class GROUNDSTATION:
     '''
         Name: image_verification
         Description: Ensures the satellite did not delete any images since the last pass.
-                     Will reset the sequence counter if new image was loaded.
+                     Opens the new target if a different image was loaded.
     '''
     def image_verification(self):
-        if (self.target_image_UID != self.sat_images.image_UID):
-            self.sequence_counter = 0
-            self.image_array.clear()
+        if ((self.image is None) or
+                not self.image.matches(self.sat_images.image_UID, self.sat_images.image_size,
+                                       self.sat_images.image_message_count)):
+            self.open_image()
+
+    '''
+        Name: open_image
+        Description: Opens the reassembly buffer for the image in sat_images, preallocated
+                     for image_message_count chunks. Chunks received in an earlier pass (or
+                     before a restart) are picked up from image_dir. The size field of
+                     SAT_IMG_INFO is not needed, the last chunk tells the exact length.
+                     Starts the multipart upload the image is streamed to, named after
+                     the time the download started.
+    '''
+    def open_image(self):
+        if (self.image is not None):
+            # Keep what we have of the old target in case it is offered again
+            self.image.close()
+            self.image = None
+        if (self.image_upload is not None):
+            self.image_upload.cancel()
+            self.image_upload = None
+        self.image_saved = False
+        self.target_image_UID = self.sat_images.image_UID
+        self.target_sequence_count = self.sat_images.image_message_count
+
+        if (self.sat_images.image_UID != 0x00) and (self.sat_images.image_message_count > 0):
+            self.image = PartialImage.open(self.image_dir, self.sat_images.image_UID,
+                                           self.sat_images.image_size, self.sat_images.image_message_count)
+            if (self.image.resumed):
+                print(f'Resuming image {self.image.uid}: {self.image.received_count} of '
+                      f'{self.image.message_count} chunks already received')
+
+            formatted_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            self.image_upload = self.uploads.stream(AWS_S3_BUCKET_NAME, f"earth_image_{formatted_time}.jpg",
+                                                    self.upload_part_size)
+            self.stream_image()
+
+    '''
+        Name: stream_image
+        Description: Hands the part of the image received without gaps to the multipart
+                     upload, which uploads it in the background once it fills a whole part.
+    '''
+    def stream_image(self):
+        available = self.image.contiguous_length()
+        if (available - self.image_upload.offset >= self.image_upload.part_size):
+            image = self.image.data(available)
+            self.image_upload.update(image)
+            image.release()
 
     '''
         Name: image_unpack
         Description: This function unpacks the contents of the image and stores
         the image in a file when the complete image has been received.
         Inputs
-            lora - Declaration of lora class
+            payload - LoRaPacket taken from the LoRa receive queue
     '''
-    def image_unpack(self,lora):
-        self.image_array.append(lora._last_payload.message[4:self.rx_message_size + 4])
-
-        if (self.sequence_counter != self.rx_message_sequence_count):
-            self.missed_message = True
-
-        # Increment sequence counter
-        self.sequence_counter += 1
-        if self.sequence_counter >= self.target_sequence_count:
-            # Get the current time
-            current_time = datetime.datetime.now()
-
-            # Format the current time
-            formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
-
-            # Create image name
-            filename = f"earth_image_{formatted_time}.jpg"
-            refresh_file = f"latest_earth_image.jpg"
-
-            rec_bytes = open(filename,'wb')
-            more_bytes = open(refresh_file,'wb')
-            
-            for i in range(self.target_sequence_count):
-                rec_bytes.write(self.image_array[i])       
-                more_bytes.write(self.image_array[i])  
-
-            rec_bytes.close()
-            more_bytes.close()
-
-            response = self.s3_client.upload_file(filename, AWS_S3_BUCKET_NAME, filename)
-            print(f'upload_log_to_aws response: {response}')
-
-            response = self.s3_client.upload_file(refresh_file, AWS_PUBLIC_BUCKET, refresh_file)
-            print(f'upload_log_to_aws response: {response}')
-
-            self.image_array.clear()
-            os.remove(filename)
-            os.remove(refresh_file)
-            self.influx.upload_image_info(self.sat_images.image_UID, self.sat_images.image_size, self.sat_images.image_message_count)
+    def image_unpack(self,payload):
+        chunk = self.rx_body
+        if (self.image is None) or not self.image.store(self.rx_message_sequence_count, chunk):
+            # Not part of the target image, a chunk we already have or malformed
+            return
+        self.stream_image()
+
+        # The image is complete once none of its chunks are missing
+        if (self.image.complete()):
+            # The upload already holds every whole part, only the rest is left to send
+            image = self.image.data()
+            self.uploads.put(image, [(self.image_upload.bucket, self.image_upload.key),
+                                     (AWS_PUBLIC_BUCKET, "latest_earth_image.jpg")],
+                             stream=self.image_upload)
+            image.release()
+
+            self.image.remove()
+            self.image = None
+            self.image_upload = None
+            self.image_saved = True
+            self.influx.upload_image_info(self.sat_images.image_UID, self.sat_images.image_size, self.sat_images.image_message_count,
+                                          time_ns=payload.rx_time_ns)
 
     '''
         Name: transmit_message
@@ -301,51 +441,32 @@ class GROUNDSTATION:
         # Pull GS TX pin HIGH!
         self.tx_ctrl.on()
         send_multiple = True
+        # Give the satellite time to get back into RX after its last packet
+        turnaround_delay = lora.airtime.turnaround_delay()
+        # Switch to a faster or more robust modem config before the next command
+        modem_config = self.propose_modem_config(lora)
+        ota_window = []
+        ota_frame = 0
         while (send_multiple):
-            time.sleep(0.15)
+            self.clock.sleep(turnaround_delay)
 
-            if self.num_commands_sent < self.cmd_queue_size:
+            if modem_config is not None:
+                lora_tx_message = self.pack_modem_command(modem_config)
+                send_multiple = False
+            elif ota_frame < len(ota_window):
+                # Rest of the OTA window, until the frame requesting an ack has gone out
+                lora_tx_message = ota_window[ota_frame]
+                ota_frame += 1
+                send_multiple = ota_frame < len(ota_window)
+            elif self.num_commands_sent < self.cmd_queue_size:
                 self.gs_cmd = self.cmd_queue[self.num_commands_sent]
 
-                # OTA Update Sequence
+                # OTA Update Sequence, the whole window is packed before the first frame goes out
                 if (self.gs_cmd == GS_OTA_REQ):
-                    if (self.ota_sat_rec_success == 0):
-                        self.ota_sequence_counter = self.ota_sat_sequence_counter
-
-                    # If at the beginning of the OTA update sequence, 
-                    # fetch the file and store it in a buffer.
-                    if (self.ota_sequence_counter <= 0):
-                        self.OTA_get_info()
-                    target_sequence_count = self.ota_files.file_message_count
-
-                    # If 10 messages have not be sent and less than the target,
-                    # request no ack and stay in loop.
-                    if ((((self.ota_sequence_counter % self.send_mod) > 0) and (self.ota_sequence_counter < (target_sequence_count - 1))) or \
-                        (self.ota_sequence_counter == 0)):
-                        send_multiple = True
-                        self.gs_req_ack = 0x0
-                    # Otherwise, exit loop and request ack
-                    else:
-                        send_multiple = False
-                        self.gs_req_ack = REQ_ACK_NUM
-
-                    packets_remaining = (target_sequence_count - 1) - self.ota_sequence_counter
-                    packet_size = len(self.file_array[self.ota_sequence_counter]) + 2
-                    packet_size = packet_size.to_bytes(1,'big')
-                    # Transmit image in multiple packets
-                    # Header
-                    tx_header = ((self.gs_req_ack | GS_OTA_REQ).to_bytes(1,'big') + (self.ota_sequence_counter).to_bytes(2,'big') + packet_size)
-                    # Payload
-                    tx_payload = packets_remaining.to_bytes(2,'big') + self.file_array[self.ota_sequence_counter]
-                    # Pack entire message
-                    lora_tx_message = tx_header + tx_payload
-
-                    self.ota_sequence_counter += 1
-                    # If at the end of the file,
-                    # Exit OTA sequence and reset sequence counter
-                    if (self.ota_sequence_counter >= target_sequence_count):
-                        self.num_commands_sent += 1
-                        self.ota_sequence_counter = 0
+                    ota_window = self.pack_ota_window()
+                    lora_tx_message = ota_window[0]
+                    ota_frame = 1
+                    send_multiple = ota_frame < len(ota_window)
             
                 else:
                     lora_tx_message = self.pack_telemetry_command()
@@ -358,10 +479,11 @@ class GROUNDSTATION:
             # Retry sending the message twice if we don't get an acknowledgment from the recipient
         
             status = lora.send(lora_tx_message, 255)
+            self.pass_budget(lora).charge_tx(len(lora_tx_message) + 4)
 
             # Check for groundstation acknowledgement 
             if status is True:
-                print(time.time() - self.start_time, ": Ground station sent message: [", *[hex(num) for num in lora_tx_message], "]")
+                print(self.clock.time() - self.start_time, ": Ground station sent message: [", *[hex(num) for num in lora_tx_message], "]")
                 print()
             else:
                 print("No acknowledgment from recipient")
@@ -370,6 +492,10 @@ class GROUNDSTATION:
             while not lora.wait_packet_sent():
                 pass
 
+        # The satellite is back on its heartbeat config once the session ends
+        if (self.modem_controller is not None) and (self.gs_cmd == GS_STOP):
+            self.set_modem_config(lora, self.modem_controller.base)
+
         lora.crc_error_count = 0
 
         # Set GS TX pin LOW!
@@ -383,9 +509,7 @@ class GROUNDSTATION:
         print("Sending command: ",self.cmd_queue[self.num_commands_sent])
         # Payload to transmit
         # Simulated for now!
-        lora_tx_header = bytes([REQ_ACK_NUM | GS_ACK, 0x00, 0x01, 0x4])
-        lora_tx_payload = (self.rx_message_ID.to_bytes(1,'big') + self.gs_cmd.to_bytes(1,'big') + (0x0).to_bytes(2,'big'))
-        lora_tx_message = lora_tx_header + lora_tx_payload
+        lora_tx_message = self.pack_command()
         self.num_commands_sent += 1
 
         return lora_tx_message
@@ -399,55 +523,226 @@ class GROUNDSTATION:
         # Simulated for now!
 
         if (self.new_session == True):
-            self.time_diff = time.time()
-            
             self.gs_cmd = SAT_IMG_INFO
-            lora_tx_header = bytes([REQ_ACK_NUM | GS_ACK, 0x00, 0x01, 0x4])
-            lora_tx_payload = (self.rx_message_ID.to_bytes(1,'big') + self.gs_cmd.to_bytes(1,'big') + (0x0).to_bytes(2,'big'))
-            lora_tx_message = lora_tx_header + lora_tx_payload
+            lora_tx_message = self.pack_command()
             # Session is no longer "new" after telemetry has been retrieved
             self.new_session = False
 
         elif (self.gs_cmd == SAT_DEL_IMG):
             # Downlinked an image, request to kill comms sequence
             self.gs_cmd = GS_STOP
-            lora_tx_header = bytes([REQ_ACK_NUM | GS_ACK, 0x00, 0x01, 0x4])
-            lora_tx_payload = (self.rx_message_ID.to_bytes(1,'big') + self.gs_cmd.to_bytes(1,'big') + (0x0).to_bytes(2,'big'))
-            lora_tx_message = lora_tx_header + lora_tx_payload
+            lora_tx_message = self.pack_command()
 
-        elif ((self.sequence_counter >= self.target_sequence_count) and (self.target_sequence_count != 0)):
+        elif (self.image_saved):
+            # Only an image received in full is deleted on the satellite
             self.gs_cmd = SAT_DEL_IMG
-            lora_tx_header = bytes([REQ_ACK_NUM | GS_ACK, 0x00, 0x01, 0x4])
-            lora_tx_payload = (self.rx_message_ID.to_bytes(1,'big') + self.gs_cmd.to_bytes(1,'big') + (0x0).to_bytes(2,'big'))
-            lora_tx_message = lora_tx_header + lora_tx_payload
-            # Reset sequence counter and get new image
-            self.sequence_counter = 0
+            lora_tx_message = self.pack_command()
+            self.image_saved = False
 
         else:
             # Check image UID to see if SAT has a stored image or not 
             if(self.sat_images.image_UID == 0x00):
                 # No image on satellite, request to kill comms sequence
                 self.gs_cmd = GS_STOP
-                lora_tx_header = bytes([REQ_ACK_NUM | GS_ACK, 0x00, 0x01, 0x4])
-                lora_tx_payload = (self.rx_message_ID.to_bytes(1,'big') + self.gs_cmd.to_bytes(1,'big') + (0x0).to_bytes(2,'big'))
-                lora_tx_message = lora_tx_header + lora_tx_payload
+                lora_tx_message = self.pack_command()
 
             else:
-                self.target_image_UID = self.sat_images.image_UID
-                self.target_sequence_count = self.sat_images.image_message_count       
-                self.gs_cmd = SAT_IMG_CMD
+                if (self.image is None):
+                    self.open_image()
+                wanted = [] if (self.image is None) else self.missing_chunks()
+
+                if not wanted:
+                    # Nothing left to ask for, request to kill comms sequence
+                    self.gs_cmd = GS_STOP
+                    lora_tx_message = self.pack_command()
+
+                else:
+                    self.gs_cmd = SAT_IMG_CMD
+                    # Output packet timing between last two acknowledgements
+                    self.print_window_stats()
 
-                # Output average packet time between last two acknowledgements
-                sat_send_mod = 10 
-                print(f'Avg. transmission time: {self.packet_time / sat_send_mod}')
-                self.packet_time = 0
+                    # Ask for the next send_mod missing chunks. Without gaps that is a
+                    # plain window from the first one, otherwise a bitmap of the ones wanted.
+                    first, bitmap = pack_chunk_bitmap(wanted)
+                    if (wanted == list(range(first, min(first + self.send_mod, self.target_sequence_count)))):
+                        bitmap = b''
 
-                lora_tx_header = bytes([REQ_ACK_NUM | GS_ACK, 0x00, 0x00, 0x4])
-                lora_tx_payload = (self.rx_message_ID.to_bytes(1,'big') + self.gs_cmd.to_bytes(1,'big') + self.sequence_counter.to_bytes(2,'big'))
-                lora_tx_message = lora_tx_header + lora_tx_payload
+                    lora_tx_message = self.pack_command(first, sequence_count=0x0000, bitmap=bitmap)
 
         return lora_tx_message
 
+    '''
+        Name: pack_command
+        Description: Packs a GS_ACK carrying gs_cmd into the first frame slot
+        Inputs:
+            argument - command argument, the first chunk wanted for SAT_IMG_CMD
+            sequence_count - header sequence count
+            bitmap - missing-chunk bitmap following a SAT_IMG_CMD
+    '''
+    def pack_command(self, argument=0x0, sequence_count=0x0001, bitmap=b''):
+        return self.tx_frames.pack(0, GS_ACK, (self.rx_message_ID, self.gs_cmd, argument),
+                                   REQ_ACK_NUM, sequence_count, bitmap)
+
+    '''
+        Name: pack_ota_window
+        Description: Packs the OTA frames up to and including the next one requesting an
+                     acknowledgement (every send_mod frames and the last one of the file)
+                     into the frame slots and returns them in sending order
+    '''
+    def pack_ota_window(self):
+        if (self.ota_sat_rec_success == 0):
+            # Go back to the first chunk the satellite is missing, once
+            self.ota_sequence_counter = self.ota_sat_sequence_counter
+            self.ota_sat_rec_success = 1
+
+        # If at the beginning of the OTA update sequence, 
+        # fetch the file and store it in a buffer.
+        if (self.ota_sequence_counter <= 0):
+            self.OTA_get_info()
+        target_sequence_count = self.ota_files.file_message_count
+
+        frames = []
+        while True:
+            # If 10 messages have not be sent and less than the target,
+            # request no ack and carry on with the window.
+            if ((((self.ota_sequence_counter % self.send_mod) > 0) and (self.ota_sequence_counter < (target_sequence_count - 1))) or \
+                (self.ota_sequence_counter == 0)):
+                self.gs_req_ack = 0x0
+            # Otherwise, request ack and end the window
+            else:
+                self.gs_req_ack = REQ_ACK_NUM
+
+            packets_remaining = (target_sequence_count - 1) - self.ota_sequence_counter
+            frames.append(self.tx_frames.pack(len(frames), GS_OTA_REQ, (packets_remaining,), self.gs_req_ack,
+                                              self.ota_sequence_counter, self.file_array[self.ota_sequence_counter]))
+
+            self.ota_sequence_counter += 1
+            # If at the end of the file,
+            # Exit OTA sequence and reset sequence counter
+            if (self.ota_sequence_counter >= target_sequence_count):
+                self.num_commands_sent += 1
+                self.ota_sequence_counter = 0
+                return frames
+            if (self.gs_req_ack == REQ_ACK_NUM):
+                return frames
+
+    '''
+        Name: missing_chunks
+        Description: Sequence counts of the first send_mod chunks of the target image not
+                     received yet, no further apart than one SAT_IMG_CMD bitmap can cover
+    '''
+    def missing_chunks(self):
+        return self.image.missing(self.send_mod, MAX_CHUNK_BITMAP * 8)
+
+    '''
+        Name: propose_modem_config
+        Description: Asks the modem controller whether to change modem config, returns the
+                     ModemConfig to request from the satellite or None
+        Inputs:
+            lora - Declaration of lora class
+    '''
+    def propose_modem_config(self, lora):
+        # Heartbeats are answered at the config they came in with
+        if (self.modem_controller is None) or (self.new_session == True):
+            return None
+
+        modem_config = self.modem_controller.propose(lora.profile.modem_config)
+        if modem_config is not None:
+            self.modem_controller.requested(modem_config)
+            self.modem_response = None
+        return modem_config
+
+    '''
+        Name: pack_modem_command
+        Description: Packs a GS_MODEM_REQ asking the satellite to switch to a modem config
+    '''
+    def pack_modem_command(self, modem_config):
+        print("Requesting modem config:", modem_config.name)
+        return self.tx_frames.pack(0, GS_MODEM_REQ, (modem_config_bytes(modem_config),), REQ_ACK_NUM)
+
+    '''
+        Name: update_modem_config
+        Description: Feeds the losses of the last receive window to the modem controller and
+                     switches config once the satellite has confirmed a GS_MODEM_REQ
+        Inputs:
+            lora - Declaration of lora class
+    '''
+    def update_modem_config(self, lora):
+        controller = self.modem_controller
+        if controller is None:
+            return
+
+        controller.observe_losses(lora.crc_error_count + (1 if self.missed_message else 0))
+        if controller.pending is not None:
+            if self.modem_response == controller.pending:
+                previous = lora.profile.modem_config
+                self.set_modem_config(lora, controller.pending)
+                controller.confirmed(previous)
+            else:
+                controller.failed()
+
+    '''
+        Name: modem_link_lost
+        Description: Satellite went quiet, go back to the base modem config it heartbeats with
+        Inputs:
+            lora - Declaration of lora class
+    '''
+    def modem_link_lost(self, lora):
+        controller = self.modem_controller
+        if controller is None:
+            return
+
+        if controller.pending is not None:
+            controller.failed()
+        controller.reset()
+        self.set_modem_config(lora, controller.base)
+
+    '''
+        Name: set_modem_config
+        Description: Switches the LoRa module to another modem config, keeping the rest of its profile
+        Inputs:
+            lora - Declaration of lora class
+            modem_config - ModemConfig to use
+    '''
+    def set_modem_config(self, lora, modem_config):
+        if (lora.profile.modem_config != modem_config):
+            print(f'{self.clock.time() - self.start_time}: Switching modem config to {modem_config.name}')
+            lora.apply_profile(lora.profile.replace(modem_config=modem_config))
+
+    '''
+        Name: pass_budget
+        Description: Returns the airtime budget of the current pass, starting a new
+                     one once the last pass_duration has run out
+        Inputs:
+            lora - Declaration of lora class
+    '''
+    def pass_budget(self, lora):
+        if (self.airtime_budget is None) or self.airtime_budget.expired():
+            self.airtime_budget = AirtimeBudget(lora.airtime, self.pass_duration, self.clock)
+        # Follow modem config changes within the pass
+        self.airtime_budget.airtime = lora.airtime
+        return self.airtime_budget
+
+    '''
+        Name: print_window_stats
+        Description: Prints the average time between image packets and the image
+                     throughput for the last request window, then resets the window.
+                     Also prints the airtime used so far in the pass.
+    '''
+    def print_window_stats(self):
+        if (self.window_packets > 1):
+            window_time = (self.window_end_ns - self.window_start_ns) / 1e9
+            print(f'Avg. transmission time: {window_time / (self.window_packets - 1)}')
+            if (window_time > 0):
+                print(f'Image throughput: {self.window_bytes / window_time} B/s')
+        if (self.airtime_budget is not None):
+            budget = self.airtime_budget
+            print(f'Pass airtime: TX {budget.tx_time:.2f} s, RX {budget.rx_time:.2f} s, '
+                  f'{budget.remaining():.0f} s of the pass left')
+
+        self.window_packets = 0
+        self.window_bytes = 0
+
     '''
         Name: OTA_get_info
         Description: Read OTA file from memory and store in a buffer.
@@ -461,7 +756,7 @@ class GROUNDSTATION:
 
         ## ---------- File Size and Message Counts ---------- ## 
         # Get file size and message count
-        file_stat = os.stat('tinyimage.jpg')
+        file_stat = os.stat(self.ota_file)
         self.ota_files.file_size = int(file_stat[6])
         self.ota_files.file_message_count = int(self.ota_files.file_size / 196)
 
@@ -490,7 +785,7 @@ class GROUNDSTATION:
         
         # Image #Buffer Store
         bytes_remaining = self.ota_files.file_size
-        send_bytes = open('tinyimage.jpg','rb')
+        send_bytes = open(self.ota_file,'rb')
         # Loop through image and store contents in an array
         while (bytes_remaining > 0):
             if (bytes_remaining >= 196):
@@ -508,7 +803,7 @@ class GROUNDSTATION:
     '''
     def get_commands(self):
         # Open the file in read mode
-        with open('groundstation_commands.txt', 'r') as file:
+        with open(self.commands_file, 'r') as file:
             # Read all lines from the file
             lines = file.readlines()
 
@@ -527,23 +822,36 @@ class GROUNDSTATION:
 
         return items
 
-    def close_log(self):
+    '''
+        Name: close_log
+        Description: Closes the log and queues it for upload, then gives the background
+                     uploads up to upload_timeout seconds to finish. The radio loop has
+                     stopped by now, anything left is uploaded after the next start.
+        Inputs:
+            upload_timeout - seconds to wait for pending uploads
+    '''
+    def close_log(self, upload_timeout=5.0):
         self.log.close()
+        if (self.image is not None):
+            self.image.close()
+        if (self.image_upload is not None):
+            # The image is finished in a later pass, from where it was checkpointed
+            self.image_upload.cancel()
 
-        response = self.s3_client.upload_file(self.log_name, AWS_S3_BUCKET_NAME, self.log_name)
-        print(f'upload_log_to_aws response: {response}')
-        time.sleep(1)
+        self.uploads.put_file(self.log_name, [(AWS_S3_BUCKET_NAME, self.log_name)])
         os.remove(self.log_name)
+        self.uploads.close(upload_timeout)
 
 '''
     Name: on_recv
     Description: Callback function that runs when a message is received.
+                 Runs on the interrupt thread after the packet has been queued,
+                 GROUNDSTATION.receive_message is woken by the queue itself.
     Inputs: 
         payload - message that was received
 '''
 def on_recv(payload):
-    global received_success 
-    received_success = True
+    pass
 
 '''
     Name: hard_exit
@@ -1,11 +1,18 @@
 from argus_lora import LoRa, ModemConfig
+from adaptive_modem import ModemController
 from protocol_database import *
 from GS_helpers import *
 import time
 import signal
 import sys
 
-GS = GROUNDSTATION()
+# Passes start on Bw125Cr45Sf128, the satellite's heartbeat config. With
+# --adaptive-modem they move to a faster or more robust config as the link SNR
+# allows. Off by default: the flight software does not answer GS_MODEM_REQ yet
+# and every unanswered request costs an RX timeout.
+ADAPTIVE_MODEM = '--adaptive-modem' in sys.argv[1:]
+modem_controller = ModemController(base=ModemConfig.Bw125Cr45Sf128) if ADAPTIVE_MODEM else None
+GS = GROUNDSTATION(modem_controller=modem_controller)
 
 ## ---------- MAIN CODE STARTS HERE! ---------- ##
 # LoRa module setup
@@ -18,8 +25,9 @@ lora.on_recv = on_recv
 signal.signal(signal.SIGINT, lambda signum, frame: hard_exit(lora, GS, signum, frame))
 
 while True:
-    GS.receive_message(lora)
-    GS.transmit_message(lora) # RX only mode for testing
+    # Keep listening until the satellite asks for a response
+    if GS.receive_message(lora):
+        GS.transmit_message(lora) # RX only mode for testing
 
 GS.close_log()
 lora.close()
\ No newline at end of file
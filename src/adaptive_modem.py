@@ -0,0 +1,190 @@
+"""
+'adaptive_modem.py'
+===================
+Adaptive data rate for the ground station. A ModemController watches the
+SNR, RSSI and losses of the packets received from the satellite and picks
+the fastest modem config the link can sustain, so the high elevation part
+of a pass runs at a higher bitrate than the horizons.
+
+Switching is negotiated with the satellite at the current config:
+
+    GS  -> SAT   GS_MODEM_REQ  | REQ_ACK   MODEM_CONFIG1, 2, 3 wanted
+    SAT -> GS    SAT_MODEM_RES | REQ_ACK   MODEM_CONFIG1, 2, 3 it will use
+
+The satellite changes config once its response has been sent and the
+ground station once it has received it. When the link goes quiet both ends
+go back to the base config the satellite sends its heartbeats with.
+"""
+
+from collections import deque
+import math
+
+from airtime import Airtime, noise_floor
+from argus_lora import ModemConfig
+
+_BY_REGISTERS = {modem_config.value: modem_config for modem_config in ModemConfig}
+
+
+def modem_config_bytes(modem_config):
+    """The three MODEM_CONFIG register values sent for a ModemConfig"""
+    return bytes(modem_config.value)
+
+
+def modem_config_from_bytes(data):
+    """ModemConfig with the three register values in `data`, None if there is none"""
+    return _BY_REGISTERS.get(tuple(data[:3]))
+
+
+class ModemController(object):
+    """Picks the modem config for the rest of a pass from the link quality
+    seen by the ground station.
+
+    Each received packet adds its SNR to a rolling window of `window`
+    packets. Above 0 dB, where the SNR estimate saturates, the SNR implied
+    by the packet RSSI over the noise floor is used if it is higher. The
+    margin above the demodulation floor of every config in `ladder` is
+    predicted from the window, allowing for the change in noise bandwidth.
+
+    - Moving up: once `min_packets` have been seen and no more than
+      `up_loss` of them were lost, the fastest faster config whose
+      predicted margin, from the weakest packet, is at least `up_margin` dB
+      is proposed.
+    - Moving down: when more than `max_loss` of the packets in the window
+      were lost or failed the CRC, the fastest slower config with
+      `up_margin` to spare (or the most robust one) is proposed. When only
+      the average margin has fallen below `down_margin` dB, configs more
+      than `max_slowdown` times slower are not considered.
+
+    The default ladder is every ModemConfig except those that would need
+    LowDataRateOptimize and do not set it.
+
+    A negotiation the satellite does not confirm backs off for `backoff`
+    exchanges, doubling each time. After `max_failures` failures in a row
+    the satellite is taken not to support switching and nothing more is
+    proposed.
+    """
+
+    def __init__(self, base=ModemConfig.Bw125Cr45Sf128, ladder=None, window=16, min_packets=8,
+                 up_margin=6.0, down_margin=2.0, up_loss=0.1, max_loss=0.5, max_slowdown=4,
+                 backoff=4, max_failures=3):
+        self.base = base
+        self.min_packets = min_packets
+        self.up_margin = up_margin
+        self.down_margin = down_margin
+        self.up_loss = up_loss
+        self.max_loss = max_loss
+        self.max_slowdown = max_slowdown
+        self.backoff = backoff
+        self.max_failures = max_failures
+
+        # Configs to choose from, slowest (most robust) first
+        if ladder is None:
+            ladder = [modem_config for modem_config in ModemConfig
+                      if not Airtime(modem_config).ldro_required() or Airtime(modem_config).ldro]
+        self._airtime = {modem_config: Airtime(modem_config) for modem_config in ladder}
+        self._airtime.setdefault(base, Airtime(base))
+        self.ladder = sorted(self._airtime, key=lambda modem_config: self._airtime[modem_config].bitrate())
+
+        # Rolling link quality at the current config
+        self._snr = deque(maxlen=window)
+        self._rssi = deque(maxlen=window)
+        self._lost = deque(maxlen=window)    # 1 for each lost or corrupted packet, 0 for each good one
+
+        # Config asked for and waiting for the satellite's answer
+        self.pending = None
+        self.enabled = True
+        self.failures = 0
+        self._holdoff = 0
+
+        # Statistics
+        self.negotiations = 0
+        self.switches = []      # (from, to) for every confirmed switch
+
+    def observe(self, packet, airtime):
+        """Add a packet received with the modem setup in `airtime`"""
+        snr = packet.snr
+        if snr > 0:
+            snr = max(snr, packet.rssi - noise_floor(airtime.bandwidth))
+        self._snr.append(snr)
+        self._rssi.append(packet.rssi)
+        self._lost.append(0)
+
+    def observe_losses(self, count):
+        """Count packets that were lost or failed the CRC"""
+        self._lost.extend((1,) * min(count, self._lost.maxlen))
+
+    def link_quality(self):
+        """Mean SNR, mean RSSI and loss ratio over the window, None while empty"""
+        if not self._snr:
+            return None
+        return (sum(self._snr) / len(self._snr), sum(self._rssi) / len(self._rssi),
+                sum(self._lost) / len(self._lost))
+
+    def margin(self, modem_config, current, snr):
+        """Predicted dB above the demodulation floor of `modem_config` for a
+        packet received at `snr` with the `current` config"""
+        target, now = self._airtime[modem_config], self._airtime[current]
+        return snr + 10 * math.log10(now.bandwidth / target.bandwidth) - target.snr_limit
+
+    def propose(self, current):
+        """Config to switch to from `current`, None to stay"""
+        if not self.enabled or self.pending is not None or len(self._snr) < self.min_packets:
+            return None
+        if self._holdoff > 0:
+            self._holdoff -= 1
+            return None
+
+        if current not in self._airtime:
+            self._airtime[current] = Airtime(current)
+        bitrate = self._airtime[current].bitrate()
+        mean_snr, _, loss = self.link_quality()
+        worst_snr = min(self._snr)
+
+        if loss > self.max_loss or self.margin(current, current, mean_snr) < self.down_margin:
+            slowest = 0 if loss > self.max_loss else bitrate / self.max_slowdown
+            slower = [modem_config for modem_config in self.ladder
+                      if slowest <= self._airtime[modem_config].bitrate() < bitrate]
+            if not slower:
+                return None
+            usable = [modem_config for modem_config in slower
+                      if self.margin(modem_config, current, mean_snr) >= self.up_margin]
+            return usable[-1] if usable else slower[0]
+
+        if loss <= self.up_loss:
+            usable = [modem_config for modem_config in self.ladder
+                      if self._airtime[modem_config].bitrate() > bitrate and
+                      self.margin(modem_config, current, worst_snr) >= self.up_margin]
+            if usable:
+                return usable[-1]
+
+        return None
+
+    def requested(self, modem_config):
+        """A GS_MODEM_REQ for `modem_config` was sent"""
+        self.pending = modem_config
+        self.negotiations += 1
+
+    def confirmed(self, previous):
+        """The satellite accepted the pending config, switched from `previous`"""
+        self.switches.append((previous, self.pending))
+        self.pending = None
+        self.failures = 0
+        self._clear()
+
+    def failed(self):
+        """The pending config was refused or not answered"""
+        self.pending = None
+        self.failures += 1
+        self._holdoff = self.backoff << (self.failures - 1)
+        if self.failures >= self.max_failures:
+            self.enabled = False
+
+    def reset(self):
+        """Link lost, both ends are back on the base config"""
+        self.pending = None
+        self._clear()
+
+    def _clear(self):
+        self._snr.clear()
+        self._rssi.clear()
+        self._lost.clear()
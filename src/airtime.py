@@ -0,0 +1,183 @@
+"""
+'airtime.py'
+============
+Time-on-air model for the SX127x LoRa modem (SX1276 datasheet section
+4.1.1.7) and the waits and timeouts derived from it.
+
+    airtime = Airtime(ModemConfig.Bw125Cr45Sf128)
+    airtime.time_on_air(255)        # seconds for a full FIFO
+    airtime.tx_timeout(255)         # how long to wait for TxDone
+    airtime.ack_timeout(5)          # how long to wait for an ACK
+
+Every timeout is a number of symbols plus a fixed guard for the host, so
+it scales with the modem config: at SF12/125 kHz a symbol is 32.8 ms, at
+SF7/500 kHz it is 0.26 ms.
+
+AirtimeBudget keeps track of how much of a pass has gone on transmitting
+and receiving and how much time is left in it.
+"""
+
+import math
+import time
+
+from constants import (FIFO_SIZE, PREAMBLE_LENGTH, PREAMBLE_DETECT_SYMBOLS, GUARD_SYMBOLS,
+                       TIMING_GUARD, PEER_TURNAROUND)
+
+# Bandwidth in Hz for each value of the RegModemConfig1 bandwidth field
+BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+
+# Symbols longer than this need LowDataRateOptimize (datasheet section 4.1.1.6)
+LDRO_SYMBOL_TIME = 0.016
+
+# Lowest SNR (dB) each spreading factor can demodulate, SX1276 datasheet table 13
+SNR_LIMITS = {6: -5.0, 7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+
+# Receiver noise figure (dB) on top of thermal noise
+NOISE_FIGURE = 6
+
+
+def symbol_time(sf, bandwidth):
+    """Seconds per symbol for spreading factor `sf` and `bandwidth` in Hz."""
+    return (1 << sf) / bandwidth
+
+
+def noise_floor(bandwidth):
+    """Receiver noise power in dBm over `bandwidth` Hz: thermal noise
+    (-174 dBm/Hz) plus the noise figure."""
+    return -174 + 10 * math.log10(bandwidth) + NOISE_FIGURE
+
+
+def lora_time_on_air(length, sf, bandwidth, cr, preamble=PREAMBLE_LENGTH, crc=True,
+                     implicit_header=False, ldro=False):
+    """Seconds to transmit `length` bytes (RadioHead header included).
+    `cr` is the RegModemConfig1 coding rate field, 1 (4/5) to 4 (4/8)."""
+    t_sym = symbol_time(sf, bandwidth)
+    payload_symbols = 8 + max(math.ceil((8 * length - 4 * sf + 28 + 16 * crc - 20 * implicit_header) /
+                                        (4 * (sf - 2 * ldro))) * (cr + 4), 0)
+    return (preamble + 4.25) * t_sym + payload_symbols * t_sym
+
+
+class Airtime(object):
+    """Timing of one modem setup. `modem_config` is a ModemConfig or its
+    (MODEM_CONFIG1, MODEM_CONFIG2, MODEM_CONFIG3) register values.
+
+    Time-on-air is tabulated for every packet length when the object is
+    created, so looking it up per packet costs nothing."""
+
+    def __init__(self, modem_config, preamble=PREAMBLE_LENGTH, crc=True):
+        config1, config2, config3 = getattr(modem_config, "value", modem_config)
+        self.modem_config = modem_config
+        self.sf = min(max(config2 >> 4, 6), 12)
+        self.bandwidth = BANDWIDTHS[min(config1 >> 4, len(BANDWIDTHS) - 1)]
+        self.cr = (config1 >> 1) & 0x07
+        self.implicit_header = bool(config1 & 0x01)
+        self.ldro = bool((config3 >> 3) & 0x01)
+        self.preamble = preamble
+        self.crc = crc
+
+        self.t_sym = symbol_time(self.sf, self.bandwidth)
+        self.snr_limit = SNR_LIMITS[self.sf]
+        self._table = tuple(lora_time_on_air(length, self.sf, self.bandwidth, self.cr, preamble, crc,
+                                             self.implicit_header, self.ldro)
+                            for length in range(FIFO_SIZE + 1))
+
+    def symbol_time(self):
+        return self.t_sym
+
+    def time_on_air(self, length):
+        """Seconds to transmit a `length` byte packet (header included)"""
+        return self._table[length]
+
+    def bitrate(self):
+        """Raw payload bit rate in bits/s"""
+        return self.sf * self.bandwidth / (1 << self.sf) * 4 / (4 + self.cr)
+
+    def ldro_required(self):
+        """True if the symbol time is long enough to need LowDataRateOptimize"""
+        return self.t_sym > LDRO_SYMBOL_TIME
+
+    def tx_timeout(self, length):
+        """How long to wait for TxDone after starting to send `length` bytes"""
+        return self._table[length] + GUARD_SYMBOLS * self.t_sym + TIMING_GUARD
+
+    def ack_timeout(self, ack_length, turnaround=PEER_TURNAROUND):
+        """How long to wait, from our TxDone, for an `ack_length` byte reply
+        from a peer that takes `turnaround` seconds to answer"""
+        return turnaround + self._table[ack_length] + GUARD_SYMBOLS * self.t_sym + TIMING_GUARD
+
+    def burst_timeout(self, packets=1, length=FIFO_SIZE, turnaround=PEER_TURNAROUND):
+        """How long to wait for the next packet of a burst the peer is
+        sending back to back, with up to `packets` packets of at most
+        `length` bytes still to come (the ones in between may be lost)"""
+        return turnaround + packets * self._table[length] + GUARD_SYMBOLS * self.t_sym + TIMING_GUARD
+
+    def turnaround_delay(self, turnaround=PEER_TURNAROUND):
+        """How long to wait before answering a peer that needs `turnaround`
+        seconds to get back into RX. The receiver only has to be listening
+        before the preamble runs out, so slow modem configs need no delay."""
+        return max(turnaround - (self.preamble - PREAMBLE_DETECT_SYMBOLS) * self.t_sym, 0.0)
+
+    def exchange_time(self, request_length, responses, response_length=FIFO_SIZE,
+                      turnaround=PEER_TURNAROUND):
+        """Seconds for one request followed by `responses` packets of
+        `response_length` bytes sent back to back"""
+        return (self.turnaround_delay(turnaround) + self._table[request_length] + turnaround +
+                responses * self._table[response_length])
+
+
+class AirtimeBudget(object):
+    """Airtime used during one pass of `duration` seconds, starting now on
+    `clock` (the time module or a VirtualClock).
+
+    `max_duty_cycle` caps the share of the pass spent transmitting,
+    `tx_allowed` says whether one more packet still fits under it."""
+
+    def __init__(self, airtime, duration, clock=time, max_duty_cycle=1.0):
+        self.airtime = airtime
+        self.duration = duration
+        self.clock = clock
+        self.max_duty_cycle = max_duty_cycle
+        self.start = clock.monotonic()
+
+        self.tx_time = 0.0
+        self.rx_time = 0.0
+        self.tx_packets = 0
+        self.rx_packets = 0
+
+    def elapsed(self):
+        return self.clock.monotonic() - self.start
+
+    def remaining(self):
+        """Seconds left in the pass"""
+        return max(self.duration - self.elapsed(), 0.0)
+
+    def expired(self):
+        return self.elapsed() >= self.duration
+
+    def charge_tx(self, length):
+        self.tx_time += self.airtime.time_on_air(length)
+        self.tx_packets += 1
+
+    def charge_rx(self, length):
+        self.rx_time += self.airtime.time_on_air(length)
+        self.rx_packets += 1
+
+    def tx_allowed(self, length):
+        return self.tx_time + self.airtime.time_on_air(length) <= self.max_duty_cycle * self.duration
+
+    def exchanges_remaining(self, request_length, responses, response_length=FIFO_SIZE,
+                            turnaround=PEER_TURNAROUND):
+        """How many more request/response exchanges fit in the pass"""
+        return int(self.remaining() // self.airtime.exchange_time(request_length, responses,
+                                                                  response_length, turnaround))
+
+    def utilisation(self):
+        """Share of the elapsed pass the channel was busy with our traffic"""
+        elapsed = self.elapsed()
+        return (self.tx_time + self.rx_time) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return {"elapsed": self.elapsed(), "remaining": self.remaining(),
+                "tx_time": self.tx_time, "rx_time": self.rx_time,
+                "tx_packets": self.tx_packets, "rx_packets": self.rx_packets,
+                "utilisation": self.utilisation()}
@@ -1,13 +1,21 @@
 import time
+import threading
 from enum import Enum
 import math
-from collections import namedtuple
 from random import random
 
-from gpiozero import Button
-import spidev
+try:
+    from gpiozero import Button
+    import spidev
+except ImportError:
+    # Hardware libraries are only needed when no `spi`/`irq` backend
+    # (e.g. sx127x_emulator) is passed to LoRa
+    Button = None
+    spidev = None
 
 from constants import *
+from airtime import Airtime
+from lora_packet import LoRaPacket, PacketQueue
 
 
 class ModemConfig(Enum):
@@ -17,10 +25,81 @@ class ModemConfig(Enum):
     Bw125Cr48Sf4096 = (0x78, 0xc4, 0x0c)
 
 
+# 1 for every register address held in the shadow copy
+_SHADOWED = bytearray(0x80)
+for _register in SHADOW_REGISTERS:
+    _SHADOWED[_register] = 1
+
+
+class ModemProfile(object):
+    """Everything needed to set the radio up for a pass: modem config, frequency,
+    output power and preamble. The register image is compiled once, when the
+    profile is created, into a few bursts of contiguous registers so that
+    `LoRa.apply_profile` can switch profiles with a handful of SPI writes.
+    `airtime` holds the matching time-on-air table and timeouts.
+
+    tx_power=None keeps the fixed maximum output (PA_CONFIG 0xFF) the
+    ground station has always used.
+    """
+
+    def __init__(self, modem_config=ModemConfig.Bw125Cr45Sf128, freq=915, tx_power=None,
+                 preamble=PREAMBLE_LENGTH, crc=True):
+        self.modem_config = modem_config
+        self.freq = freq
+        self.tx_power = tx_power
+        self.preamble = preamble
+        self.crc = crc
+
+        self.bursts = self._compile()
+        self.airtime = Airtime(modem_config, preamble, crc)
+
+    def _compile(self):
+        config1, config2, config3 = self.modem_config.value
+        if self.crc:
+            config2 |= 0x04
+        else:
+            config2 &= 0xFB
+
+        frf = int((self.freq * 1000000.0) / FSTEP)
+
+        if self.tx_power is None:
+            pa_config = 0xFF
+            pa_dac = PA_DAC_DISABLE
+        else:
+            tx_power = min(max(self.tx_power, 5), 23)
+            # Above 20 dBm the PA DAC adds 3 dB on top of PA_BOOST
+            if tx_power > 20:
+                pa_dac = PA_DAC_ENABLE
+                tx_power -= 3
+            else:
+                pa_dac = PA_DAC_DISABLE
+            pa_config = PA_SELECT | (tx_power - 5)
+
+        return (
+            # FRF_MSB, FRF_MID, FRF_LSB, PA_CONFIG
+            (REG_06_FRF_MSB, bytes(((frf >> 16) & 0xff, (frf >> 8) & 0xff, frf & 0xff, pa_config))),
+            # FIFO_TX_BASE_ADDR, FIFO_RX_BASE_ADDR
+            (REG_0E_FIFO_TX_BASE_ADDR, bytes((0, 0))),
+            # MODEM_CONFIG1, MODEM_CONFIG2, SYMB_TIMEOUT_LSB, PREAMBLE_MSB, PREAMBLE_LSB,
+            # PAYLOAD_LENGTH, MAX_PAYLOAD_LENGTH, HOP_PERIOD, (FIFO_RX_BYTE_ADDR), MODEM_CONFIG3
+            (REG_1D_MODEM_CONFIG1, bytes((config1, config2, 0x64, (self.preamble >> 8) & 0xff,
+                                          self.preamble & 0xff, 0x01, 0xff, 0x00, 0x00, config3))),
+            (REG_4D_PA_DAC, bytes((pa_dac,))),
+        )
+
+    def replace(self, **changes):
+        """New profile with some settings changed, e.g. `profile.replace(freq=433.1)`"""
+        settings = dict(modem_config=self.modem_config, freq=self.freq, tx_power=self.tx_power,
+                        preamble=self.preamble, crc=self.crc)
+        settings.update(changes)
+        return ModemProfile(**settings)
+
+
 class LoRa(object):
-    def __init__(self, channel, interrupt, this_address, freq=915, tx_power=14,
+    def __init__(self, channel, interrupt, this_address, freq=915, tx_power=None,
                  modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False,
-                 acks=False, crypto=None):
+                 acks=False, crypto=None, rx_queue_size=64, profile=None, warm_start=False,
+                 spi=None, irq=None):
 
         self._channel = channel
         self._interrupt = interrupt
@@ -39,97 +118,216 @@ class LoRa(object):
         self._last_payload = None
         self.crypto = crypto
 
+        # Received packets are buffered here by the interrupt handler
+        self.rx_queue = PacketQueue(rx_queue_size)
+
         self.cad_timeout = 0
         self.send_retries = 2
-        self.wait_packet_sent_timeout = 0.2
-        self.retry_timeout = 0.2
+        # Seconds the other end takes to send an ACK, the ACK wait is
+        # derived from this and the ACK's time-on-air
+        self.ack_turnaround = PEER_TURNAROUND
+
+        # Signalled by `_handle_interrupt` on TxDone and on a matching ACK
+        self._tx_done = threading.Event()
+        self._tx_done.set()
+        self._tx_timeout = 0.0
+        self._ack_received = threading.Event()
+        self._irq_thread = None
 
         self.crc_error_count = 0
 
-        # Setup the module
-        btn = Button(self._interrupt,pull_up=False)
-        btn.when_pressed = self._handle_interrupt
+        # SPI transactions issued in total and while reading the last received packet
+        self.spi_transactions = 0
+        self.last_rx_spi_transactions = 0
+
+        # Preallocated SPI buffers, byte 0 of each holds the register address.
+        # FIFO_SIZE + 1 covers a full 255 byte packet in a single transfer.
+        # Reads send from `_read_cmd` but spidev returns what it clocked in as
+        # a new list, which is then copied into one of the read buffers.
+        # The interrupt handler runs on gpiozero's thread, `_spi_lock` is held
+        # while a buffer is staged and transferred
+        self._spi_lock = threading.RLock()
+        self._write_buf = bytearray(FIFO_SIZE + 1)
+        self._write_view = memoryview(self._write_buf)
+        self._read_cmd = bytearray(FIFO_SIZE + 1)   # register address followed by zeros
+        self._read_cmd_view = memoryview(self._read_cmd)
+        self._read_buf = bytearray(FIFO_SIZE + 1)
+        self._fifo_buf = bytearray(FIFO_SIZE + 1)
+        self._status_buf = bytearray(RX_STATUS_LENGTH + 1)
+
+        # Write-through copy of the configuration registers
+        self._shadow = bytearray(0x80)
+        self._shadow_valid = bytearray(0x80)
+
+        # Setup the module. `spi` and `irq` stand in for the spidev device and
+        # the gpiozero DIO0 button, e.g. sx127x_emulator's EmulatedSpiDev/EmulatedButton
+        if spi is None:
+            assert spidev is not None, "spidev is not installed, pass spi= to use another backend"
+            spi = spidev.SpiDev()
+            spi.open(0, self._channel)
+            spi.max_speed_hz = 5000000
+        self.spi = spi
+
+        # writebytes2 (spidev >= 3.5) sends straight from a buffer object
+        self._spi_write_block = getattr(self.spi, "writebytes2", self.spi.xfer2)
+
+        # Modem config, preamble, frequency, output power and CRC
+        if profile is None:
+            profile = ModemProfile(self._modem_config, self._freq, self._tx_power)
+        self.profile = None
+
+        # Packets recovered from the FIFO by a warm start
+        self.salvaged_packets = 0
+        self.warm_started = warm_start and self._warm_start(profile)
+
+        if not self.warm_started:
+            # LoRa mode can only be selected from sleep
+            self._spi_write(REG_01_OP_MODE, MODE_SLEEP | LONG_RANGE_MODE)
+            assert self._wait_op_mode(MODE_SLEEP | LONG_RANGE_MODE), "LoRa initialization failed"
+            self._mode = MODE_SLEEP
 
-        self.spi = spidev.SpiDev()
-        self.spi.open(0, self._channel)
-        self.spi.max_speed_hz = 5000000
+            self.set_mode_idle()
+            self.apply_profile(profile)
+
+        # Attach the interrupt last, once the radio is in a known state
+        if irq is None:
+            assert Button is not None, "gpiozero is not installed, pass irq= to use another backend"
+            irq = Button(self._interrupt, pull_up=False)
+        self._button = irq
+        self._button.when_pressed = self._handle_interrupt
+
+    def _warm_start(self, profile):
+        """Take over a radio that is already running in LoRa mode (e.g. after
+        the ground station process restarted mid-pass) without resetting it.
+
+        The register image is read back in one burst and only the profile
+        bursts that differ are rewritten, so a radio that is already set up
+        keeps listening. A packet left in the FIFO by the previous process is
+        moved into `rx_queue`. Returns False if the chip is not in LoRa mode
+        and needs a cold start."""
+        registers = self._spi_read_into(REG_01_OP_MODE, self._read_buf, SHADOW_END)
+        op_mode = registers[0]
+        if not op_mode & LONG_RANGE_MODE:
+            return False
+
+        self._mode = op_mode & 0x07
+        self._update_shadow(REG_01_OP_MODE, registers)
+
+        # RX status block (0x10 - 0x1A) is part of the image we just read,
+        # the FIFO is not accessible in sleep so there is nothing to salvage
+        status_start = REG_10_FIFO_RX_CURRENT_ADDR - REG_01_OP_MODE
+        status = registers[status_start:status_start + RX_STATUS_LENGTH]
+        irq_flags = status[REG_12_IRQ_FLAGS - REG_10_FIFO_RX_CURRENT_ADDR]
+        if (self._mode != MODE_SLEEP and irq_flags & RX_DONE and self.crc_error(irq_flags) == 0 and
+                status[REG_13_RX_NB_BYTES - REG_10_FIFO_RX_CURRENT_ADDR] >= 4):
+            # Copy the status out, the FIFO read reuses the shared read buffer
+            packet = self._accept_packet(self._read_fifo_packet(bytes(status), None, None))
+            if packet is not None and not packet.header_flags & FLAGS_ACK:
+                self.rx_queue.put(packet)
+                self.salvaged_packets += 1
+
+        # A pending flag would hold DIO0 high and no edge would ever reach us
+        self._spi_write(REG_12_IRQ_FLAGS, 0xff)
 
-        self._spi_write(REG_01_OP_MODE, MODE_SLEEP | LONG_RANGE_MODE)
-        time.sleep(0.1)
+        stale = [burst for burst in profile.bursts if self._burst_differs(*burst)]
+        mode = self._mode
+        if stale or mode not in (MODE_STDBY, MODE_RXCONTINUOUS):
+            # Leave TX, CAD or a single receive, frequency can only change in standby
+            self.set_mode_idle()
+            for register, values in stale:
+                self._spi_write(register, values)
 
-        assert self._spi_read(REG_01_OP_MODE) == (MODE_SLEEP | LONG_RANGE_MODE), \
-            "LoRa initialization failed"
+        self.profile = profile
+        self._modem_config = profile.modem_config
+        self._freq = profile.freq
+        self._tx_power = profile.tx_power
 
-        self._spi_write(REG_0E_FIFO_TX_BASE_ADDR, 0)
-        self._spi_write(REG_0F_FIFO_RX_BASE_ADDR, 0)
+        if mode == MODE_RXCONTINUOUS:
+            if self._mode != MODE_RXCONTINUOUS:
+                self.set_mode_rx()
+            elif self._shadow[REG_40_DIO_MAPPING1] != 0x00:
+                self._spi_write(REG_40_DIO_MAPPING1, 0x00)  # Interrupt on RxDone
 
-        self.set_mode_idle()
+        return True
 
-        # set modem config (Bw125Cr45Sf128)
-        self._spi_write(REG_1D_MODEM_CONFIG1, self._modem_config.value[0])
-        self._spi_write(REG_1E_MODEM_CONFIG2, self._modem_config.value[1])
-        self._spi_write(REG_26_MODEM_CONFIG3, self._modem_config.value[2])
-
-        # set preamble length (8)
-        self._spi_write(REG_20_PREAMBLE_MSB, 0)
-        self._spi_write(REG_21_PREAMBLE_LSB, 8)
-
-        # set frequency
-        frf = int((self._freq * 1000000.0) / FSTEP)
-        self._spi_write(REG_06_FRF_MSB, (frf >> 16) & 0xff)
-        self._spi_write(REG_07_FRF_MID, (frf >> 8) & 0xff)
-        self._spi_write(REG_08_FRF_LSB, frf & 0xff)
-
-        # Set tx power
-        if self._tx_power < 5:
-            self._tx_power = 5
-        if self._tx_power > 23:
-            self._tx_power = 23
-
-        '''
-        if self._tx_power < 20:
-            self._spi_write(REG_4D_PA_DAC, PA_DAC_ENABLE)
-            self._tx_power -= 3
-        else:
-            self._spi_write(REG_4D_PA_DAC, PA_DAC_DISABLE)
+    def _burst_differs(self, register, values):
+        # Compare a profile burst with the shadow. Registers the chip changes
+        # on its own (FIFO_RX_BYTE_ADDR) or that `send` rewrites per packet
+        # (PAYLOAD_LENGTH) are ignored
+        for value in values:
+            if _SHADOWED[register] and register != REG_22_PAYLOAD_LENGTH:
+                if not self._shadow_valid[register] or self._shadow[register] != value:
+                    return True
+            register += 1
+        return False
 
-        self._spi_write(REG_09_PA_CONFIG, PA_SELECT | (self._tx_power - 5))
-        '''
-        self._spi_write(REG_4D_PA_DAC, 0x4)
-        self._spi_write(REG_09_PA_CONFIG, 0xFF)
-        # print(self._spi_read(REG_4D_PA_DAC))
-        # print(self._spi_read(REG_09_PA_CONFIG))
+    def _wait_op_mode(self, op_mode, timeout=0.01):
+        deadline = time.monotonic() + timeout
+        while self._spi_read(REG_01_OP_MODE) != op_mode:
+            if time.monotonic() > deadline:
+                return False
+        return True
 
-        # CRC Enable
-        self.enable_crc = True
+    def apply_profile(self, profile, force=False):
+        """Switch to a ModemProfile. Only register bursts that differ from the
+        current profile are written unless `force` is set. The radio passes
+        through standby (frequency can not change while in RX or TX) and is
+        put back into RX if it was listening."""
+        mode = self._mode
+        if mode != MODE_SLEEP:
+            self.set_mode_idle()
+
+        current = None if force else self.profile
+        for i, burst in enumerate(profile.bursts):
+            if current is None or current.bursts[i] != burst:
+                self._spi_write(burst[0], burst[1])
+
+        self.profile = profile
+        self._modem_config = profile.modem_config
+        self._freq = profile.freq
+        self._tx_power = profile.tx_power
+
+        if mode == MODE_RXCONTINUOUS:
+            self.set_mode_rx()
+
+    def set_frequency(self, freq):
+        self.apply_profile(self.profile.replace(freq=freq))
 
     def on_recv(self, message):
         # This should be overridden by the user
         print("Message received!")
         pass
 
+    def receive(self, timeout=None):
+        # Next buffered packet, or None if nothing arrives within `timeout` seconds
+        return self.rx_queue.get(timeout)
+
     def sleep(self):
         if self._mode != MODE_SLEEP:
             self._spi_write(REG_01_OP_MODE, MODE_SLEEP)
             self._mode = MODE_SLEEP
 
+    # The DIO0 mapping and `_mode` are set before the op mode is written so
+    # an operation that completes immediately can not slip past the handler
+
     def set_mode_tx(self):
         if self._mode != MODE_TX:
-            self._spi_write(REG_01_OP_MODE, MODE_TX)
+            self._tx_done.clear()
             self._spi_write(REG_40_DIO_MAPPING1, 0x40)  # Interrupt on TxDone
             self._mode = MODE_TX
+            self._spi_write(REG_01_OP_MODE, MODE_TX)
 
     def set_mode_rx(self):
         if self._mode != MODE_RXCONTINUOUS:
-            self._spi_write(REG_01_OP_MODE, MODE_RXCONTINUOUS)
             self._spi_write(REG_40_DIO_MAPPING1, 0x00)  # Interrupt on RxDone
             self._mode = MODE_RXCONTINUOUS
+            self._spi_write(REG_01_OP_MODE, MODE_RXCONTINUOUS)
 
     def set_mode_cad(self):
         if self._mode != MODE_CAD:
-            self._spi_write(REG_01_OP_MODE, MODE_CAD)
             self._spi_write(REG_40_DIO_MAPPING1, 0x80)  # Interrupt on CadDone
             self._mode = MODE_CAD
+            self._spi_write(REG_01_OP_MODE, MODE_CAD)
 
     def _is_channel_active(self):
         self.set_mode_cad()
@@ -154,19 +352,52 @@ class LoRa(object):
             else:
                 return status
 
-    def wait_packet_sent(self):
-        # wait for `_handle_interrupt` to switch the mode back
-        start = time.time()
-        while time.time() - start < self.wait_packet_sent_timeout:
-            if self._mode != MODE_TX:
+    def wait_packet_sent(self, timeout=None):
+        # wait for `_handle_interrupt` to signal TxDone
+        if self._mode != MODE_TX:
+            return True
+
+        if timeout is None:
+            timeout = self._tx_timeout
+
+        if threading.get_ident() == self._irq_thread:
+            # Called from inside the interrupt handler (e.g. sending an ACK),
+            # TxDone cannot be delivered until we return so poll for it
+            return self._poll_packet_sent(timeout)
+
+        return self._tx_done.wait(timeout)
+
+    def _poll_packet_sent(self, timeout):
+        deadline = time.monotonic() + timeout
+        interval = self.symbol_time()
+        while time.monotonic() < deadline:
+            if self._spi_read(REG_12_IRQ_FLAGS) & TX_DONE:
+                self._spi_write(REG_12_IRQ_FLAGS, 0xff)
+                self.set_mode_idle()
+                self._tx_done.set()
                 return True
+            time.sleep(interval)
 
         return False
 
+    @property
+    def airtime(self):
+        # Timing of the current profile, see airtime.Airtime
+        return self.profile.airtime
+
+    def symbol_time(self):
+        return self.profile.airtime.t_sym
+
+    def time_on_air(self, length):
+        # Time in seconds to transmit `length` bytes (header included)
+        return self.profile.airtime.time_on_air(length)
+
     def set_mode_idle(self):
         if self._mode != MODE_STDBY:
             self._spi_write(REG_01_OP_MODE, MODE_STDBY)
-            time.sleep(0.1)
+            if self._mode == MODE_SLEEP:
+                # Crystal oscillator start-up
+                time.sleep(OSC_STARTUP_TIME)
             self._mode = MODE_STDBY
 
     def send(self, data, header_to, header_id=0, header_flags=0):
@@ -174,22 +405,30 @@ class LoRa(object):
         self.set_mode_idle()
         self.wait_cad()
 
-        header = [header_to, self._this_address, header_id, header_flags]
         if type(data) == int:
-            data = [data]
-        elif type(data) == bytes:
-            data = [p for p in data]
+            data = bytes((data,))
         elif type(data) == str:
-            data = [ord(s) for s in data]
+            data = data.encode()
 
         if self.crypto:
-            data = [b for b in self._encrypt(bytes(data))]
-
-        payload = header + data
-
-        self._spi_write(REG_0D_FIFO_ADDR_PTR, 0)
-        self._spi_write(REG_00_FIFO, payload)
-        self._spi_write(REG_22_PAYLOAD_LENGTH, len(payload))
+            data = self._encrypt(bytes(data))
+
+        length = len(data) + 4
+        assert length <= FIFO_SIZE, "LoRa packets are limited to 255 bytes"
+
+        with self._spi_lock:
+            self._spi_write(REG_0D_FIFO_ADDR_PTR, 0)
+
+            # Build the packet in place behind the FIFO register address
+            packet = self._write_buf
+            packet[1] = header_to
+            packet[2] = self._this_address
+            packet[3] = header_id
+            packet[4] = header_flags
+            packet[5:length + 1] = data
+            self._spi_write_from(REG_00_FIFO, length)
+            self._spi_write(REG_22_PAYLOAD_LENGTH, length)
+        self._tx_timeout = self.profile.airtime.tx_timeout(length)
         self.set_mode_tx()
 
         return True
@@ -197,22 +436,24 @@ class LoRa(object):
     def send_to_wait(self, data, header_to, header_flags=0, retries=3):
         self._last_header_id += 1
 
+        # ACK is a 4 byte header plus a single byte (one AES block when encrypting)
+        ack_length = 20 if self.crypto else 5
+        ack_timeout = self.profile.airtime.ack_timeout(ack_length, self.ack_turnaround)
+
         for _ in range(retries + 1):
+            self._ack_received.clear()
             self.send(data, header_to, header_id=self._last_header_id, header_flags=header_flags)
+            self.wait_packet_sent()
             self.set_mode_rx()
 
             if header_to == BROADCAST_ADDRESS:  # Don't wait for acks from a broadcast message
                 return True
 
-            start = time.time()
-            while time.time() - start < self.retry_timeout + (self.retry_timeout * random()):
-                if self._last_payload:
-                    if self._last_payload.header_to == self._this_address and \
-                            self._last_payload.header_flags & FLAGS_ACK and \
-                            self._last_payload.header_id == self._last_header_id:
-
-                        # We got an ACK
-                        return True
+            # Random backoff of up to one ACK time-on-air so two stations
+            # retrying at once do not keep colliding
+            if self._ack_received.wait(ack_timeout + self.time_on_air(ack_length) * random()):
+                # We got an ACK
+                return True
         return False
 
     def send_ack(self, header_to, header_id):
@@ -220,20 +461,74 @@ class LoRa(object):
         self.wait_packet_sent()
 
     def _spi_write(self, register, payload):
-        if type(payload) == int:
-            payload = [payload]
-        elif type(payload) == bytes:
-            payload = [p for p in payload]
-        elif type(payload) == str:
-            payload = [ord(s) for s in payload]
+        if type(payload) == str:
+            payload = payload.encode()
 
-        self.spi.xfer([register | 0x80] + payload)
+        with self._spi_lock:
+            if type(payload) == int:
+                self._write_buf[1] = payload
+                length = 1
+            else:
+                length = len(payload)
+                self._write_buf[1:length + 1] = payload
+
+            self._spi_write_from(register, length)
+
+    def _spi_write_from(self, register, length):
+        # Write `length` bytes already staged in `_write_buf[1:]`, the
+        # caller holds `_spi_lock` from staging them
+        with self._spi_lock:
+            self.spi_transactions += 1
+            self._write_buf[0] = register | 0x80
+            self._spi_write_block(self._write_view[:length + 1])
+
+            if register != REG_00_FIFO:
+                self._update_shadow(register, self._write_view[1:length + 1])
+
+    def _update_shadow(self, register, values):
+        for value in values:
+            if register < 0x80 and _SHADOWED[register]:
+                self._shadow[register] = value
+                self._shadow_valid[register] = 1
+            register += 1
+
+    def _read_register(self, register):
+        # Configuration registers come from the shadow once known,
+        # everything else is read from the chip
+        if self._shadow_valid[register]:
+            return self._shadow[register]
+
+        value = self._spi_read(register)
+        if _SHADOWED[register]:
+            self._shadow[register] = value
+            self._shadow_valid[register] = 1
+        return value
+
+    def resync(self):
+        """Reload the register shadow (and current mode) from the chip in one
+        burst read, e.g. after the radio has been reset behind our back."""
+        registers = self._spi_read_into(REG_01_OP_MODE, self._read_buf, SHADOW_END)
+        self._mode = registers[0] & 0x07
+        self._update_shadow(REG_01_OP_MODE, registers)
 
     def _spi_read(self, register, length=1):
         if length == 1:
-            return self.spi.xfer([register] + [0] * length)[1]
+            with self._spi_lock:
+                self.spi_transactions += 1
+                self._read_cmd[0] = register
+                return self.spi.xfer2(self._read_cmd_view[:2])[1]
         else:
-            return self.spi.xfer([register] + [0] * length)[1:]
+            # View into a shared buffer, only valid until the next read
+            return self._spi_read_into(register, self._read_buf, length)
+
+    def _spi_read_into(self, register, buf, length):
+        # Read `length` bytes into `buf[1:]` and return a view of them. xfer2
+        # has no in-place variant, its result list is copied into `buf`
+        with self._spi_lock:
+            self.spi_transactions += 1
+            self._read_cmd[0] = register
+            buf[:length + 1] = self.spi.xfer2(self._read_cmd_view[:length + 1])
+        return memoryview(buf)[1:length + 1]
 
     def _decrypt(self, message):
         decrypted_msg = self.crypto.decrypt(message)
@@ -247,60 +542,95 @@ class LoRa(object):
         encrypted_msg = self.crypto.encrypt(msg_bytes)
         return encrypted_msg
 
-    def _handle_interrupt(self, channel):
-        irq_flags = self._spi_read(REG_12_IRQ_FLAGS)
+    def _read_fifo_packet(self, status, rx_monotonic_ns, rx_time_ns):
+        # Read the packet described by an RX status snapshot (registers
+        # 0x10 - 0x1A) out of the FIFO. Header and link quality are decoded
+        # here, address filtering and decryption are left to `_accept_packet`
+        packet_len = status[REG_13_RX_NB_BYTES - REG_10_FIFO_RX_CURRENT_ADDR]
+        with self._spi_lock:
+            self._spi_write(REG_0D_FIFO_ADDR_PTR, status[0])
+            packet = self._spi_read_into(REG_00_FIFO, self._fifo_buf, packet_len)
+
+        snr = status[REG_19_PKT_SNR_VALUE - REG_10_FIFO_RX_CURRENT_ADDR]
+        if snr > 127:
+            snr -= 256  # SNR register is two's complement
+        snr = snr / 4
+        rssi = status[REG_1A_PKT_RSSI_VALUE - REG_10_FIFO_RX_CURRENT_ADDR]
+
+        if snr < 0:
+            rssi = snr + rssi
+        else:
+            rssi = rssi * 16 / 15
 
-        if self._mode == MODE_RXCONTINUOUS and (irq_flags & RX_DONE) and (self.crc_error() == 0):
-            packet_len = self._spi_read(REG_13_RX_NB_BYTES)
-            self._spi_write(REG_0D_FIFO_ADDR_PTR, self._spi_read(REG_10_FIFO_RX_CURRENT_ADDR))
+        if self._freq >= 779:
+            rssi = round(rssi - 157, 2)
+        else:
+            rssi = round(rssi - 164, 2)
 
-            packet = self._spi_read(REG_00_FIFO, packet_len)
-            self._spi_write(REG_12_IRQ_FLAGS, 0xff)  # Clear all IRQ flags
+        message = bytes(packet[4:]) if packet_len > 4 else b''
 
-            snr = self._spi_read(REG_19_PKT_SNR_VALUE) / 4
-            rssi = self._spi_read(REG_1A_PKT_RSSI_VALUE)
+        return LoRaPacket(message, packet[0], packet[1], packet[2], packet[3], rssi, snr,
+                          rx_monotonic_ns, rx_time_ns)
 
-            if snr < 0:
-                rssi = snr + rssi
-            else:
-                rssi = rssi * 16 / 15
+    def _accept_packet(self, packet):
+        # Drop packets that are not for us, decrypt the rest
+        if packet is None:
+            return None
 
-            if self._freq >= 779:
-                rssi = round(rssi - 157, 2)
-            else:
-                rssi = round(rssi - 164, 2)
+        if (packet.header_to != 255 and self._this_address != packet.header_to) or self._receive_all is True:
+            return None
+
+        if self.crypto and len(packet.message) % 16 == 0:
+            packet.message = self._decrypt(packet.message)
 
-            if packet_len >= 4:
-                header_to = packet[0]
-                header_from = packet[1]
-                header_id = packet[2]
-                header_flags = packet[3]
-                message = bytes(packet[4:]) if packet_len > 4 else b''
+        return packet
 
-                # for i in range(0,packet_len):
-                    # print(hex(packet[i]))
+    def _handle_interrupt(self, channel):
+        # Timestamp before any SPI traffic so packet timing is not skewed
+        rx_monotonic_ns = time.monotonic_ns()
+        rx_time_ns = time.time_ns()
+        self._irq_thread = threading.get_ident()
+        spi_start = self.spi_transactions
 
-                if (header_to != 255 and self._this_address != header_to) or self._receive_all is True:
-                    return
+        # Snapshot FIFO_RX_CURRENT_ADDR (0x10) through PKT_RSSI_VALUE (0x1A)
+        # in a single transaction, everything RxDone needs is in this block
+        status = self._spi_read_into(REG_10_FIFO_RX_CURRENT_ADDR, self._status_buf, RX_STATUS_LENGTH)
+        irq_flags = status[REG_12_IRQ_FLAGS - REG_10_FIFO_RX_CURRENT_ADDR]
 
-                if self.crypto and len(message) % 16 == 0:
-                    message = self._decrypt(message)
+        if self._mode == MODE_RXCONTINUOUS and (irq_flags & RX_DONE):
+            packet = None
+            if self.crc_error(irq_flags) == 0 and status[REG_13_RX_NB_BYTES - REG_10_FIFO_RX_CURRENT_ADDR] >= 4:
+                packet = self._read_fifo_packet(status, rx_monotonic_ns, rx_time_ns)
 
-                if self._acks and header_to == self._this_address and not header_flags & FLAGS_ACK:
-                    self.send_ack(header_from, header_id)
+            # Clear all IRQ flags straight away so DIO0 can rise for the next packet
+            self._spi_write(REG_12_IRQ_FLAGS, 0xff)
+            self.last_rx_spi_transactions = self.spi_transactions - spi_start
 
-                self.set_mode_rx()
+            packet = self._accept_packet(packet)
+            if packet is None:
+                return
+
+            if self._acks and packet.header_to == self._this_address and not packet.header_flags & FLAGS_ACK:
+                self.send_ack(packet.header_from, packet.header_id)
+
+            self.set_mode_rx()
+
+            self._last_payload = packet
 
-                self._last_payload = namedtuple(
-                    "Payload",
-                    ['message', 'header_to', 'header_from', 'header_id', 'header_flags', 'rssi', 'snr']
-                )(message, header_to, header_from, header_id, header_flags, rssi, snr)
+            if not packet.header_flags & FLAGS_ACK:
+                self.rx_queue.put(packet)
+                self.on_recv(packet)
+            elif packet.header_to == self._this_address and packet.header_id == self._last_header_id:
+                self._ack_received.set()
 
-                if not header_flags & FLAGS_ACK:
-                    self.on_recv(self._last_payload)
+            return
 
         elif self._mode == MODE_TX and (irq_flags & TX_DONE):
             self.set_mode_idle()
+            # Clear the flags before waking `send`, as `_poll_packet_sent` does
+            self._spi_write(REG_12_IRQ_FLAGS, 0xff)
+            self._tx_done.set()
+            return
 
         elif self._mode == MODE_CAD and (irq_flags & CAD_DONE):
             self._cad = irq_flags & CAD_DETECTED
@@ -314,20 +644,23 @@ class LoRa(object):
         Incoming packets that fail the CRC check are not processed.  Set to
         False to disable CRC checking and process all incoming packets.
         Taken from PyCubed Repo by Max Holliday"""
-        return (self._spi_read(REG_1E_MODEM_CONFIG2) & 0x04) == 0x04
+        return (self._read_register(REG_1E_MODEM_CONFIG2) & 0x04) == 0x04
 
     @enable_crc.setter
     def enable_crc(self, val):
         # Optionally enable CRC checking on incoming packets.
         # Taken from PyCubed Repo by Max Holliday
         if val:
-            self._spi_write(REG_1E_MODEM_CONFIG2, self._spi_read(REG_1E_MODEM_CONFIG2) | 0x04)
+            self._spi_write(REG_1E_MODEM_CONFIG2, self._read_register(REG_1E_MODEM_CONFIG2) | 0x04)
         else:
-            self._spi_write(REG_1E_MODEM_CONFIG2, self._spi_read(REG_1E_MODEM_CONFIG2) & 0xFB)
+            self._spi_write(REG_1E_MODEM_CONFIG2, self._read_register(REG_1E_MODEM_CONFIG2) & 0xFB)
 
-    def crc_error(self):
-        """crc status. Taken from PyCubed Repo by Max Holliday"""
-        error = (self._spi_read(REG_12_IRQ_FLAGS) & 0x20) >> 5
+    def crc_error(self, irq_flags=None):
+        """crc status. Taken from PyCubed Repo by Max Holliday
+        Pass `irq_flags` if they have already been read to save an SPI transaction."""
+        if irq_flags is None:
+            irq_flags = self._spi_read(REG_12_IRQ_FLAGS)
+        error = (irq_flags & 0x20) >> 5
 
         if (error == 1):
             print("CRC Error!")
@@ -336,5 +669,6 @@ class LoRa(object):
 
     def close(self):
         # GPIO.cleanup()
+        self._button.close()
         self.spi.close()
 
@@ -19,27 +19,37 @@ REG_08_FRF_LSB = 0x08
 REG_0E_FIFO_TX_BASE_ADDR = 0x0e
 REG_0F_FIFO_RX_BASE_ADDR = 0x0f
 REG_10_FIFO_RX_CURRENT_ADDR = 0x10
+REG_11_IRQ_FLAGS_MASK = 0x11
 REG_12_IRQ_FLAGS = 0x12
 REG_13_RX_NB_BYTES = 0x13
 REG_1D_MODEM_CONFIG1 = 0x1d
 REG_1E_MODEM_CONFIG2 = 0x1e
 REG_19_PKT_SNR_VALUE = 0x19
 REG_1A_PKT_RSSI_VALUE = 0x1a
+# Registers 0x10 - 0x1A read as one burst in the RxDone interrupt
+RX_STATUS_LENGTH = REG_1A_PKT_RSSI_VALUE - REG_10_FIFO_RX_CURRENT_ADDR + 1
+REG_1B_RSSI_VALUE = 0x1b
 REG_20_PREAMBLE_MSB = 0x20
 REG_21_PREAMBLE_LSB = 0x21
 REG_22_PAYLOAD_LENGTH = 0x22
+REG_25_FIFO_RX_BYTE_ADDR = 0x25
 REG_26_MODEM_CONFIG3 = 0x26
 
 REG_4D_PA_DAC = 0x4d
 REG_40_DIO_MAPPING1 = 0x40
+REG_42_VERSION = 0x42
 REG_0D_FIFO_ADDR_PTR = 0x0d
 
+FIFO_SIZE = 255
+
 PA_DAC_ENABLE = 0x07
 PA_DAC_DISABLE = 0x04
 PA_SELECT = 0x80
 
 CAD_DETECTED_MASK = 0x01
 RX_DONE = 0x40
+PAYLOAD_CRC_ERROR = 0x20
+VALID_HEADER = 0x10
 TX_DONE = 0x08
 CAD_DONE = 0x04
 CAD_DETECTED = 0x01
@@ -49,8 +59,36 @@ MODE_SLEEP = 0x00
 MODE_STDBY = 0x01
 MODE_TX = 0x03
 MODE_RXCONTINUOUS = 0x05
+MODE_RXSINGLE = 0x06
 MODE_CAD = 0x07
 
 REG_09_PA_CONFIG = 0x09
+
+# Configuration registers that only change when we write them, reads of
+# these are served from the driver's shadow copy. Op mode, FIFO pointers,
+# IRQ flags and packet status change on their own and are always read
+# from the chip.
+SHADOW_REGISTERS = (
+    0x06, 0x07, 0x08, 0x09, 0x0a, 0x0b, 0x0c, 0x0e, 0x0f, 0x11,
+    0x1d, 0x1e, 0x1f, 0x20, 0x21, 0x22, 0x23, 0x24, 0x26, 0x27,
+    0x31, 0x33, 0x37, 0x39, 0x40, 0x41, 0x42, 0x4b, 0x4d,
+)
+# Last register covered by `LoRa.resync`
+SHADOW_END = 0x4d
+
+PREAMBLE_LENGTH = 8
+# Worst case TS_OSC leaving sleep mode
+OSC_STARTUP_TIME = 0.0005
+
+# Airtime derived timeouts (airtime.py). Preamble symbols the receiver
+# needs to lock on to a packet, symbols of margin on every timeout and a
+# fixed allowance for interrupt latency and SPI traffic on the host
+PREAMBLE_DETECT_SYMBOLS = 5
+GUARD_SYMBOLS = 8
+TIMING_GUARD = 0.01
+# Seconds the other end takes to get back into RX after a TxDone or
+# RxDone, or to answer a packet that asked for a reply
+PEER_TURNAROUND = 0.05
+
 FXOSC = 32000000.0
 FSTEP = (FXOSC / 524288)
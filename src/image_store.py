@@ -0,0 +1,189 @@
+"""
+'image_store.py'
+================
+Partially downloaded images, kept in a memory-mapped file per image UID
+so a download interrupted by the end of a pass or a restart of the ground
+station resumes from the chunks it is missing.
+
+File layout (big endian):
+
+    header      magic 'AGIM', version, UID, image size, message count,
+                chunk size, image length (0 until the last chunk arrives)
+    chunk map   one byte per chunk, 1 once it has been received
+    data        message count * chunk size bytes, chunk n at n * chunk size
+
+A chunk's data is written before its map byte, so a map byte is only set
+for data that is in the file. The pages are shared with the kernel: a
+crash of the ground station loses nothing, `flush` protects against
+losing power too.
+
+UIDs are the satellite's image slots and SAT_IMG_INFO carries nothing that
+tells two images of the same size in a slot apart. A resumed image so asks
+again for one chunk it has and starts over if the satellite's differs.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+
+from protocol_database import IMAGE_CHUNK_SIZE
+
+_MAGIC = b'AGIM'
+_VERSION = 1
+_HEADER = struct.Struct('>4sBIIHHI')
+_LENGTH_OFFSET = _HEADER.size - 4
+
+
+class PartialImage(object):
+    """Reassembly buffer of one image backed by the file at `path`. An
+    existing file for the same UID, size and message count is picked up
+    where it was left (until a chunk requested again shows it is of another
+    image), anything else at `path` is deleted."""
+
+    def __init__(self, path, uid, size, message_count, chunk_size=IMAGE_CHUNK_SIZE):
+        self.path = path
+        self.uid = uid
+        self.size = size
+        self.message_count = message_count
+        self.chunk_size = chunk_size
+
+        self._map_start = _HEADER.size
+        self._data_start = _HEADER.size + message_count
+        file_size = self._data_start + message_count * chunk_size
+
+        header = None
+        if os.path.exists(path):
+            if os.path.getsize(path) == file_size:
+                with open(path, 'rb') as f:
+                    header = _HEADER.unpack(f.read(_HEADER.size))
+                if header[:6] != (_MAGIC, _VERSION, uid, size, message_count, chunk_size):
+                    header = None
+            if header is None:
+                # Checkpoint of another image in this slot
+                os.remove(path)
+
+        self.resumed = header is not None
+        self._file = open(path, 'r+b' if self.resumed else 'w+b')
+        if not self.resumed:
+            self._file.truncate(file_size)
+        self._mmap = mmap.mmap(self._file.fileno(), file_size)
+
+        if self.resumed:
+            self.length = header[6]
+            self.received_count = self._mmap[self._map_start:self._data_start].count(1)
+        else:
+            self._mmap[:_HEADER.size] = _HEADER.pack(_MAGIC, _VERSION, uid, size, message_count, chunk_size, 0)
+            self.length = 0
+            self.received_count = 0
+        # Chunks received without a gap from the start of the image
+        self._contiguous = self._first_missing(0)
+        # Chunk requested again to check the checkpoint is of the satellite's image
+        self._verify = None
+        if self.received_count:
+            self._verify = (self._contiguous - 1 if self._contiguous else
+                            self._mmap.find(b'\x01', self._map_start, self._data_start) - self._map_start)
+
+    @classmethod
+    def open(cls, directory, uid, size, message_count, chunk_size=IMAGE_CHUNK_SIZE):
+        """Partial image for a UID in `directory`, created if needed"""
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, f'image_{uid}.part'), uid, size, message_count, chunk_size)
+
+    def matches(self, uid, size, message_count):
+        return (uid, size, message_count) == (self.uid, self.size, self.message_count)
+
+    def store(self, sequence_count, chunk):
+        """Write a chunk at its offset. False for a chunk that is already
+        there, outside the image or too long. The chunk a resumed image checks
+        against the satellite's is True if it matches and otherwise discards
+        the checkpoint before it is stored."""
+        if (sequence_count == self._verify) and (len(chunk) <= self.chunk_size):
+            self._verify = None
+            if self._holds(sequence_count, chunk):
+                return True
+            self._reset()
+        if ((sequence_count >= self.message_count) or self._mmap[self._map_start + sequence_count] or
+                (len(chunk) > self.chunk_size)):
+            return False
+
+        offset = self._data_start + sequence_count * self.chunk_size
+        self._mmap[offset:offset + len(chunk)] = chunk
+        if sequence_count == self.message_count - 1:
+            self.length = sequence_count * self.chunk_size + len(chunk)
+            self._mmap[_LENGTH_OFFSET:_HEADER.size] = self.length.to_bytes(4, 'big')
+        self._mmap[self._map_start + sequence_count] = 1
+        self.received_count += 1
+        if sequence_count == self._contiguous:
+            self._contiguous = self._first_missing(sequence_count + 1)
+        return True
+
+    def _holds(self, sequence_count, chunk):
+        """True if `chunk` is what the file has for this sequence count"""
+        if sequence_count == self.message_count - 1:
+            expected = self.length - sequence_count * self.chunk_size
+        else:
+            expected = self.chunk_size
+        offset = self._data_start + sequence_count * self.chunk_size
+        return (len(chunk) == expected) and (self._mmap[offset:offset + expected] == chunk)
+
+    def _reset(self):
+        """Forget every chunk, the checkpoint was of an earlier image"""
+        self._mmap[self._map_start:self._data_start] = bytes(self.message_count)
+        self._mmap[_LENGTH_OFFSET:_HEADER.size] = bytes(4)
+        self.length = 0
+        self.received_count = 0
+        self._contiguous = 0
+        self.resumed = False
+
+    def _first_missing(self, start):
+        position = self._mmap.find(b'\x00', self._map_start + start, self._data_start)
+        return self.message_count if position < 0 else position - self._map_start
+
+    def contiguous_length(self):
+        """Bytes at the start of the image received without a gap, none
+        while a resumed image is not checked yet"""
+        if self._verify is not None:
+            return 0
+        if self._contiguous == self.message_count:
+            return self.length
+        return self._contiguous * self.chunk_size
+
+    def missing(self, limit, span):
+        """Sequence counts of up to `limit` chunks not received yet, starting
+        with the first one and less than `span` chunks after it. Includes the
+        chunk a resumed image checks against the satellite's."""
+        start = self._contiguous if self._verify is None else min(self._contiguous, self._verify)
+        end = self._map_start + min(self.message_count, start + span)
+        missing = []
+        position = self._mmap.find(b'\x00', self._map_start + self._contiguous, end)
+        while (0 <= position) and (len(missing) < limit):
+            missing.append(position - self._map_start)
+            position = self._mmap.find(b'\x00', position + 1, end)
+        if (self._verify is not None) and (self._verify < start + span):
+            bisect.insort(missing, self._verify)
+            del missing[limit:]
+        return missing
+
+    def complete(self):
+        return (self._contiguous == self.message_count) and (self._verify is None)
+
+    def data(self, length=None):
+        """The image, or its first `length` bytes, as a memoryview that has to
+        be released before `close`"""
+        if length is None:
+            length = self.length
+        return memoryview(self._mmap)[self._data_start:self._data_start + length]
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        if not self._mmap.closed:
+            self._mmap.close()
+            self._file.close()
+
+    def remove(self):
+        """Close and delete the file, once the image has been saved"""
+        self.close()
+        os.remove(self.path)
@@ -1,4 +1,8 @@
-from influxdb_client_3 import InfluxDBClient3, Point
+try:
+    from influxdb_client_3 import InfluxDBClient3, Point, WritePrecision
+except ImportError:
+    # DATABASE needs the client, protocol_database only needs this module to import
+    InfluxDBClient3 = Point = WritePrecision = None
 
 class DATABASE:
     '''
@@ -12,8 +16,18 @@ class DATABASE:
 
         self.database="Argus-1 Telemetry - Spring 2024"
 
+    '''
+        Name: new_point
+        Description: Creates a point for a subsystem, stamped with the receive time of its
+                     packet (ns since epoch), the server's time when time_ns is None
+    '''
+    def new_point(self, subsystem, time_ns=None):
+        point = Point("argus-1").tag("Subsystem", subsystem)
+        if time_ns is not None:
+            point.time(time_ns, WritePrecision.NS)
+        return point
 
-    def upload_image_info(self, UID, image_size, message_count):
+    def upload_image_info(self, UID, image_size, message_count, time_ns=None):
         data = {
         "point1": {
             "Subsystem": "Downlinked Image Info",
@@ -32,7 +46,7 @@ class DATABASE:
         }
 
         for key in data:
-            point = Point("argus-1").tag("Subsystem", data[key]["Subsystem"])
+            point = self.new_point(data[key]["Subsystem"], time_ns)
             
             # Add fields for each item under "Image"
             for item_key, item_value in data[key]["Image"].items():
@@ -42,7 +56,7 @@ class DATABASE:
             self.client.write(database=self.database, record=point)
 
 
-    def upload_last_received_packet(self, ack, message_ID, sequence_count, message_size):
+    def upload_last_received_packet(self, ack, message_ID, sequence_count, message_size, time_ns=None):
         data = {
         "point1": {
             "Subsystem": "Downlinked Message Info",
@@ -64,7 +78,7 @@ class DATABASE:
         }
 
         for key in data:
-            point = Point("argus-1").tag("Subsystem", data[key]["Subsystem"])
+            point = self.new_point(data[key]["Subsystem"], time_ns)
             
             # Add fields for each item under "Image"
             for item_key, item_value in data[key]["Message"].items():
@@ -74,7 +88,7 @@ class DATABASE:
             self.client.write(database=self.database, record=point)
 
 
-    def upload_battery_info(self, soc, current):
+    def upload_battery_info(self, soc, current, time_ns=None):
         data = {
             "point1": {
                 "Subsystem": "Battery",
@@ -90,7 +104,7 @@ class DATABASE:
         }
 
         for key in data:
-            point = Point("argus-1").tag("Subsystem", data[key]["Subsystem"])
+            point = self.new_point(data[key]["Subsystem"], time_ns)
             
             # Add fields for each item under "Battery Info"
             for item_key, item_value in data[key]["Battery Info"].items():
@@ -101,7 +115,7 @@ class DATABASE:
             self.client.write(database=self.database, record=point)
 
 
-    def upload_sun_vector(self, x, y, z):
+    def upload_sun_vector(self, x, y, z, time_ns=None):
         data = {
         "point1": {
             "Subsystem": "Sun Vector Info",
@@ -120,7 +134,7 @@ class DATABASE:
         }
 
         for key in data:
-            point = Point("argus-1").tag("Subsystem", data[key]["Subsystem"])
+            point = self.new_point(data[key]["Subsystem"], time_ns)
             
             # Add fields for each item under "Image"
             for item_key, item_value in data[key]["Sun Vector"].items():
@@ -130,7 +144,7 @@ class DATABASE:
             self.client.write(database=self.database, record=point)
 
 
-    def upload_IMU_Info(self, x_mag, y_mag, z_mag, x_gyro, y_gyro, z_gyro):
+    def upload_IMU_Info(self, x_mag, y_mag, z_mag, x_gyro, y_gyro, z_gyro, time_ns=None):
         data = {
         "point1": {
             "Subsystem": "IMU Info",
@@ -158,7 +172,7 @@ class DATABASE:
         }
 
         for key in data:
-            point = Point("argus-1").tag("Subsystem", data[key]["Subsystem"])
+            point = self.new_point(data[key]["Subsystem"], time_ns)
             
             # Add fields for each item under "Image"
             for item_key, item_value in data[key]["IMU"].items():
@@ -168,7 +182,7 @@ class DATABASE:
             self.client.write(database=self.database, record=point)
 
 
-    def upload_system_info(self, status, time):
+    def upload_system_info(self, status, time, time_ns=None):
         data = {
             "point1": {
                 "Subsystem": "System",
@@ -184,7 +198,7 @@ class DATABASE:
         }
 
         for key in data:
-            point = Point("argus-1").tag("Subsystem", data[key]["Subsystem"])
+            point = self.new_point(data[key]["Subsystem"], time_ns)
             
             # Add fields for each item under "System Info"
             for item_key, item_value in data[key]["System Info"].items():
@@ -194,7 +208,7 @@ class DATABASE:
             
             self.client.write(database=self.database, record=point)
 
-    def upload_jetson_info(self, ram_usage, disk_usage, cpu_temp, gpu_temp):
+    def upload_jetson_info(self, ram_usage, disk_usage, cpu_temp, gpu_temp, time_ns=None):
         data = {
             "point1": {
                 "Subsystem": "Jetson",
@@ -216,7 +230,7 @@ class DATABASE:
         }
 
         for key in data:
-            point = Point("argus-1").tag("Subsystem", data[key]["Subsystem"])
+            point = self.new_point(data[key]["Subsystem"], time_ns)
             
             # Add fields for each item under "Jetson Info"
             for item_key, item_value in data[key]["Jetson Info"].items():
@@ -226,7 +240,7 @@ class DATABASE:
             
             self.client.write(database=self.database, record=point)
 
-    def upload_reboot(self, reboot):
+    def upload_reboot(self, reboot, time_ns=None):
         data = {
             "point1": {
                 "Subsystem": "Satellite Reboot Counter",
@@ -239,7 +253,7 @@ class DATABASE:
         }
 
         for key in data:
-            point = Point("argus-1").tag("Subsystem", data[key]["Subsystem"])
+            point = self.new_point(data[key]["Subsystem"], time_ns)
             
             # Add fields for each item under "System Info"
             for item_key, item_value in data[key]["SAT Reboot Counter"].items():
@@ -0,0 +1,142 @@
+"""
+'lora_packet.py'
+================
+Received packet record and receive-side buffering shared by the LoRa
+driver, the ground station and protocol_database.
+
+The driver pushes every packet it reads out of the FIFO into a
+PacketQueue from the interrupt thread, and the ground station drains
+it from the main loop. The queue is a fixed-size ring buffer so a burst
+of image chunks that arrives while the main loop is busy is held
+instead of overwriting the previous packet.
+"""
+
+import threading
+import time
+
+
+class LoRaPacket:
+    """One received packet: message body, RadioHead header and link quality.
+
+    `rx_monotonic_ns` (time.monotonic_ns) and `rx_time_ns` (time.time_ns)
+    are taken on entry to the RxDone interrupt, before any SPI traffic, so
+    they do not include main loop latency. Use the monotonic stamp for
+    intervals and the wall-clock stamp for logs and database points.
+    """
+
+    __slots__ = ('message', 'header_to', 'header_from', 'header_id', 'header_flags',
+                 'rssi', 'snr', 'rx_monotonic_ns', 'rx_time_ns')
+
+    def __init__(self, message, header_to, header_from, header_id, header_flags,
+                 rssi, snr, rx_monotonic_ns=None, rx_time_ns=None):
+        self.message = message
+        self.header_to = header_to
+        self.header_from = header_from
+        self.header_id = header_id
+        self.header_flags = header_flags
+        self.rssi = rssi
+        self.snr = snr
+        self.rx_monotonic_ns = time.monotonic_ns() if rx_monotonic_ns is None else rx_monotonic_ns
+        self.rx_time_ns = time.time_ns() if rx_time_ns is None else rx_time_ns
+
+    def __repr__(self):
+        return (f"LoRaPacket(message={self.message!r}, header_to={self.header_to}, "
+                f"header_from={self.header_from}, header_id={self.header_id}, "
+                f"header_flags={self.header_flags}, rssi={self.rssi}, snr={self.snr}, "
+                f"rx_time_ns={self.rx_time_ns})")
+
+
+class PacketQueue:
+    """Bounded, thread-safe FIFO of received packets.
+
+    When the ring is full the oldest packet is dropped to make room for
+    the newest one and `overflow_count` is incremented, so a stalled
+    consumer shows up in the counters instead of silently losing data.
+    """
+
+    def __init__(self, size=64):
+        assert size > 0, "PacketQueue size must be positive"
+
+        self._ring = [None] * size
+        self._size = size
+        self._head = 0
+        self._count = 0
+        self._cond = threading.Condition(threading.Lock())
+
+        # Statistics
+        self.put_count = 0
+        self.overflow_count = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self._count
+
+    def __bool__(self):
+        return self._count > 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def put(self, packet):
+        """Add a packet and wake one waiting consumer. Never blocks."""
+        with self._cond:
+            tail = (self._head + self._count) % self._size
+            self._ring[tail] = packet
+
+            if self._count == self._size:
+                # Ring full, the slot we just wrote was the oldest packet
+                self._head = (self._head + 1) % self._size
+                self.overflow_count += 1
+            else:
+                self._count += 1
+
+            self.put_count += 1
+            if self._count > self.high_water:
+                self.high_water = self._count
+
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Remove and return the oldest packet.
+
+        Blocks until a packet is available or `timeout` seconds have
+        passed. Returns None on timeout. `timeout=None` waits forever
+        and `timeout=0` never blocks.
+        """
+        with self._cond:
+            if not self._count:
+                if timeout is not None and timeout <= 0:
+                    return None
+                self._cond.wait_for(lambda: self._count > 0, timeout)
+                if not self._count:
+                    return None
+
+            packet = self._ring[self._head]
+            self._ring[self._head] = None
+            self._head = (self._head + 1) % self._size
+            self._count -= 1
+
+            return packet
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def clear(self):
+        """Drop all buffered packets. Returns the number dropped."""
+        with self._cond:
+            dropped = self._count
+            for i in range(self._size):
+                self._ring[i] = None
+            self._head = 0
+            self._count = 0
+
+            return dropped
+
+    def stats(self):
+        return {
+            "queued": self._count,
+            "received": self.put_count,
+            "overflows": self.overflow_count,
+            "high_water": self.high_water,
+        }
@@ -13,6 +13,9 @@ LENGTH     : 1 byte
 Authors: Akshat Sahay, DJ Morvay
 """
 
+from collections import namedtuple
+import struct
+
 from influx_db import *
 
 # Message ID definitions 
@@ -33,10 +36,22 @@ SAT_DEL_IMG = 0x22
 
 GS_STOP = 0x30
 
+# Modem config negotiation, the payload is the three MODEM_CONFIG register values
+GS_MODEM_REQ = 0x40
+SAT_MODEM_RES = 0x41
+
 SAT_IMG_CMD = 0x50
 
 REQ_ACK_NUM = 0x80
 
+# Image bytes per SAT_IMG_CMD chunk, all chunks but the last one are full
+IMAGE_CHUNK_SIZE = 196
+# Largest missing-chunk bitmap sent in a SAT_IMG_CMD, covering 8 chunks per byte
+MAX_CHUNK_BITMAP = 32
+
+# Header of every message: ID (REQ_ACK_NUM bit set to ask for an ACK), sequence count, length
+HEADER = struct.Struct('>BHB')
+
 class IMAGES:
     def __init__(self):
         # Image #1 declarations
@@ -51,184 +66,408 @@ class OTA:
         self.file_size = 0
         self.file_message_count = 0
 
+# Header fields of a received message, its body as a memoryview of the received
+# buffer (no longer than the LENGTH field) and the record its schema decodes
+ReceivedMessage = namedtuple('ReceivedMessage', ('ack_req', 'message_ID', 'sequence_count', 'size',
+                                                 'body', 'record'))
+
 # Function definitions 
-def gs_unpack_header(lora, influx):
+def parse_message(message):
+    """
+        Name: parse_message
+        Description: Reads the header of a message in place with struct.unpack_from, the body
+                     is a view of `message` so nothing is copied
+
+        Return
+            ReceivedMessage (record None, deconstruct_message decodes it), None for a
+            message shorter than the header
+    """
+    view = memoryview(message)
+    if len(view) < HEADER.size:
+        return None
+    message_ID, sequence_count, size = HEADER.unpack_from(view)
+    return ReceivedMessage(message_ID >> 7, message_ID & 0x7F, sequence_count, size,
+                           view[HEADER.size:HEADER.size + size], None)
+
+def gs_unpack_header(payload, influx):
     """
         Name: gs_unpack_header
         Description: Unpacks the header information (message ID, message sequence count, and message size)
-                     from the received lora message. 
+                     from a received lora packet (LoRaPacket) and decodes its body.
 
         Return
-            acknowledgement_request
-            message_ID
-            message_sequence_count
-            message_sizes
+            ReceivedMessage
+                ack_req - acknowledgement request
+                message_ID
+                sequence_count
+                size
+                body - memoryview of the message body
+                record - decoded body, None for unknown messages
+            None for a message shorter than the header, which is skipped
     """
-    ack_req = (int.from_bytes((lora._last_payload.message[0:1]),byteorder='big') & 0b10000000) >> 7
-    message_ID = int.from_bytes((lora._last_payload.message[0:1]),byteorder='big') & 0b01111111
-    message_sequence_count = int.from_bytes(lora._last_payload.message[1:3],byteorder='big')
-    message_size = int.from_bytes(lora._last_payload.message[3:4],byteorder='big')
-
-    lora_rx_message = list(lora._last_payload.message)
-    lora_rx_message[0] = lora_rx_message[0] & 0b01111111
-    deconstruct_message(lora_rx_message, influx)
-
-    return ack_req, message_ID, message_sequence_count, message_size
-
-def image_meta_info(lora):
+    received = parse_message(payload.message)
+    if received is None:
+        print(f"Received message too short for a header ({len(payload.message)} bytes)")
+        return None
+    record = deconstruct_message(payload.message, influx, received, payload.rx_time_ns)
+    return received._replace(record=record)
+
+def image_meta_info(payload):
     """
         Name: image_meta_info
-        Description: Parses a lora packet and returns the stored images meta information, 
+        Description: Parses a lora packet (LoRaPacket) and returns the stored images meta information, 
                      such as the CMD ID, UID, size, and message count.
 
         Return 
-            stored_images (class)
+            stored_images (class), None if the message is too short for it
     """
-    stored_image = IMAGES()
+    try:
+        record = RECEIVE_SCHEMAS[SAT_IMG_INFO].decode(payload.message)
+    except struct.error:
+        return None
 
-    # Get image information
-    stored_image.image_UID = int.from_bytes(lora._last_payload.message[4:5],byteorder='big')
-    stored_image.image_size = int.from_bytes(lora._last_payload.message[5:9],byteorder='big')
-    stored_image.image_message_count = int.from_bytes(lora._last_payload.message[9:11],byteorder='big')
+    stored_image = IMAGES()
+    stored_image.image_UID = record.image_UID
+    stored_image.image_size = record.image_size
+    stored_image.image_message_count = record.image_message_count
 
     return stored_image
 
-def deconstruct_message(lora_rx_message, influx):
+def pack_chunk_bitmap(sequence_counts):
     """
-    :param lora_rx_message: Received LoRa message
-    :return: None
+        Name: pack_chunk_bitmap
+        Description: Packs the image chunks the ground station wants into the first
+                     sequence count and a bitmap, bit i (MSB first) of which asks for
+                     chunk first + i. Used as the tail of a SAT_IMG_CMD request.
 
-    Deconstructs RX message based on message ID
+        Return
+            first sequence count
+            bitmap (bytes)
     """
-    # Check RX message ID 
-    if(lora_rx_message[0] == SAT_HEARTBEAT_BATT):
-        # Received satellite heartbeat, deconstruct header 
-        print("Received SAT heartbeat!")
-        sq = (lora_rx_message[1] << 8) + lora_rx_message[2]
-        print("Sequence Count:", sq)
-        print("Message Length:", lora_rx_message[3])
-
-        # Deconstruct message 
-        print("Satellite system status: " + str(lora_rx_message[4]) + str(lora_rx_message[5]))
-
-        print("Battery SOC:", lora_rx_message[6])
-
-        sat_current = int((lora_rx_message[7] << 8) + lora_rx_message[8])
-        print("Total current draw:", sat_current)
+    first = sequence_counts[0]
+    bitmap = bytearray(((sequence_counts[-1] - first) >> 3) + 1)
+    for sequence_count in sequence_counts:
+        offset = sequence_count - first
+        bitmap[offset >> 3] |= 0x80 >> (offset & 0x07)
 
-        print("Reboot count:", lora_rx_message[9])
+    return first, bytes(bitmap)
 
-        sat_time = (lora_rx_message[10] << 24) + (lora_rx_message[11] << 16) + (lora_rx_message[12] << 8) + lora_rx_message[13]
-        print("Satellite time:", sat_time)
+def unpack_chunk_bitmap(first, bitmap):
+    """
+        Name: unpack_chunk_bitmap
+        Description: Sequence counts asked for by a SAT_IMG_CMD bitmap, in order
 
-        influx.upload_battery_info(lora_rx_message[6], sat_current)
-        influx.upload_system_info(str(lora_rx_message[4]) + str(lora_rx_message[5]), sat_time)
-        influx.upload_reboot(lora_rx_message[9])
+        Return
+            list of sequence counts
+    """
+    return [first + (i << 3) + bit for i, byte in enumerate(bitmap) for bit in range(8)
+            if byte & (0x80 >> bit)]
 
-        print()
-    
-    elif(lora_rx_message[0] == SAT_HEARTBEAT_SUN):
-        # Received satellite heartbeat, deconstruct header 
-        print("Received SAT heartbeat!")
-        sq = (lora_rx_message[1] << 8) + lora_rx_message[2]
-        print("Sequence Count:", sq)
-        print("Message Length:", lora_rx_message[3])
+def fixed_point_value(raw):
+    """
+    :param raw: 16.16 sign-magnitude fixed point value read as a big endian unsigned int
+    :return: value as floating point
 
-        # Deconstruct message 
-        print("Satellite system status: " + str(lora_rx_message[4]) + str(lora_rx_message[5]))
+    Same value as convert_floating_point on the 4 bytes of `raw`, the
+    batch version is fixed_point.decode_fixed_point
+    """
+    val = (raw & 0x7FFFFFFF) / 65536
+    return -val if raw >> 31 else val
 
-        print("Sun vector X:", convert_floating_point_hp(lora_rx_message[6:10]))
-        print("Sun vector Y:", convert_floating_point_hp(lora_rx_message[10:14]))
-        print("Sun vector Z:", convert_floating_point_hp(lora_rx_message[14:18]))
+def fixed_point_hp_value(raw):
+    """
+    :param raw: 8.24 sign-magnitude (HP) fixed point value read as a big endian unsigned int
+    :return: value as floating point
 
-        sat_time = (lora_rx_message[18] << 24) + (lora_rx_message[19] << 16) + (lora_rx_message[20] << 8) + lora_rx_message[21]
-        print("Satellite time:", sat_time)
+    Same value as convert_floating_point_hp on the 4 bytes of `raw`, which
+    adds one to the fraction. The batch version is fixed_point.decode_fixed_point_hp
+    """
+    val = ((raw & 0x7FFFFFFF) + 1) / 16777216
+    return -val if raw >> 31 else val
 
-        influx.upload_sun_vector(convert_floating_point_hp(lora_rx_message[6:10]), convert_floating_point_hp(lora_rx_message[10:14]), convert_floating_point_hp(lora_rx_message[14:18]))
-        influx.upload_system_info(str(lora_rx_message[4]) + str(lora_rx_message[5]), sat_time)
+def fixed_point_raw(val):
+    """
+    :param val: Value to convert to fixed point
+    :return: 16.16 sign-magnitude value as an unsigned int, the bytes of convert_fixed_point
+    """
+    negative = val < 0
+    val = -val if negative else val
+    val_int = int(val)
+    return (negative << 31) | ((val_int & 0xFFFF) << 16) | (int((val - val_int) * 65536) & 0xFFFF)
 
-        print()
+def fixed_point_hp_raw(val):
+    """
+    :param val: Value to convert to HP fixed point
+    :return: 8.24 sign-magnitude value as an unsigned int, the bytes of convert_fixed_point_hp
+    """
+    negative = val < 0
+    val = -val if negative else val
+    val_int = int(val)
+    return (negative << 31) | ((val_int & 0xFF) << 24) | (int((val - val_int) * 16777216) & 0xFFFFFF)
 
-    elif(lora_rx_message[0] == SAT_HEARTBEAT_IMU):
-        # Received satellite heartbeat, deconstruct header 
-        print("Received SAT heartbeat!")
-        sq = (lora_rx_message[1] << 8) + lora_rx_message[2]
-        print("Sequence Count:", sq)
-        print("Message Length:", lora_rx_message[3])
+# (decode, encode) of the scaled fields
+FIXED_POINT = (fixed_point_value, fixed_point_raw)
+FIXED_POINT_HP = (fixed_point_hp_value, fixed_point_hp_raw)
 
-        # Deconstruct message 
-        print("Satellite system status: " + str(lora_rx_message[4]) + str(lora_rx_message[5]))
+class MessageSchema:
+    """
+        Name: MessageSchema
+        Description: Layout of one message ID, compiled into a single struct.Struct for the
+                     body and one for header and body together. Each field is a
+                     (name, struct format, scale, label) row: scale is None for a field
+                     that is its raw value (a tuple of them if the format has several),
+                     or the (decode, encode) pair converting between the raw values and
+                     the field value. Label is what
+                     deconstruct_message prints the field as (None to not print it).
+                     Decoding gives a namedtuple of the fields, pack_into writes a
+                     message from them. upload(influx, record, time_ns) sends the decoded
+                     record to the database stamped with its receive time, telemetry
+                     schemas are printed as heartbeats.
+    """
+    def __init__(self, message_ID, name, fields, upload=None, telemetry=False):
+        self.message_ID = message_ID
+        self.name = name
+        self.fields = tuple(fields)
+        self.upload = upload
+        self.telemetry = telemetry
+
+        body = ''.join(field[1] for field in self.fields)
+        self.struct = struct.Struct('>' + body)
+        self.frame = struct.Struct('>BHB' + body)
+        self.record = namedtuple(name, [field[0] for field in self.fields])
+        self.size = HEADER.size + self.struct.size
+
+        # (first raw value, end, scale) of every field
+        self._slices = []
+        position = 0
+        for _, fmt, scale, _ in self.fields:
+            count = len(struct.unpack('>' + fmt, bytes(struct.calcsize('>' + fmt))))
+            self._slices.append((position, position + count, scale))
+            position += count
+        self._raw = all((scale is None) and (end - start == 1) for start, end, scale in self._slices)
+
+    def decode(self, message):
+        """Record of the fields in `message`, header included, struct.error if it is too short"""
+        raw = self.struct.unpack_from(message, HEADER.size)
+        if self._raw:
+            return self.record._make(raw)
+        values = []
+        for start, end, scale in self._slices:
+            if scale is not None:
+                values.append(scale[0](*raw[start:end]))
+            elif end - start == 1:
+                values.append(raw[start])
+            else:
+                values.append(raw[start:end])
+        return self.record._make(values)
+
+    def encode(self, values):
+        """Raw struct values of the field `values` (a record or a sequence in field order)"""
+        if self._raw:
+            return tuple(values)
+        raw = []
+        for value, (start, end, scale) in zip(values, self._slices):
+            if scale is None:
+                if end - start == 1:
+                    raw.append(value)
+                else:
+                    raw.extend(value)
+            elif end - start == 1:
+                raw.append(scale[1](value))
+            else:
+                raw.extend(scale[1](value))
+        return raw
+
+    def pack_into(self, buffer, offset, values=(), flags=0, sequence_count=0, tail=b''):
+        """Writes the message, header, fields and then `tail` (bytes-like), into
+        `buffer` at `offset`. `flags` are ORed into the message ID. Returns its length."""
+        length = self.struct.size + len(tail)
+        self.frame.pack_into(buffer, offset, self.message_ID | flags, sequence_count, length,
+                             *self.encode(values))
+        start = offset + self.size
+        buffer[start:start + len(tail)] = tail
+        return HEADER.size + length
+
+    def pack(self, values=(), flags=0, sequence_count=0, tail=b''):
+        """The message as bytes, see pack_into"""
+        buffer = bytearray(self.size + len(tail))
+        self.pack_into(buffer, 0, values, flags, sequence_count, tail)
+        return bytes(buffer)
+
+    def labels(self, record):
+        """(label, value) of every field that is printed"""
+        return [(field[3], value) for field, value in zip(self.fields, record) if field[3] is not None]
+
+def _status_text(status):
+    # Status as the database has always stored it, the two bytes in decimal one after the other
+    return str(status[0]) + str(status[1])
+
+def _upload_battery(influx, record, time_ns):
+    influx.upload_battery_info(record.battery_soc, record.current, time_ns=time_ns)
+    influx.upload_system_info(_status_text(record.system_status), record.sat_time, time_ns=time_ns)
+    influx.upload_reboot(record.reboot_count, time_ns=time_ns)
+
+def _upload_sun(influx, record, time_ns):
+    influx.upload_sun_vector(record.sun_x, record.sun_y, record.sun_z, time_ns=time_ns)
+    influx.upload_system_info(_status_text(record.system_status), record.sat_time, time_ns=time_ns)
+
+def _upload_imu(influx, record, time_ns):
+    influx.upload_IMU_Info(record.mag_x, record.mag_y, record.mag_z, record.gyro_x, record.gyro_y, record.gyro_z, time_ns=time_ns)
+    influx.upload_system_info(_status_text(record.system_status), record.sat_time, time_ns=time_ns)
+
+def _upload_jetson(influx, record, time_ns):
+    influx.upload_jetson_info(record.ram_usage, record.disk_usage, record.cpu_temp, record.gpu_temp, time_ns=time_ns)
+    influx.upload_system_info(_status_text(record.system_status), record.sat_time, time_ns=time_ns)
+
+# The two status bytes as received, (first, second)
+_STATUS = ('system_status', 'BB', None, 'Satellite system status')
+_TIME = ('sat_time', 'I', None, 'Satellite time')
+
+# Layout of every message the ground station receives, by message ID. IDs not in
+# here are unknown SAT messages.
+RECEIVE_SCHEMAS = {schema.message_ID: schema for schema in (
+    MessageSchema(SAT_HEARTBEAT_BATT, 'SatHeartbeatBatt', [
+        _STATUS,
+        ('battery_soc', 'B', None, 'Battery SOC'),
+        ('current', 'H', None, 'Total current draw'),
+        ('reboot_count', 'B', None, 'Reboot count'),
+        _TIME], upload=_upload_battery, telemetry=True),
+    MessageSchema(SAT_HEARTBEAT_SUN, 'SatHeartbeatSun', [
+        _STATUS,
+        ('sun_x', 'I', FIXED_POINT_HP, 'Sun vector X'),
+        ('sun_y', 'I', FIXED_POINT_HP, 'Sun vector Y'),
+        ('sun_z', 'I', FIXED_POINT_HP, 'Sun vector Z'),
+        _TIME], upload=_upload_sun, telemetry=True),
+    MessageSchema(SAT_HEARTBEAT_IMU, 'SatHeartbeatImu', [
+        _STATUS,
+        ('mag_x', 'I', FIXED_POINT, 'Magnetometer X'),
+        ('mag_y', 'I', FIXED_POINT, 'Magnetometer Y'),
+        ('mag_z', 'I', FIXED_POINT, 'Magnetometer Z'),
+        ('gyro_x', 'I', FIXED_POINT, 'Gyroscope X'),
+        ('gyro_y', 'I', FIXED_POINT, 'Gyroscope Y'),
+        ('gyro_z', 'I', FIXED_POINT, 'Gyroscope Z'),
+        _TIME], upload=_upload_imu, telemetry=True),
+    # Body not decoded, see deconstruct_message
+    MessageSchema(SAT_HEARTBEAT_GPS, 'SatHeartbeatGps', [], telemetry=True),
+    MessageSchema(SAT_HEARTBEAT_JETSON, 'SatHeartbeatJetson', [
+        _STATUS,
+        ('ram_usage', 'B', None, 'RAM Usage'),
+        ('disk_usage', 'B', None, 'Disk Usage'),
+        ('cpu_temp', 'B', None, 'CPU Temperature'),
+        ('gpu_temp', 'B', None, 'GPU Temperature'),
+        _TIME], upload=_upload_jetson, telemetry=True),
+    MessageSchema(SAT_OTA_RES, 'SatOtaRes', [
+        ('success', 'B', None, None),
+        ('sequence_count', 'H', None, None)]),
+    MessageSchema(SAT_IMG_INFO, 'SatImgInfo', [
+        ('image_UID', 'B', None, None),
+        ('image_size', 'I', None, None),
+        ('image_message_count', 'H', None, None)]),
+    # Image data follows the header, image_unpack takes it from there
+    MessageSchema(SAT_IMG_CMD, 'SatImgCmd', []),
+    MessageSchema(SAT_DEL_IMG, 'SatDelImg', []),
+    MessageSchema(SAT_MODEM_RES, 'SatModemRes', [
+        ('modem_config', '3s', None, None)]),
+)}
+
+# Layout of every message the ground station sends, by message ID
+TRANSMIT_SCHEMAS = {schema.message_ID: schema for schema in (
+    # A GS_ACK carries a command, for SAT_IMG_CMD the argument is the first chunk
+    # wanted and a missing-chunk bitmap may follow.
+    MessageSchema(GS_ACK, 'GsAck', [
+        ('rx_message_ID', 'B', None, None),
+        ('command', 'B', None, None),
+        ('argument', 'H', None, None)]),
+    # OTA file data follows
+    MessageSchema(GS_OTA_REQ, 'GsOtaReq', [
+        ('packets_remaining', 'H', None, None)]),
+    MessageSchema(GS_MODEM_REQ, 'GsModemReq', [
+        ('modem_config', '3s', None, None)]),
+)}
+
+# Largest message, the 255 byte FIFO less the RadioHead header
+MAX_MESSAGE_SIZE = 251
+
+class FrameBuffer:
+    """
+        Name: FrameBuffer
+        Description: Preallocated buffer the ground station packs its messages into, with a
+                     MAX_MESSAGE_SIZE slot for each frame of a window so a whole window of
+                     OTA or command frames is built without intermediate bytes objects.
+                     pack returns a memoryview of the frame, valid until its slot is
+                     packed again.
+    """
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.buffer = bytearray(frames * MAX_MESSAGE_SIZE)
+        self.view = memoryview(self.buffer)
+
+    def pack(self, slot, message_ID, values=(), flags=0, sequence_count=0, tail=b''):
+        schema = TRANSMIT_SCHEMAS[message_ID]
+        if schema.size + len(tail) > MAX_MESSAGE_SIZE:
+            raise ValueError(f"{schema.name} of {schema.size + len(tail)} bytes is too long")
+        offset = slot * MAX_MESSAGE_SIZE
+        length = schema.pack_into(self.buffer, offset, values, flags, sequence_count, tail)
+        return self.view[offset:offset + length]
+
+def decode_message(message):
+    """
+        Name: decode_message
+        Description: Decodes the body of a received message (header included) with the
+                     schema of its message ID
 
-        print("Magnetometer X:", convert_floating_point(lora_rx_message[6:10]))
-        print("Magnetometer Y:", convert_floating_point(lora_rx_message[10:14]))
-        print("Magnetometer Z:", convert_floating_point(lora_rx_message[14:18]))
+        Return
+            record (namedtuple), None for an unknown message ID
+    """
+    schema = RECEIVE_SCHEMAS.get(message[0] & 0x7F)
+    return None if schema is None else schema.decode(message)
 
-        print("Gyroscope X:", convert_floating_point(lora_rx_message[18:22]))
-        print("Gyroscope Y:", convert_floating_point(lora_rx_message[22:26]))
-        print("Gyroscope Z:", convert_floating_point(lora_rx_message[26:30]))
+def deconstruct_message(lora_rx_message, influx, received=None, rx_time_ns=None):
+    """
+    :param lora_rx_message: Received LoRa message
+    :param received: its header as parsed by parse_message, parsed here if not given
+    :param rx_time_ns: time the message was received (ns since epoch) to stamp uploads with,
+                       the database's time if None
+    :return: decoded record, None if the message is unknown or too short
 
-        influx.upload_IMU_Info(convert_floating_point(lora_rx_message[6:10]), convert_floating_point(lora_rx_message[10:14]), \
-                               convert_floating_point(lora_rx_message[14:18]), convert_floating_point(lora_rx_message[18:22]), \
-                               convert_floating_point(lora_rx_message[22:26]), convert_floating_point(lora_rx_message[26:30]))
+    Deconstructs RX message based on message ID
+    """
+    if received is None:
+        received = parse_message(lora_rx_message)
+        if received is None:
+            return None
+    sq, length = received.sequence_count, received.size
+    schema = RECEIVE_SCHEMAS.get(received.message_ID)
+    if schema is None:
+        print("Received unknown SAT message")
+        print("Sequence Count:", sq)
+        print("Message Length:", length)
 
-        sat_time = (lora_rx_message[30] << 24) + (lora_rx_message[31] << 16) + (lora_rx_message[32] << 8) + lora_rx_message[33]
-        print("Satellite time:", sat_time)
+        print("Message has unknown definition")
+        print()
+        return None
 
-        influx.upload_system_info(str(lora_rx_message[4]) + str(lora_rx_message[5]), sat_time)
+    try:
+        record = schema.decode(lora_rx_message)
+    except struct.error:
+        print(f"Received {schema.name} too short to decode ({len(lora_rx_message)} bytes)")
+        return None
 
-        print()
-    
-    elif(lora_rx_message[0] == SAT_HEARTBEAT_GPS):
-        # Received satellite heartbeat, deconstruct header 
+    if schema.telemetry:
+        # Received satellite heartbeat
         print("Received SAT heartbeat!")
-        sq = (lora_rx_message[1] << 8) + lora_rx_message[2]
         print("Sequence Count:", sq)
-        print("Message Length:", lora_rx_message[3])
+        print("Message Length:", length)
+        if received.message_ID == SAT_HEARTBEAT_GPS:
+            print("TODO: Add message decoding for GPS heartbeat")
+        for label, value in schema.labels(record):
+            print(f"{label}:", value)
+        print()
 
-        print("TODO: Add message decoding for GPS heartbeat")
-    
-    elif(lora_rx_message[0] == SAT_HEARTBEAT_JETSON):
-        # Received satellite heartbeat, deconstruct header 
-        print("Received SAT heartbeat!")
-        sq = (lora_rx_message[1] << 8) + lora_rx_message[2]
-        print("Sequence Count:", sq)
-        print("Message Length:", lora_rx_message[3])
-
-        # Deconstruct message 
-        print("Satellite system status: " + str(lora_rx_message[4]) + str(lora_rx_message[5]))
-
-        print("RAM Usage:", lora_rx_message[6])
-        print("Disk Usage:", lora_rx_message[7])
-        print("CPU Temperature:", lora_rx_message[8])
-        print("GPU Temperature:", lora_rx_message[9])
-
-        sat_time = (lora_rx_message[10] << 24) + (lora_rx_message[11] << 16) + (lora_rx_message[12] << 8) + lora_rx_message[13]
-        print("Satellite time:", sat_time)
-        
-        influx.upload_jetson_info(lora_rx_message[6], lora_rx_message[7], lora_rx_message[8], lora_rx_message[9])
-        influx.upload_system_info(str(lora_rx_message[4]) + str(lora_rx_message[5]), sat_time)
-    
-    elif(lora_rx_message[0] == SAT_IMG_INFO):
-        # Image packet, do nothing 
-        return 
-
-    elif(lora_rx_message[0] == SAT_IMG_CMD):
-        # Image packet, do nothing 
-        return 
-
-    elif(lora_rx_message[0] == SAT_DEL_IMG):
-        # Image packet, do nothing 
-        return 
-    
-    else:
-        # Received satellite heartbeat, deconstruct header 
-        print("Received unknown SAT message")
-        sq = (lora_rx_message[1] << 8) + lora_rx_message[2]
-        print("Sequence Count:", sq)
-        print("Message Length:", lora_rx_message[3])
+    if schema.upload is not None:
+        schema.upload(influx, record, rx_time_ns)
 
-        print("Message has unknown definition")
-        print()
+    return record
 
 ### Helper functions for converting to FP format and back ###
 def convert_fixed_point(val):
@@ -239,60 +478,18 @@ def convert_fixed_point(val):
     Convert value to FP with 2 int bytes, 2 dec bytes
     Range: [-32767.9999], 32767.9999]
     """
-    message_list = []
-    neg_bit_flag = 0
-
-    # If val -ve, convert to natural, set first bit of MSB 
-    if(val < 0):
-        val = -1 * val
-        neg_bit_flag = 1
-
-    # Isolate int and write to 2 bytes 
-    val_int = int(val)
-    val_int_LSB = val_int & 0xFF
-    val_int_MSB = (val_int >> 8) & 0xFF
-
-    # Set MSB first bit as neg_bit_flag
-    val_int_MSB |= (neg_bit_flag << 7)
-
-    # Add the values to the test list 
-    message_list.append(val_int_MSB)
-    message_list.append(val_int_LSB)
-
-    # Isolate decimal and write to 2 bytes
-    val_dec = val - val_int
-    val_dec = int(val_dec * 65536)
-    val_dec_LSB = val_dec & 0xFF
-    val_dec_MSB = (val_dec >> 8) & 0xFF
-
-    # Add the values to the test list 
-    message_list.append(val_dec_MSB)
-    message_list.append(val_dec_LSB)
-
-    return message_list
+    return list(fixed_point_raw(val).to_bytes(4, 'big'))
 
 def convert_floating_point(message_list):
     """
     :param message_list: Byte list to convert to floating 
     :return: value as floating point  
 
-    Convert FP value back to floating point 
+    Convert FP value back to floating point, message_list is not modified
     Range: [-32767.9999], 32767.9999]
     """
-    val = 0
-    neg_bit_flag = 0
-
-    # Check -ve, extract LSB bytes for val, combine 
-    if((message_list[0] >> 7) == 1): 
-        message_list[0] &= 0x7F
-        neg_bit_flag = 1
-
-    # Extract bytes for val, combine 
-    val += (message_list[0] << 8) + message_list[1]
-    val += ((message_list[2] << 8) + message_list[3]) / 65536
-    if(neg_bit_flag == 1): val = -1 * val
-
-    return val
+    return fixed_point_value((message_list[0] << 24) | (message_list[1] << 16) |
+                             (message_list[2] << 8) | message_list[3])
 
 def convert_fixed_point_hp(val):
     """
@@ -302,57 +499,15 @@ def convert_fixed_point_hp(val):
     Convert value to HP FP with 1 int byte, 3 dec bytes
     Range: [-128.9999999, 128.9999999]
     """
-    message_list = []
-    neg_bit_flag = 0
-
-    # If val -ve, convert to natural, set first bit of MSB 
-    if(val < 0):
-        val = -1 * val
-        neg_bit_flag = 1
-
-    # Isolate int and write to 1 byte 
-    val_int = int(val)
-    val_int_LSB = val_int & 0xFF
-
-    # Set LSB first bit as neg_bit_flag
-    val_int_LSB |= (neg_bit_flag << 7)
-
-    # Add the values to the test list 
-    message_list.append(val_int_LSB)
-
-    # Isolate decimal and write to 3 bytes
-    val_dec = val - val_int
-    val_dec = int(val_dec * 16777216)
-    val_dec_LSB  = val_dec & 0xFF
-    val_dec_MiSB = (val_dec >> 8) & 0xFF
-    val_dec_MSB  = (val_dec >> 16) & 0xFF
-
-    # Add the values to the test list 
-    message_list.append(val_dec_MSB)
-    message_list.append(val_dec_MiSB)
-    message_list.append(val_dec_LSB)
-
-    return message_list
+    return list(fixed_point_hp_raw(val).to_bytes(4, 'big'))
 
 def convert_floating_point_hp(message_list):
     """
     :param message_list: Byte list to convert to floating 
     :return: value as floating point  
 
-    Convert HP FP value back to floating point 
+    Convert HP FP value back to floating point, message_list is not modified
     Range: [-128.9999999, 128.9999999]
     """
-    val = 0
-    neg_bit_flag = 0
-
-    # Check -ve, extract LSB bytes for val, combine 
-    if((message_list[0] >> 7) == 1): 
-        message_list[0] &= 0x7F
-        neg_bit_flag = 1
-
-    # Extract bytes for val, combine 
-    val += message_list[0]
-    val += ((message_list[1] << 16) + (message_list[2] << 8) + message_list[3] + 1) / 16777216
-    if(neg_bit_flag == 1): val = -1 * val
-
-    return val
\ No newline at end of file
+    return fixed_point_hp_value((message_list[0] << 24) | (message_list[1] << 16) |
+                                (message_list[2] << 8) | message_list[3])
@@ -0,0 +1,477 @@
+"""
+'sim_satellite.py'
+==================
+Simulated Argus-1 satellite speaking the protocol in protocol_database,
+plus stand-ins for the ground station's AWS, InfluxDB and GPIO backends,
+so an unmodified GROUNDSTATION can be run through a whole pass on a
+VirtualLink:
+
+    result = simulate_pass(duration=600, downlink=GilbertElliottChannel(p_good_to_bad=0.05, seed=1))
+    result["s3"].uploads            # images the ground station completed
+
+The satellite sends a heartbeat every `heartbeat_period` seconds until
+the ground station answers, then serves IMG_INFO, image windows of
+`window` chunks, SAT_DEL_IMG, telemetry requests, OTA uplinks and modem
+config changes until GS_STOP (or `session_timeout` seconds without hearing
+the ground station), then goes back to the modem config it started with.
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+from collections import deque
+
+from protocol_database import *
+from virtual_link import VirtualClock, VirtualLink, GilbertElliottChannel, pass_snr_trace
+from adaptive_modem import modem_config_bytes, modem_config_from_bytes
+from constants import BROADCAST_ADDRESS
+import GS_helpers
+
+SAT_HEARTBEATS = (SAT_HEARTBEAT_BATT, SAT_HEARTBEAT_SUN, SAT_HEARTBEAT_IMU,
+                  SAT_HEARTBEAT_GPS, SAT_HEARTBEAT_JETSON)
+
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SATELLITE:
+    '''
+        Name: __init__
+        Description: Simulated satellite on a VirtualRadio
+        Inputs:
+            radio - VirtualRadio for the satellite end of the link
+            images - image files (bytes) stored on board, downlinked in order
+            heartbeat_period - seconds between heartbeats outside a session
+            session_timeout - seconds without a ground station command before
+                              the satellite goes back to sending heartbeats
+            turnaround - seconds between receiving a command and replying
+            window - image chunks sent per SAT_IMG_CMD request
+            chunk_size - image bytes per chunk
+            adaptive_modem - accept GS_MODEM_REQ, False answers with the current config
+    '''
+    def __init__(self, radio, images=(), heartbeat_period=20.0, session_timeout=15.0,
+                 turnaround=0.15, window=10, chunk_size=IMAGE_CHUNK_SIZE, adaptive_modem=True):
+        self.radio = radio
+        self.clock = radio.clock
+        radio.on_recv = self.on_recv
+
+        self.heartbeat_period = heartbeat_period
+        self.session_timeout = session_timeout
+        self.turnaround = turnaround
+        self.window = window
+        self.chunk_size = chunk_size
+        self.adaptive_modem = adaptive_modem
+
+        # Heartbeats always go out with the profile the radio started with,
+        # a negotiated profile is switched to after the response has been sent
+        self.base_profile = radio.profile
+        self._next_profile = None
+
+        # Images waiting to be downlinked as [UID, data]
+        self.images = [[uid, bytes(data)] for uid, data in enumerate(images, 1)]
+        self.deleted_images = []
+
+        # OTA chunks received, by sequence count
+        self.ota_chunks = {}
+        self.ota_message_count = 0
+
+        self.in_session = False
+        self.last_command_time = None
+        self.heartbeat_sequence = 0
+        self.reboot_count = 0
+
+        self._tx_queue = deque()
+        self._transmitting = False
+
+        # Statistics
+        self.commands_received = 0
+        self.heartbeats_sent = 0
+        self.chunks_sent = 0
+        self.chunks_unique = set()  # (UID, sequence count) of every chunk sent at least once
+        self.ota_frames_received = 0
+        self.ota_complete_time = None
+        self.chunk_requests = []    # (virtual time, first sequence count) of each SAT_IMG_CMD
+
+    '''
+        Name: start
+        Description: Start listening and schedule the first heartbeat
+    '''
+    def start(self, delay=0.0):
+        self.radio.set_mode_rx()
+        self.clock.schedule(delay, self._heartbeat)
+
+    def _heartbeat(self):
+        now = self.clock.monotonic()
+        if self.in_session and now - self.last_command_time > self.session_timeout:
+            # Ground station went quiet mid-session
+            self.in_session = False
+            self.radio.apply_profile(self.base_profile)
+
+        if not self.in_session:
+            self.heartbeats_sent += 1
+            self._reply([self.pack_heartbeat(SAT_HEARTBEAT_BATT)], delay=0.0)
+
+        self.clock.schedule(self.heartbeat_period, self._heartbeat)
+
+    '''
+        Name: on_recv
+        Description: Handles a command from the ground station at the time it is received
+        Inputs:
+            packet - LoRaPacket from the satellite radio
+    '''
+    def on_recv(self, packet):
+        message = packet.message
+        if len(message) < 4:
+            return
+
+        self.commands_received += 1
+        self.last_command_time = self.clock.monotonic()
+        self.in_session = True
+
+        message_ID = message[0] & 0x7F
+        req_ack = message[0] & REQ_ACK_NUM
+
+        if message_ID == GS_OTA_REQ:
+            self.ota_unpack(message)
+            if req_ack:
+                self._reply([self.pack_ota_response()])
+            return
+
+        if message_ID == GS_MODEM_REQ:
+            self._reply([self.pack_modem_response(message[4:7])])
+            return
+
+        if message_ID != GS_ACK or len(message) < 8:
+            return
+
+        gs_cmd = message[5]
+        sequence_count = int.from_bytes(message[6:8], 'big')
+        # Selective repeat: a bitmap of the chunks wanted may follow the sequence count
+        bitmap = message[8:4 + message[3]]
+
+        if gs_cmd == SAT_IMG_INFO:
+            self._reply([self.pack_image_info()])
+        elif gs_cmd == SAT_IMG_CMD:
+            self.chunk_requests.append((self.last_command_time, sequence_count))
+            self._reply(self.pack_image_window(sequence_count, bitmap))
+        elif gs_cmd == SAT_DEL_IMG:
+            if self.images:
+                self.deleted_images.append(self.images.pop(0)[0])
+            self._reply([self.pack_message(SAT_DEL_IMG, 0, bytes([0x1]))])
+        elif gs_cmd == GS_STOP:
+            self.in_session = False
+            self.radio.apply_profile(self.base_profile)
+        elif gs_cmd in SAT_HEARTBEATS:
+            self._reply([self.pack_heartbeat(gs_cmd)])
+
+    '''
+        Name: pack_message
+        Description: Message ID (with REQ_ACK), sequence count and length header plus payload
+    '''
+    def pack_message(self, message_ID, sequence_count, payload, req_ack=True):
+        return (bytes([message_ID | (REQ_ACK_NUM if req_ack else 0)]) + sequence_count.to_bytes(2, 'big') +
+                len(payload).to_bytes(1, 'big') + payload)
+
+    '''
+        Name: pack_heartbeat
+        Description: Heartbeat or telemetry message of the requested type with plausible values
+    '''
+    def pack_heartbeat(self, message_ID):
+        self.heartbeat_sequence = (self.heartbeat_sequence + 1) & 0xFFFF
+        status = bytes([0x1, 0x0])
+        sat_time = int(self.clock.time()).to_bytes(4, 'big')
+
+        if message_ID == SAT_HEARTBEAT_BATT:
+            payload = status + bytes([87]) + (420).to_bytes(2, 'big') + bytes([self.reboot_count]) + sat_time
+        elif message_ID == SAT_HEARTBEAT_SUN:
+            payload = status + bytes(convert_fixed_point_hp(0.25) + convert_fixed_point_hp(-0.5) +
+                                     convert_fixed_point_hp(0.83)) + sat_time
+        elif message_ID == SAT_HEARTBEAT_IMU:
+            payload = status + bytes(convert_fixed_point(21.5) + convert_fixed_point(-3.25) + convert_fixed_point(40.0) +
+                                     convert_fixed_point(0.5) + convert_fixed_point(-0.25) + convert_fixed_point(1.0)) + sat_time
+        elif message_ID == SAT_HEARTBEAT_JETSON:
+            payload = status + bytes([35, 60, 48, 45]) + sat_time
+        else:
+            payload = b''
+
+        return self.pack_message(message_ID, self.heartbeat_sequence, payload)
+
+    '''
+        Name: pack_image_info
+        Description: UID, size and message count of the next image (all zero when there is none)
+    '''
+    def pack_image_info(self):
+        if self.images:
+            uid, data = self.images[0]
+            message_count = -(-len(data) // self.chunk_size)
+        else:
+            uid, data, message_count = 0, b'', 0
+
+        payload = uid.to_bytes(1, 'big') + len(data).to_bytes(4, 'big') + message_count.to_bytes(2, 'big')
+        return self.pack_message(SAT_IMG_INFO, 0, payload)
+
+    '''
+        Name: pack_image_window
+        Description: Up to `window` image chunks starting at a sequence count, or the
+                     chunks flagged in a bitmap, the last one requests an acknowledgement
+    '''
+    def pack_image_window(self, sequence_count, bitmap=b''):
+        if not self.images:
+            return [self.pack_image_info()]
+
+        uid, data = self.images[0]
+        message_count = -(-len(data) // self.chunk_size)
+        if bitmap:
+            wanted = [seq for seq in unpack_chunk_bitmap(sequence_count, bitmap) if seq < message_count]
+        else:
+            wanted = list(range(sequence_count, message_count))
+        wanted = wanted[:self.window]
+
+        messages = []
+        for seq in wanted:
+            chunk = data[seq * self.chunk_size:(seq + 1) * self.chunk_size]
+            messages.append(self.pack_message(SAT_IMG_CMD, seq, chunk, req_ack=(seq == wanted[-1])))
+            self.chunks_unique.add((uid, seq))
+
+        self.chunks_sent += len(messages)
+        return messages
+
+    '''
+        Name: ota_unpack
+        Description: Stores one OTA chunk: header, packets remaining (2 bytes), file data
+    '''
+    def ota_unpack(self, message):
+        sequence_count = int.from_bytes(message[1:3], 'big')
+        size = message[3]
+        packets_remaining = int.from_bytes(message[4:6], 'big')
+        self.ota_chunks[sequence_count] = bytes(message[6:4 + size])
+        self.ota_message_count = max(self.ota_message_count, sequence_count + packets_remaining + 1)
+        self.ota_frames_received += 1
+        if self.ota_complete_time is None and self.ota_file() is not None:
+            self.ota_complete_time = self.clock.monotonic()
+
+    '''
+        Name: pack_ota_response
+        Description: OTA success flag and the next sequence count the satellite needs
+    '''
+    def pack_ota_response(self):
+        next_sequence = 0
+        while next_sequence in self.ota_chunks:
+            next_sequence += 1
+        success = 1 if next_sequence >= len(self.ota_chunks) else 0
+        return self.pack_message(SAT_OTA_RES, 0, bytes([success]) + next_sequence.to_bytes(2, 'big'))
+
+    '''
+        Name: pack_modem_response
+        Description: Accepts a requested modem config if it is a known one, the
+                     response carries the config the satellite will use next
+    '''
+    def pack_modem_response(self, registers):
+        modem_config = modem_config_from_bytes(registers)
+        if self.adaptive_modem and modem_config is not None:
+            self._next_profile = self.radio.profile.replace(modem_config=modem_config)
+        else:
+            modem_config = self.radio.modem_config
+        return self.pack_message(SAT_MODEM_RES, 0, modem_config_bytes(modem_config))
+
+    '''
+        Name: ota_file
+        Description: Reassembled OTA file, None until every chunk has arrived
+    '''
+    def ota_file(self):
+        if not self.ota_message_count or len(self.ota_chunks) < self.ota_message_count:
+            return None
+        return b''.join(self.ota_chunks[i] for i in range(self.ota_message_count))
+
+    def _reply(self, messages, delay=None):
+        self._tx_queue.extend(messages)
+        if not self._transmitting:
+            self._transmitting = True
+            self.clock.schedule(self.turnaround if delay is None else delay, self._transmit_next)
+
+    def _transmit_next(self):
+        if not self._tx_queue:
+            self._transmitting = False
+            if self._next_profile is not None:
+                self.radio.apply_profile(self._next_profile)
+                self._next_profile = None
+            self.radio.set_mode_rx()
+            return
+
+        self.radio.send(self._tx_queue.popleft(), BROADCAST_ADDRESS)
+        self.clock.schedule(self.radio.tx_end - self.clock.monotonic(), self._transmit_next)
+
+
+class SimS3Client:
+    '''
+        Name: SimS3Client
+        Description: Keeps uploads in memory instead of sending them to S3. Multipart
+                     uploads are checked like S3 does: every part but the last has to
+                     be at least min_part_size bytes.
+    '''
+    def __init__(self, min_part_size=5 * 1024 * 1024):
+        self.min_part_size = min_part_size
+        self.objects = {}
+        self.uploads = []   # (bucket, key, data) in upload order
+        self.multipart = {}     # UploadId -> (bucket, key, {PartNumber: data})
+        self.multipart_count = 0
+        self.parts_uploaded = 0
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as f:
+            data = f.read()
+        self.objects[(Bucket, Key)] = data
+        self.uploads.append((Bucket, Key, data))
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        self.objects[(Bucket, Key)] = data
+        self.uploads.append((Bucket, Key, data))
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.multipart_count += 1
+        upload_id = f'upload-{self.multipart_count}'
+        self.multipart[upload_id] = (Bucket, Key, {})
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body, **kwargs):
+        if (UploadId not in self.multipart) or (self.multipart[UploadId][:2] != (Bucket, Key)):
+            raise KeyError(f'NoSuchUpload: {UploadId}')
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        self.multipart[UploadId][2][PartNumber] = data
+        self.parts_uploaded += 1
+        return {'ETag': f'"{PartNumber}-{len(data)}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        if (UploadId not in self.multipart) or (self.multipart[UploadId][:2] != (Bucket, Key)):
+            raise KeyError(f'NoSuchUpload: {UploadId}')
+        uploaded = self.multipart[UploadId][2]
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        if not numbers or (numbers != sorted(numbers)) or any(number not in uploaded for number in numbers):
+            raise ValueError('InvalidPart')
+        if any(len(uploaded[number]) < self.min_part_size for number in numbers[:-1]):
+            raise ValueError('EntityTooSmall')
+        data = b''.join(uploaded[number] for number in numbers)
+        del self.multipart[UploadId]
+        self.objects[(Bucket, Key)] = data
+        self.uploads.append((Bucket, Key, data))
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.multipart.pop(UploadId, None)
+        return {}
+
+
+class SimDatabase:
+    '''
+        Name: SimDatabase
+        Description: Records DATABASE uploads as (method, time_ns, args) instead of
+                     writing them to InfluxDB
+    '''
+    UPLOADS = ('upload_image_info', 'upload_last_received_packet', 'upload_battery_info',
+               'upload_sun_vector', 'upload_IMU_Info', 'upload_system_info',
+               'upload_jetson_info', 'upload_reboot')
+
+    def __init__(self):
+        self.records = []
+
+    def __getattr__(self, name):
+        if name in SimDatabase.UPLOADS:
+            return lambda *args, time_ns=None: self.records.append((name, time_ns, args))
+        raise AttributeError(name)
+
+
+class SimLED:
+    '''
+        Name: SimLED
+        Description: gpiozero LED stand-in for the RX/TX control pins
+    '''
+    def __init__(self):
+        self.is_lit = False
+        self.switch_count = 0
+
+    def on(self):
+        self.is_lit = True
+        self.switch_count += 1
+
+    def off(self):
+        self.is_lit = False
+
+
+'''
+    Name: simulate_pass
+    Description: Runs an unmodified GROUNDSTATION main loop against a SATELLITE over a
+                 VirtualLink for `duration` virtual seconds. The ground station runs in
+                 a temporary directory, its stdout is discarded when `quiet` is set.
+    Inputs:
+        duration - length of the pass in seconds
+        images - files stored on the satellite, defaults to tinyimage.jpg
+        commands - commands for groundstation_commands.txt, e.g. ['GS_OTA_REQ']
+        uplink, downlink - GilbertElliottChannel for each direction, defaults follow
+                           a pass_snr_trace over `duration`
+        modem_config - ModemConfig for both radios
+        modem_controller - adaptive_modem.ModemController for the ground station
+        image_dir - where the ground station keeps partial images, pass the same directory
+                    to several passes to resume downloads (default: inside the temporary directory)
+        setup - called with the result dict (gs included) before the pass starts
+        s3 - SimS3Client the ground station uploads to
+        gs_kwargs - extra GROUNDSTATION arguments
+        satellite_kwargs - extra SATELLITE arguments
+    Return:
+        dict with the clock, link, gs, satellite, s3 and influx objects
+'''
+def simulate_pass(duration=600.0, images=None, commands=(), uplink=None, downlink=None,
+                  modem_config=None, rx_timeout=10.0, quiet=True, setup=None, modem_controller=None,
+                  image_dir=None, s3=None, gs_kwargs=None, **satellite_kwargs):
+    if images is None:
+        with open(os.path.join(_SRC_DIR, 'tinyimage.jpg'), 'rb') as f:
+            images = [f.read()]
+    if uplink is None:
+        uplink = GilbertElliottChannel(snr_trace=pass_snr_trace(duration))
+    if downlink is None:
+        downlink = GilbertElliottChannel(snr_trace=pass_snr_trace(duration))
+
+    clock = VirtualClock()
+    link_kwargs = {} if modem_config is None else {'modem_config': modem_config}
+    link = VirtualLink(clock, uplink, downlink, **link_kwargs)
+    satellite = SATELLITE(link.radio_b, images, **satellite_kwargs)
+
+    if s3 is None:
+        s3 = SimS3Client()
+    influx = SimDatabase()
+    result = {'clock': clock, 'link': link, 'satellite': satellite, 's3': s3, 'influx': influx}
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='gs_sim_')
+    image_dir = os.path.join(workdir, 'partial_images') if image_dir is None else os.path.abspath(image_dir)
+    output = io.StringIO() if quiet else None
+    try:
+        os.chdir(workdir)
+        with open('groundstation_commands.txt', 'w') as f:
+            for i, command in enumerate(commands, 1):
+                f.write(f'{i}. {command}\n')
+        shutil.copy(os.path.join(_SRC_DIR, 'tinyimage.jpg'), 'tinyimage.jpg')
+
+        with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+            gs = GS_helpers.GROUNDSTATION(rx_timeout=rx_timeout, s3_client=s3, influx=influx,
+                                          rx_ctrl=SimLED(), tx_ctrl=SimLED(), clock=clock,
+                                          modem_controller=modem_controller,
+                                          image_dir=image_dir, **(gs_kwargs or {}))
+            result['gs'] = gs
+            if setup is not None:
+                setup(result)
+
+            satellite.start()
+            lora = link.radio_a
+            while clock.monotonic() < duration:
+                if gs.receive_message(lora):
+                    gs.transmit_message(lora)
+
+            gs.close_log()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return result
@@ -0,0 +1,517 @@
+"""
+'sx127x_emulator.py'
+====================
+Register level model of the SX1276/77/78 (RFM95/96/98) LoRa radio, with
+SPI and GPIO stand-ins so the radio drivers can run without hardware:
+
+    from sx127x_emulator import SX127xEmulator, EmulatedSpiDev, EmulatedButton
+
+    gs_chip = SX127xEmulator()
+    sat_chip = SX127xEmulator()
+    gs_chip.connect(sat_chip)
+
+    lora = LoRa(0, 19, 25, spi=EmulatedSpiDev(gs_chip), irq=EmulatedButton(gs_chip))
+
+Modelled: the LoRa register page, the 256 byte FIFO and its pointers,
+burst read/write with address auto-increment, op mode transitions
+(LongRangeMode only changes with sleep, TX and CAD return to standby), IRQ
+flags with the flags mask and write-1-to-clear, and DIO0 mapped to
+RxDone/TxDone/CadDone. TX lasts the time-on-air computed from the modem
+registers, scaled by `time_scale` (0 completes as soon as possible).
+
+Not modelled: FSK mode, frequency hopping, RSSI noise and anything RF.
+Interrupt callbacks run on a thread owned by the emulator, the same way
+gpiozero runs `when_pressed` on its own thread.
+"""
+
+import functools
+import heapq
+import inspect
+import itertools
+import threading
+import time
+import traceback
+
+from airtime import BANDWIDTHS, lora_time_on_air, symbol_time
+# Register map shared with the drivers, so the emulator checks what they use
+from constants import (REG_00_FIFO, REG_01_OP_MODE, REG_0D_FIFO_ADDR_PTR, REG_0E_FIFO_TX_BASE_ADDR,
+                       REG_0F_FIFO_RX_BASE_ADDR, REG_10_FIFO_RX_CURRENT_ADDR, REG_11_IRQ_FLAGS_MASK,
+                       REG_12_IRQ_FLAGS, REG_13_RX_NB_BYTES, REG_19_PKT_SNR_VALUE, REG_1A_PKT_RSSI_VALUE,
+                       REG_1B_RSSI_VALUE, REG_1D_MODEM_CONFIG1, REG_1E_MODEM_CONFIG2, REG_20_PREAMBLE_MSB,
+                       REG_21_PREAMBLE_LSB, REG_22_PAYLOAD_LENGTH, REG_25_FIFO_RX_BYTE_ADDR,
+                       REG_26_MODEM_CONFIG3, REG_40_DIO_MAPPING1, REG_42_VERSION,
+                       LONG_RANGE_MODE, MODE_SLEEP, MODE_STDBY, MODE_TX, MODE_RXCONTINUOUS, MODE_RXSINGLE,
+                       MODE_CAD, RX_DONE, PAYLOAD_CRC_ERROR, VALID_HEADER, TX_DONE, CAD_DONE)
+
+# IRQ flag routed to DIO0 for each value of RegDioMapping1 bits 7-6
+DIO0_SOURCES = (RX_DONE, TX_DONE, CAD_DONE, 0)
+
+# Registers the host can not write
+READ_ONLY = frozenset((0x10, 0x13, 0x14, 0x15, 0x16, 0x17, 0x18, 0x19, 0x1A, 0x1B, 0x1C, 0x25, 0x42))
+
+# LoRa page reset values (SX1276 datasheet, table 41)
+RESET_VALUES = {
+    0x01: 0x01, 0x06: 0x6C, 0x07: 0x80, 0x08: 0x00, 0x09: 0x4F, 0x0A: 0x09,
+    0x0B: 0x2B, 0x0C: 0x20, 0x0E: 0x80, 0x1D: 0x72, 0x1E: 0x70, 0x1F: 0x64,
+    0x21: 0x08, 0x22: 0x01, 0x23: 0xFF, 0x26: 0x04, 0x31: 0xC3, 0x33: 0x27,
+    0x37: 0x0A, 0x39: 0x12, 0x4B: 0x09, 0x4D: 0x84,
+}
+
+
+class SX127xEmulator(object):
+    """One emulated radio. All register access goes through `transfer`,
+    which takes and returns a full SPI transaction like spidev's xfer."""
+
+    def __init__(self, time_scale=1.0, version=0x12, rssi=-80.0, snr=9.5):
+        self.time_scale = time_scale
+        self.version = version
+        # Link quality reported for packets delivered without explicit values
+        self.rssi = rssi
+        self.snr = snr
+
+        self.regs = bytearray(0x80)
+        self.fifo = bytearray(256)
+
+        # Called with the packet bytes whenever a transmission completes
+        self.on_transmit = None
+        self.peers = []
+
+        # Statistics
+        self.spi_transactions = 0
+        self.tx_packets = 0
+        self.rx_packets = 0
+        self.rx_missed = 0
+
+        self._cond = threading.Condition(threading.RLock())
+        self._events = []
+        self._event_seq = itertools.count()
+        self._generation = 0    # bumped on every mode change to cancel TX/CAD completion
+        self._callbacks = []
+        self._dio0_listeners = []
+        self._dio0 = False
+        self._worker = None
+        self._closed = False
+
+        self.reset()
+
+    # ---------------------------------------------------------------- control
+
+    def reset(self):
+        """Pulse the reset line: registers return to their reset values and
+        pending TX/CAD completions are dropped."""
+        with self._cond:
+            self.regs[:] = bytes(0x80)
+            for register, value in RESET_VALUES.items():
+                self.regs[register] = value
+            self.regs[REG_42_VERSION] = self.version
+            self.fifo[:] = bytes(256)
+            self._generation += 1
+            self._update_dio0()
+
+    def close(self):
+        """Stop the emulator's threads."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def connect(self, other):
+        """Deliver packets transmitted by either radio to the other one."""
+        if other not in self.peers:
+            self.peers.append(other)
+        if self not in other.peers:
+            other.peers.append(self)
+
+    def add_dio0_listener(self, callback):
+        with self._cond:
+            self._dio0_listeners.append(callback)
+
+    def remove_dio0_listener(self, callback):
+        with self._cond:
+            if callback in self._dio0_listeners:
+                self._dio0_listeners.remove(callback)
+
+    @property
+    def dio0(self):
+        return self._dio0
+
+    @property
+    def op_mode(self):
+        return self.regs[REG_01_OP_MODE] & 0x07
+
+    @property
+    def long_range_mode(self):
+        return bool(self.regs[REG_01_OP_MODE] & LONG_RANGE_MODE)
+
+    # -------------------------------------------------------------------- SPI
+
+    def transfer(self, data):
+        """One SPI transaction: address byte (bit 7 set for a write) followed
+        by data. Returns the bytes clocked out on MISO as a list."""
+        with self._cond:
+            self.spi_transactions += 1
+            length = len(data)
+            address = data[0] & 0x7F
+            out = [0] * length
+
+            if data[0] & 0x80:
+                for i in range(1, length):
+                    self._write(address, data[i])
+                    if address:
+                        address = (address + 1) & 0x7F
+            else:
+                for i in range(1, length):
+                    out[i] = self._read(address)
+                    if address:
+                        address = (address + 1) & 0x7F
+
+            self._update_dio0()
+            return out
+
+    def _read(self, address):
+        if address == REG_00_FIFO:
+            pointer = self.regs[REG_0D_FIFO_ADDR_PTR]
+            self.regs[REG_0D_FIFO_ADDR_PTR] = (pointer + 1) & 0xFF
+            return self.fifo[pointer]
+        if address == REG_1B_RSSI_VALUE:
+            return self._rssi_register(self.rssi, self.snr)
+        return self.regs[address]
+
+    def _write(self, address, value):
+        if address == REG_00_FIFO:
+            # FIFO is not accessible in sleep
+            if self.op_mode != MODE_SLEEP:
+                pointer = self.regs[REG_0D_FIFO_ADDR_PTR]
+                self.fifo[pointer] = value
+                self.regs[REG_0D_FIFO_ADDR_PTR] = (pointer + 1) & 0xFF
+        elif address == REG_01_OP_MODE:
+            self._set_op_mode(value)
+        elif address == REG_12_IRQ_FLAGS:
+            self.regs[REG_12_IRQ_FLAGS] &= ~value & 0xFF
+        elif address not in READ_ONLY:
+            self.regs[address] = value
+
+    # --------------------------------------------------------------- op modes
+
+    def _set_op_mode(self, value):
+        old = self.regs[REG_01_OP_MODE]
+        if value & 0x07 != MODE_SLEEP:
+            # LongRangeMode only takes a new value when written along with
+            # sleep, drivers write plain mode values everywhere else
+            value = (value & ~LONG_RANGE_MODE) | (old & LONG_RANGE_MODE)
+        self.regs[REG_01_OP_MODE] = value
+
+        mode = value & 0x07
+        if mode == old & 0x07 and (value ^ old) & LONG_RANGE_MODE == 0:
+            return
+
+        self._generation += 1
+        if not value & LONG_RANGE_MODE:
+            return
+
+        if mode == MODE_SLEEP:
+            # FIFO content is lost in sleep
+            self.fifo[:] = bytes(256)
+        elif mode == MODE_TX:
+            length = self.regs[REG_22_PAYLOAD_LENGTH]
+            start = self.regs[REG_0E_FIFO_TX_BASE_ADDR]
+            packet = bytes(self.fifo[(start + i) & 0xFF] for i in range(length))
+            self._schedule(self.time_on_air(length), self._tx_done, self._generation, packet)
+        elif mode in (MODE_RXCONTINUOUS, MODE_RXSINGLE):
+            self.regs[REG_25_FIFO_RX_BYTE_ADDR] = self.regs[REG_0F_FIFO_RX_BASE_ADDR]
+        elif mode == MODE_CAD:
+            # A CAD takes roughly two symbols
+            self._schedule(2 * self.symbol_time(), self._cad_done, self._generation)
+
+    def _enter_standby(self):
+        self.regs[REG_01_OP_MODE] = (self.regs[REG_01_OP_MODE] & 0xF8) | MODE_STDBY
+        self._generation += 1
+
+    def _raise_irq(self, flags):
+        self.regs[REG_12_IRQ_FLAGS] |= flags & ~self.regs[REG_11_IRQ_FLAGS_MASK] & 0xFF
+
+    def _tx_done(self, generation, packet):
+        if generation != self._generation:
+            return  # mode changed before the packet was sent
+
+        self.tx_packets += 1
+        self._enter_standby()
+        self._raise_irq(TX_DONE)
+
+        # Hand the packet on from the worker once our lock is released,
+        # a peer delivering to us at the same time would otherwise deadlock
+        if self.on_transmit is not None:
+            self._callbacks.append(functools.partial(self.on_transmit, packet))
+        for peer in self.peers:
+            self._callbacks.append(functools.partial(peer.deliver, packet))
+
+    def _cad_done(self, generation):
+        if generation != self._generation:
+            return
+        self._enter_standby()
+        self._raise_irq(CAD_DONE)
+
+    # -------------------------------------------------------------- reception
+
+    def deliver(self, packet, rssi=None, snr=None, crc_ok=True):
+        """A packet has finished arriving over the air. Returns False if the
+        radio was not listening and the packet was missed."""
+        with self._cond:
+            mode = self.op_mode
+            if not self.long_range_mode or mode not in (MODE_RXCONTINUOUS, MODE_RXSINGLE):
+                self.rx_missed += 1
+                return False
+
+            rssi = self.rssi if rssi is None else rssi
+            snr = self.snr if snr is None else snr
+            length = len(packet)
+
+            start = self.regs[REG_25_FIFO_RX_BYTE_ADDR]
+            for i in range(length):
+                self.fifo[(start + i) & 0xFF] = packet[i]
+            self.regs[REG_10_FIFO_RX_CURRENT_ADDR] = start
+            self.regs[REG_13_RX_NB_BYTES] = length
+            self.regs[REG_25_FIFO_RX_BYTE_ADDR] = (start + length) & 0xFF
+            self.regs[REG_19_PKT_SNR_VALUE] = int(round(snr * 4)) & 0xFF
+            self.regs[REG_1A_PKT_RSSI_VALUE] = self._rssi_register(rssi, snr)
+
+            # RxHeaderCnt and RxPacketCnt
+            self.rx_packets += 1
+            for register in (0x14, 0x16):
+                self.regs[register] = (self.rx_packets >> 8) & 0xFF
+                self.regs[register + 1] = self.rx_packets & 0xFF
+
+            flags = RX_DONE | VALID_HEADER
+            if not crc_ok:
+                flags |= PAYLOAD_CRC_ERROR
+            self._raise_irq(flags)
+
+            if mode == MODE_RXSINGLE:
+                self._enter_standby()
+
+            self._update_dio0()
+            return True
+
+    def inject(self, packet, rssi=None, snr=None, crc_ok=True):
+        """Start receiving a packet from an outside transmitter. It is
+        delivered once its time-on-air (scaled by `time_scale`) has passed."""
+        with self._cond:
+            self._schedule(self.time_on_air(len(packet)), self.deliver, bytes(packet), rssi, snr, crc_ok)
+
+    def _rssi_register(self, rssi, snr):
+        # Inverse of the datasheet's packet RSSI formula (section 5.5.5)
+        offset = 157 if self.frequency_mhz >= 779 else 164
+        value = rssi + offset
+        if snr >= 0:
+            value = value * 15 / 16
+        else:
+            value -= snr
+        return min(max(int(round(value)), 0), 255)
+
+    # ---------------------------------------------------------- modem timing
+
+    @property
+    def frequency_mhz(self):
+        frf = (self.regs[0x06] << 16) | (self.regs[0x07] << 8) | self.regs[0x08]
+        return frf * 32e6 / (1 << 19) / 1e6
+
+    def symbol_time(self):
+        config1 = self.regs[REG_1D_MODEM_CONFIG1]
+        sf = min(max(self.regs[REG_1E_MODEM_CONFIG2] >> 4, 6), 12)
+        return symbol_time(sf, BANDWIDTHS[min(config1 >> 4, len(BANDWIDTHS) - 1)])
+
+    def time_on_air(self, length):
+        """Seconds to send `length` bytes with the current modem registers
+        (SX1276 datasheet section 4.1.1.7)."""
+        config1 = self.regs[REG_1D_MODEM_CONFIG1]
+        config2 = self.regs[REG_1E_MODEM_CONFIG2]
+        sf = min(max(config2 >> 4, 6), 12)
+        cr = (config1 >> 1) & 0x07
+        implicit_header = config1 & 0x01
+        crc = (config2 >> 2) & 0x01
+        ldro = (self.regs[REG_26_MODEM_CONFIG3] >> 3) & 0x01
+        preamble = (self.regs[REG_20_PREAMBLE_MSB] << 8) | self.regs[REG_21_PREAMBLE_LSB]
+        bandwidth = BANDWIDTHS[min(config1 >> 4, len(BANDWIDTHS) - 1)]
+        return lora_time_on_air(length, sf, bandwidth, cr, preamble, crc, implicit_header, ldro)
+
+    # ------------------------------------------------------ interrupt worker
+
+    def _update_dio0(self):
+        source = DIO0_SOURCES[self.regs[REG_40_DIO_MAPPING1] >> 6]
+        level = bool(self.regs[REG_12_IRQ_FLAGS] & source)
+        if level and not self._dio0 and self._dio0_listeners:
+            self._callbacks.extend(self._dio0_listeners)
+            self._start_worker()
+            self._cond.notify_all()
+        self._dio0 = level
+
+    def _schedule(self, delay, action, *args):
+        due = time.monotonic() + delay * self.time_scale
+        heapq.heappush(self._events, (due, next(self._event_seq), action, args))
+        self._start_worker()
+        self._cond.notify_all()
+
+    def _start_worker(self):
+        # One thread plays the chip's timeline (TX/CAD completion, reception),
+        # another runs the DIO0 callbacks so a handler that waits on the chip
+        # (e.g. sending an ACK) does not stall it
+        if self._worker is None:
+            self._worker = (threading.Thread(target=self._run_events, name="sx127x-emulator", daemon=True),
+                            threading.Thread(target=self._run_callbacks, name="sx127x-dio0", daemon=True))
+            for thread in self._worker:
+                thread.start()
+
+    def _run_events(self):
+        with self._cond:
+            while not self._closed:
+                if not self._events:
+                    self._cond.wait()
+                    continue
+
+                wait = self._events[0][0] - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                _, _, action, args = heapq.heappop(self._events)
+                action(*args)
+                self._update_dio0()
+                if self._callbacks:
+                    self._cond.notify_all()
+
+    def _run_callbacks(self):
+        while True:
+            with self._cond:
+                while not self._callbacks:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+
+                callbacks = self._callbacks
+                self._callbacks = []
+
+            # Run outside the lock, handlers talk to the chip over SPI
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    traceback.print_exc()
+
+
+class EmulatedSpiDev(object):
+    """spidev.SpiDev stand-in connected to an SX127xEmulator."""
+
+    def __init__(self, chip):
+        self.chip = chip
+        self.max_speed_hz = 5000000
+        self.mode = 0
+        self.bits_per_word = 8
+        self.bus = None
+        self.device = None
+
+    def open(self, bus, device):
+        self.bus = bus
+        self.device = device
+
+    def close(self):
+        self.bus = None
+        self.device = None
+
+    def xfer(self, data, *args):
+        return self.chip.transfer(data)
+
+    xfer2 = xfer
+    xfer3 = xfer
+
+    def writebytes(self, data):
+        self.chip.transfer(data)
+
+    writebytes2 = writebytes
+
+
+class EmulatedButton(object):
+    """gpiozero.Button stand-in for the DIO0 line. `when_pressed` is called
+    on each rising edge, with this object if it takes an argument."""
+
+    def __init__(self, chip, pin=None, pull_up=False):
+        self.chip = chip
+        self.pin = pin
+        self._when_pressed = None
+        self._pass_device = False
+        chip.add_dio0_listener(self._pressed)
+
+    @property
+    def value(self):
+        return int(self.chip.dio0)
+
+    @property
+    def is_pressed(self):
+        return self.chip.dio0
+
+    @property
+    def when_pressed(self):
+        return self._when_pressed
+
+    @when_pressed.setter
+    def when_pressed(self, callback):
+        self._pass_device = False
+        if callback is not None:
+            required = [p for p in inspect.signature(callback).parameters.values()
+                        if p.default is p.empty and p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+            self._pass_device = len(required) == 1
+        self._when_pressed = callback
+
+    def _pressed(self):
+        callback = self._when_pressed
+        if callback is None:
+            return
+        if self._pass_device:
+            callback(self)
+        else:
+            callback()
+
+    def close(self):
+        self.chip.remove_dio0_listener(self._pressed)
+
+
+class EmulatedGPIO(object):
+    """The parts of RPi.GPIO the PyCubed RFM9x driver uses. Driving the reset
+    pin as an output and releasing it resets the chip."""
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, chip, reset_pin=12):
+        self.chip = chip
+        self.reset_pin = reset_pin
+        self._reset_asserted = False
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        if pin != self.reset_pin:
+            return
+        if direction == self.OUT:
+            self._reset_asserted = True
+        elif self._reset_asserted:
+            self._reset_asserted = False
+            self.chip.reset()
+
+    def output(self, pin, value):
+        pass
+
+    def input(self, pin):
+        return int(self.chip.dio0)
+
+    def cleanup(self, *args):
+        pass
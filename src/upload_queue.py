@@ -0,0 +1,349 @@
+"""
+'upload_queue.py'
+=================
+Background S3 uploads for the ground station. `put` spools the data to
+disk and returns, a worker thread uploads it from memory with
+`put_object` and retries failures with exponential backoff, so the radio
+loop never waits for the network:
+
+    uploads = UploadQueue(s3_client)
+    uploads.put(image, [(AWS_S3_BUCKET_NAME, 'earth_image.jpg'), (AWS_PUBLIC_BUCKET, 'latest_earth_image.jpg')])
+
+Spool layout, one pair of files per job in `spool_dir`:
+
+    <id>.data   the bytes to upload
+    <id>.json   {"destinations": [[bucket, key], ...], "attempts": n}
+
+plus one file per multipart upload started on S3 and not finished yet:
+
+    <id>.upload {"bucket": bucket, "key": key, "upload_id": upload_id}
+
+The JSON file is written last, atomically, and lists the destinations
+still to do. Jobs found in the spool when the queue is created, left by
+a stopped or crashed ground station, are uploaded first. A data file
+without its JSON file was not queued and is deleted.
+
+An object that is still being received can be streamed with a
+MultipartUpload, so little is left to send once the last byte is in:
+
+    upload = uploads.stream(AWS_S3_BUCKET_NAME, 'earth_image.jpg')
+    upload.update(first_bytes)          # as more of the object arrives
+    uploads.put(image, [(AWS_S3_BUCKET_NAME, 'earth_image.jpg')], stream=upload)
+
+The final `put` is spooled like any other. If the multipart upload cannot
+be finished (or the ground station restarts first) the object is put
+whole instead and the multipart upload aborted, so its parts are not
+left on S3.
+"""
+
+from collections import deque
+import heapq
+import json
+import os
+import random
+import threading
+import time
+
+# S3 rejects multipart uploads with a part, other than the last, smaller than this
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Attempts at finishing a multipart upload before putting the object whole
+STREAM_ATTEMPTS = 2
+
+
+class _UploadJob(object):
+    __slots__ = ('id', 'destinations', 'attempts', 'due', 'data', 'stream')
+
+    def __init__(self, job_id, destinations, attempts=0, data=None, stream=None):
+        self.id = job_id
+        self.destinations = destinations
+        self.attempts = attempts
+        self.due = 0.0
+        self.data = data        # None until needed for jobs loaded from the spool
+        self.stream = stream    # MultipartUpload already holding the start of data
+
+    def __lt__(self, other):
+        return (self.due, self.id) < (other.due, other.id)
+
+
+class MultipartUpload(object):
+    """S3 multipart upload of an object that is still being received,
+    created by UploadQueue.stream. Whole parts of `part_size` bytes are
+    uploaded by the worker as soon as `update` has them. Not thread safe,
+    `update` and `cancel` are for the thread receiving the object."""
+
+    def __init__(self, queue, job_id, bucket, key, part_size=MIN_PART_SIZE):
+        self.queue = queue
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+
+        self.offset = 0         # bytes split into parts so far
+        self.upload_id = None
+        self.etags = []         # ETag of every part uploaded, part n at n - 1
+        self.parts = deque()    # parts not uploaded yet
+        self.cancelled = False
+
+        # Scheduling on the worker
+        self.id = job_id
+        self.attempts = 0
+        self.due = 0.0
+        self.queued = False
+
+    def __lt__(self, other):
+        return (self.due, self.id) < (other.due, other.id)
+
+    def _split(self, data):
+        while len(data) - self.offset >= self.part_size:
+            self.parts.append(bytes(data[self.offset:self.offset + self.part_size]))
+            self.offset += self.part_size
+
+    def update(self, data):
+        """`data` (bytes-like) is the start of the object, queue the whole
+        parts in it that have not been queued yet"""
+        if len(data) - self.offset >= self.part_size:
+            self._split(data)
+            self.queue._schedule(self)
+
+    def cancel(self):
+        """Abort the upload, the object will not be finished"""
+        self.cancelled = True
+        self.parts.clear()
+        self.queue._schedule(self)
+
+
+class UploadQueue(object):
+    """Uploads to `s3_client` on a worker thread. A failed upload is tried
+    again after `base_delay` seconds, doubling up to `max_delay` (with
+    jitter), without holding up the jobs behind it."""
+
+    def __init__(self, s3_client, spool_dir='upload_spool', base_delay=1.0, max_delay=300.0):
+        self.s3_client = s3_client
+        self.spool_dir = spool_dir
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._jobs = []     # heap of _UploadJob by due time
+        self._busy = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # Statistics
+        self.uploaded = 0
+        self.failures = 0
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self._next_id = 0
+        names = set(os.listdir(spool_dir))
+        for name in sorted(names):
+            job_id, _, extension = name.partition('.')
+            if extension == 'json':
+                with open(os.path.join(spool_dir, name)) as f:
+                    state = json.load(f)
+                heapq.heappush(self._jobs, _UploadJob(int(job_id), [tuple(d) for d in state['destinations']],
+                                                      state['attempts']))
+            elif extension == 'upload':
+                # Multipart upload of a stopped ground station, its object is put whole
+                with open(os.path.join(spool_dir, name)) as f:
+                    state = json.load(f)
+                upload = MultipartUpload(self, int(job_id), state['bucket'], state['key'])
+                upload.upload_id = state['upload_id']
+                upload.cancelled = True
+                upload.queued = True
+                heapq.heappush(self._jobs, upload)
+            else:
+                if (extension == 'data' and job_id + '.json' not in names) or extension.endswith('.tmp'):
+                    # Left by a crash before the job was queued or while writing state
+                    os.remove(os.path.join(spool_dir, name))
+                continue
+            self._next_id = max(self._next_id, int(job_id) + 1)
+
+        self._thread = threading.Thread(target=self._run, name='upload_queue', daemon=True)
+        self._thread.start()
+
+    def _path(self, job_id, extension):
+        return os.path.join(self.spool_dir, f'{job_id:08d}.{extension}')
+
+    def _write_state(self, job):
+        tmp = self._path(job.id, 'json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'destinations': job.destinations, 'attempts': job.attempts}, f)
+        os.replace(tmp, self._path(job.id, 'json'))
+
+    def put(self, data, destinations, stream=None):
+        """Queue `data` (bytes-like) for upload to every (bucket, key) in
+        `destinations`. Returns once it is safe in the spool. The destination
+        of `stream`, a MultipartUpload of the start of `data`, is finished
+        from it."""
+        data = bytes(data)
+        with self._cond:
+            job = _UploadJob(self._next_id, [tuple(d) for d in destinations], data=data, stream=stream)
+            self._next_id += 1
+
+        with open(self._path(job.id, 'data'), 'wb') as f:
+            f.write(data)
+        self._write_state(job)
+
+        with self._cond:
+            heapq.heappush(self._jobs, job)
+            self._cond.notify_all()
+        return job.id
+
+    def put_file(self, filename, destinations):
+        """Queue the contents of a file, which can be removed once this returns"""
+        with open(filename, 'rb') as f:
+            return self.put(f.read(), destinations)
+
+    def stream(self, bucket, key, part_size=MIN_PART_SIZE):
+        """MultipartUpload to `key` in `bucket`, for an object still being received"""
+        with self._cond:
+            upload = MultipartUpload(self, self._next_id, bucket, key, part_size)
+            self._next_id += 1
+        return upload
+
+    def _schedule(self, upload):
+        with self._cond:
+            if not upload.queued:
+                upload.queued = True
+                upload.due = time.monotonic()
+                heapq.heappush(self._jobs, upload)
+                self._cond.notify_all()
+
+    def pending(self):
+        """Jobs not fully uploaded yet"""
+        with self._cond:
+            return len(self._jobs) + self._busy
+
+    def join(self, timeout=None):
+        """Wait for the queue to empty, False if it did not within `timeout`"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._jobs or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=0.0):
+        """Stop the worker after waiting up to `timeout` seconds for the queue
+        to empty. Jobs not uploaded stay in the spool for the next start."""
+        if timeout:
+            self.join(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _upload(self, job):
+        if job.data is None:
+            with open(self._path(job.id, 'data'), 'rb') as f:
+                job.data = f.read()
+
+        while job.destinations:
+            bucket, key = job.destinations[0]
+            stream = job.stream
+            try:
+                if (stream is not None) and ((stream.bucket, stream.key) == (bucket, key)):
+                    if job.attempts < STREAM_ATTEMPTS:
+                        self._finish_stream(stream, job.data)
+                    else:
+                        # Put the object whole and abort the multipart upload (retried on
+                        # its own), its parts are billed until then
+                        stream.cancel()
+                        self.s3_client.put_object(Bucket=bucket, Key=key, Body=job.data)
+                else:
+                    self.s3_client.put_object(Bucket=bucket, Key=key, Body=job.data)
+            except Exception as e:
+                self.failures += 1
+                print(f'Upload of {key} to {bucket} failed, attempt {job.attempts + 1}: {e}')
+                return False
+            job.destinations.pop(0)
+            self.uploaded += 1
+            if job.destinations:
+                self._write_state(job)
+        return True
+
+    def _send_parts(self, upload):
+        if upload.cancelled:
+            if upload.upload_id is not None:
+                self.s3_client.abort_multipart_upload(Bucket=upload.bucket, Key=upload.key,
+                                                      UploadId=upload.upload_id)
+                upload.upload_id = None
+                os.remove(self._path(upload.id, 'upload'))
+            return
+
+        if upload.parts and (upload.upload_id is None):
+            response = self.s3_client.create_multipart_upload(Bucket=upload.bucket, Key=upload.key)
+            upload.upload_id = response['UploadId']
+            # Recorded so the next start can abort it if this one stops first
+            tmp = self._path(upload.id, 'upload.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({'bucket': upload.bucket, 'key': upload.key, 'upload_id': upload.upload_id}, f)
+            os.replace(tmp, self._path(upload.id, 'upload'))
+        while upload.parts:
+            response = self.s3_client.upload_part(Bucket=upload.bucket, Key=upload.key,
+                                                  PartNumber=len(upload.etags) + 1,
+                                                  UploadId=upload.upload_id, Body=upload.parts[0])
+            upload.etags.append(response['ETag'])
+            upload.parts.popleft()
+
+    def _finish_stream(self, upload, data):
+        upload._split(data)
+        if upload.offset == 0:
+            # Smaller than a part, nothing was streamed
+            self.s3_client.put_object(Bucket=upload.bucket, Key=upload.key, Body=data)
+            return
+
+        if len(data) > upload.offset:
+            upload.parts.append(data[upload.offset:])
+            upload.offset = len(data)
+        self._send_parts(upload)
+        parts = [{'ETag': etag, 'PartNumber': number} for number, etag in enumerate(upload.etags, 1)]
+        self.s3_client.complete_multipart_upload(Bucket=upload.bucket, Key=upload.key,
+                                                 UploadId=upload.upload_id,
+                                                 MultipartUpload={'Parts': parts})
+        upload.upload_id = None
+        os.remove(self._path(upload.id, 'upload'))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._jobs or self._jobs[0].due > time.monotonic()):
+                    self._cond.wait(self._jobs[0].due - time.monotonic() if self._jobs else None)
+                if self._closed:
+                    return
+                job = heapq.heappop(self._jobs)
+                stream = isinstance(job, MultipartUpload)
+                if stream:
+                    job.queued = False
+                self._busy += 1
+
+            if stream:
+                try:
+                    self._send_parts(job)
+                    job.attempts = 0
+                    done = True
+                except Exception as e:
+                    self.failures += 1
+                    print(f'Upload of a part of {job.key} to {job.bucket} failed: {e}')
+                    done = False
+            else:
+                done = self._upload(job)
+                if done:
+                    os.remove(self._path(job.id, 'json'))
+                    os.remove(self._path(job.id, 'data'))
+
+            if not done:
+                job.attempts += 1
+                if not stream:
+                    self._write_state(job)
+                delay = min(self.base_delay * (2 ** (job.attempts - 1)), self.max_delay)
+                job.due = time.monotonic() + delay * (0.5 + random.random() / 2)
+
+            with self._cond:
+                if not done and not (stream and job.queued):
+                    if stream:
+                        job.queued = True
+                    heapq.heappush(self._jobs, job)
+                self._busy -= 1
+                self._cond.notify_all()
@@ -0,0 +1,333 @@
+"""
+'virtual_link.py'
+=================
+Packet level RF link between two in-process radios, running on a
+virtual clock so a whole pass can be replayed in a fraction of the time.
+
+    clock = VirtualClock()
+    link = VirtualLink(clock, uplink=GilbertElliottChannel(), downlink=GilbertElliottChannel(p_good_to_bad=0.02))
+    gs_radio = link.radio_a     # drop-in for argus_lora.LoRa
+    sat_radio = link.radio_b
+
+Nothing here sleeps for real. VirtualClock is a discrete event scheduler:
+a blocking call on the ground station side (receive, wait_packet_sent,
+sleep) runs the scheduled events - packets finishing their time-on-air,
+satellite replies - up to the time it would have returned.
+
+The channel decides per packet whether it arrives, using a Gilbert-Elliott
+two-state burst loss model, an SNR trace checked against the demodulator
+floor of the current spreading factor, and a CRC corruption rate.
+"""
+
+import heapq
+import itertools
+import math
+import random
+import time
+
+from airtime import noise_floor
+from argus_lora import ModemConfig, ModemProfile
+from constants import BROADCAST_ADDRESS, FLAGS_ACK, PREAMBLE_LENGTH
+from lora_packet import LoRaPacket, PacketQueue
+
+# Bandwidth the SNR traces are given for, wider bandwidths let in more noise
+REFERENCE_BANDWIDTH = 125000
+
+
+class VirtualClock(object):
+    """Virtual time and the event queue that drives it. Provides the
+    `time`, `sleep`, `monotonic` and `*_ns` functions of the time module so
+    it can be passed wherever code takes a clock."""
+
+    def __init__(self, epoch=None):
+        # Wall clock time at virtual time 0
+        self.epoch = time.time() if epoch is None else epoch
+        self._now = 0.0
+        self._events = []
+        self._seq = itertools.count()
+        self.events_run = 0
+
+    def monotonic(self):
+        return self._now
+
+    def monotonic_ns(self):
+        return int(self._now * 1e9)
+
+    def time(self):
+        return self.epoch + self._now
+
+    def time_ns(self):
+        return int((self.epoch + self._now) * 1e9)
+
+    def schedule(self, delay, action, *args):
+        """Run `action(*args)` `delay` seconds from now."""
+        heapq.heappush(self._events, (self._now + max(delay, 0.0), next(self._seq), action, args))
+
+    def pending(self):
+        return len(self._events)
+
+    def step(self, deadline=None):
+        """Run the next event if it is due by `deadline`. Returns False and
+        advances to the deadline when there is nothing left to run before it."""
+        if not self._events or (deadline is not None and self._events[0][0] > deadline):
+            if deadline is not None and deadline > self._now:
+                self._now = deadline
+            return False
+
+        due, _, action, args = heapq.heappop(self._events)
+        if due > self._now:
+            self._now = due
+        self.events_run += 1
+        action(*args)
+        return True
+
+    def run_until(self, deadline):
+        while self.step(deadline):
+            pass
+
+    def sleep(self, seconds):
+        self.run_until(self._now + seconds)
+
+
+def pass_snr_trace(duration, peak_snr=10.0, horizon_snr=-12.0):
+    """SNR over a pass: lowest at the horizons, highest at culmination,
+    out of view (no signal) outside [0, duration]."""
+    def snr(t):
+        if t < 0 or t > duration:
+            return -math.inf
+        return horizon_snr + (peak_snr - horizon_snr) * math.sin(math.pi * t / duration)
+    return snr
+
+
+class GilbertElliottChannel(object):
+    """One direction of the link.
+
+    The channel is in a good or a bad state, moving between them with
+    `p_good_to_bad` / `p_bad_to_good` per packet, and drops packets with
+    `loss_good` / `loss_bad` in each state - so losses come in bursts.
+    Packets that survive are also dropped when the SNR from `snr_trace`
+    (a callable of virtual time, or a constant, in dB at 125 kHz bandwidth)
+    is below what the receiver can demodulate with the packet's modem
+    config, and arrive with a bad CRC at `crc_error_rate`.
+    """
+
+    def __init__(self, p_good_to_bad=0.0, p_bad_to_good=1.0, loss_good=0.0, loss_bad=1.0,
+                 crc_error_rate=0.0, snr_trace=10.0, seed=None):
+        self.p_good_to_bad = p_good_to_bad
+        self.p_bad_to_good = p_bad_to_good
+        self.loss_good = loss_good
+        self.loss_bad = loss_bad
+        self.crc_error_rate = crc_error_rate
+        self.snr_trace = snr_trace
+        self.random = random.Random(seed)
+        self.bad = False
+
+        # Statistics
+        self.sent = 0
+        self.lost = 0
+        self.corrupted = 0
+
+    def snr(self, t):
+        if callable(self.snr_trace):
+            return self.snr_trace(t)
+        return self.snr_trace
+
+    def transmit(self, t, airtime):
+        """Fate of one packet sent at virtual time `t` with the modem setup
+        in `airtime` (airtime.Airtime). Returns None if it is lost,
+        otherwise (crc_ok, snr)."""
+        self.sent += 1
+        rng = self.random
+
+        if self.bad:
+            if rng.random() < self.p_bad_to_good:
+                self.bad = False
+        elif rng.random() < self.p_good_to_bad:
+            self.bad = True
+
+        snr = self.snr(t) - 10 * math.log10(airtime.bandwidth / REFERENCE_BANDWIDTH)
+        if (rng.random() < (self.loss_bad if self.bad else self.loss_good)) or snr < airtime.snr_limit:
+            self.lost += 1
+            return None
+
+        if rng.random() < self.crc_error_rate:
+            self.corrupted += 1
+            return False, snr
+
+        return True, snr
+
+    def stats(self):
+        return {"sent": self.sent, "lost": self.lost, "corrupted": self.corrupted}
+
+
+class VirtualRadio(object):
+    """Half duplex radio on a VirtualLink with the interface of
+    argus_lora.LoRa that the ground station uses. A packet is only received
+    if the radio was listening for its whole time-on-air and both ends use
+    the same modem config and frequency.
+
+    `send` does not block: TX ends `time_on_air` later on the virtual
+    clock, and `wait_packet_sent` runs the clock up to that point."""
+
+    def __init__(self, link, this_address, modem_config=ModemConfig.Bw125Cr45Sf128, freq=433.0,
+                 preamble=PREAMBLE_LENGTH, rx_queue_size=64):
+        self.link = link
+        self.clock = link.clock
+        self.peer = None
+        self.channel = None     # channel used by our transmissions
+
+        self._this_address = this_address
+        self._last_header_id = 0
+        self._last_payload = None
+
+        self.rx_queue = PacketQueue(rx_queue_size)
+        self.crc_error_count = 0
+
+        self.listening = False
+        self._rx_since = 0.0
+        self.tx_end = 0.0
+
+        # Modem config, frequency and preamble, the ground station always runs with CRC on
+        self.apply_profile(ModemProfile(modem_config, freq, preamble=preamble))
+
+        # Statistics
+        self.tx_packets = 0
+        self.tx_airtime = 0.0
+        self.rx_packets = 0
+        self.rx_missed = 0      # arrived while we were not listening (or mismatched config)
+
+    def on_recv(self, packet):
+        # Called at the virtual time the packet is received, may be overridden
+        pass
+
+    # ------------------------------------------------------------- modes
+
+    def set_mode_rx(self):
+        if not self.listening and self.clock.monotonic() >= self.tx_end:
+            self.listening = True
+            self._rx_since = self.clock.monotonic()
+
+    def set_mode_idle(self):
+        self.listening = False
+
+    def sleep(self):
+        self.listening = False
+
+    def close(self):
+        self.listening = False
+
+    def apply_profile(self, profile, force=False):
+        """Switch to a ModemProfile. A packet being received is lost, as
+        the radio passes through standby."""
+        self.profile = profile
+        self.modem_config = profile.modem_config
+        self.freq = profile.freq
+        self.preamble = profile.preamble
+        self.airtime = profile.airtime
+        if self.listening:
+            self._rx_since = self.clock.monotonic()
+
+    # ------------------------------------------------------------ timing
+
+    def time_on_air(self, length):
+        return self.airtime.time_on_air(length)
+
+    def symbol_time(self):
+        return self.airtime.t_sym
+
+    # ---------------------------------------------------------- transmit
+
+    def send(self, data, header_to, header_id=0, header_flags=0):
+        self.wait_packet_sent()
+        self.listening = False
+
+        if type(data) == int:
+            data = bytes((data,))
+        elif type(data) == str:
+            data = data.encode()
+
+        packet = bytes((header_to, self._this_address, header_id, header_flags)) + bytes(data)
+        assert len(packet) <= 255, "LoRa packets are limited to 255 bytes"
+
+        start = self.clock.monotonic()
+        airtime = self.time_on_air(len(packet))
+        self.tx_end = start + airtime
+        self.tx_packets += 1
+        self.tx_airtime += airtime
+
+        fate = self.channel.transmit(start, self.airtime) if self.channel is not None else (True, 10.0)
+        if fate is not None and self.peer is not None:
+            self.clock.schedule(airtime, self.peer._arrive, packet, start, fate[0], fate[1],
+                                self.modem_config, self.freq)
+        return True
+
+    def wait_packet_sent(self, timeout=None):
+        if self.clock.monotonic() < self.tx_end:
+            self.clock.run_until(self.tx_end)
+        return True
+
+    def send_to_wait(self, data, header_to, header_flags=0, retries=3):
+        self._last_header_id = (self._last_header_id + 1) & 0xff
+        self.send(data, header_to, self._last_header_id, header_flags)
+        self.wait_packet_sent()
+        self.set_mode_rx()
+        return True
+
+    # ----------------------------------------------------------- receive
+
+    def _arrive(self, packet, start, crc_ok, snr, modem_config, freq):
+        if (not self.listening or self._rx_since > start or modem_config != self.modem_config or
+                freq != self.freq):
+            self.rx_missed += 1
+            return
+
+        if not crc_ok:
+            self.crc_error_count += 1
+            return
+
+        header_to, header_from, header_id, header_flags = packet[:4]
+        if header_to != BROADCAST_ADDRESS and header_to != self._this_address:
+            return
+
+        rssi = round(snr + noise_floor(self.airtime.bandwidth), 2)
+
+        self.rx_packets += 1
+        self._last_payload = LoRaPacket(packet[4:], header_to, header_from, header_id, header_flags,
+                                        rssi, round(snr * 4) / 4,
+                                        self.clock.monotonic_ns(), self.clock.time_ns())
+        if not header_flags & FLAGS_ACK:
+            self.rx_queue.put(self._last_payload)
+            self.on_recv(self._last_payload)
+
+    def receive(self, timeout=None):
+        """Next packet, running the virtual clock until one arrives or
+        `timeout` seconds pass. None on timeout, or if nothing else can
+        happen on the link while waiting forever."""
+        deadline = None if timeout is None else self.clock.monotonic() + timeout
+        while not self.rx_queue:
+            if not self.clock.step(deadline):
+                break
+        return self.rx_queue.get_nowait()
+
+    def stats(self):
+        return {"tx_packets": self.tx_packets, "tx_airtime": self.tx_airtime,
+                "rx_packets": self.rx_packets, "rx_missed": self.rx_missed,
+                "crc_errors": self.crc_error_count}
+
+
+class VirtualLink(object):
+    """Two VirtualRadios joined by an uplink (a -> b) and a downlink (b -> a)
+    channel. Addresses default to the ground station (25) and satellite."""
+
+    def __init__(self, clock=None, uplink=None, downlink=None, modem_config=ModemConfig.Bw125Cr45Sf128,
+                 freq=433.0, address_a=25, address_b=2):
+        self.clock = VirtualClock() if clock is None else clock
+        self.uplink = GilbertElliottChannel() if uplink is None else uplink
+        self.downlink = GilbertElliottChannel() if downlink is None else downlink
+
+        self.radio_a = VirtualRadio(self, address_a, modem_config, freq)
+        self.radio_b = VirtualRadio(self, address_b, modem_config, freq)
+        self.radio_a.peer = self.radio_b
+        self.radio_b.peer = self.radio_a
+        self.radio_a.channel = self.uplink
+        self.radio_b.channel = self.downlink